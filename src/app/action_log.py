@@ -0,0 +1,257 @@
+# ----------------------------------------------------------------------------------------------
+# The user action log is written off the request path: crud.rememberUserAction() hands each
+# action to the ActionLogWriter, which queues it in memory and returns without waiting on
+# the database. A background task flushes the queue as one multi-row INSERT when it reaches
+# ACTION_LOG_BATCH_SIZE actions or ACTION_LOG_FLUSH_SECONDS pass, and once more at shutdown.
+#
+# The queue is bounded by ACTION_LOG_MAX_QUEUED. When full, actions of the droppable levels
+# (NORMAL) are dropped and counted, while all other levels wait for a flush to make room.
+# ACTION_LOG_SAMPLE_RATES optionally keeps only 1-in-N actions of a level, such as NORMAL reads.
+#
+# Every remembered action, sampled out or dropped included, is also counted into the daily
+# action_daily rollups at each flush, so activity counts never need to scan the raw log.
+# The raw log is partitioned by month; once a day the writer makes sure upcoming months have
+# partitions and drops whole partitions older than ACTION_LOG_RETENTION_MONTHS.
+#
+import asyncio
+import time
+from datetime import datetime, date
+from typing import Dict, List, Optional, Set, Tuple
+from functools import lru_cache
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.db import DatabaseMgr, get_database_mgr, ACTION_PARTITIONS_AHEAD, ACTION_MIGRATION_LOCK
+from app.db import action_partition_months, action_partition_ddl
+from app.config import get_settings, log
+
+MAINTENANCE_SECONDS = 24 * 60 * 60  # how often partitions are created & expired
+
+
+# ----------------------------------------------------------------------------------------------
+class ActionLogWriter:
+    def __init__(self,
+                 batchSize: int,
+                 flushSeconds: float,
+                 maxQueued: int,
+                 sampleRates: Dict[int, int],
+                 droppableLevels: Set[int],
+                 retentionMonths: int = 0):
+        self.batchSize = max(1, batchSize)
+        self.flushSeconds = flushSeconds
+        self.maxQueued = max(self.batchSize, maxQueued)
+        self.sampleRates = sampleRates          # actionLevel -> keep 1 in N
+        self.droppableLevels = droppableLevels  # actionLevels dropped when the queue is full
+        self.retentionMonths = retentionMonths  # months of raw actions kept, 0 keeps all
+        #
+        self.queue: List[dict] = []
+        self.counts: Dict[Tuple, int] = {}      # (day, userid, actionLevel, actionCode) -> count
+        self.lastMaintenance = None
+        self.sampleCounts: Dict[int, int] = {}
+        # made by start() on the serving loop, as python 3.9 binds them to the loop they are made on:
+        self.lock: Optional[asyncio.Lock] = None
+        self.wake: Optional[asyncio.Event] = None
+        self.task = None
+        self.running = False
+        #
+        # counters, reported in the log at shutdown:
+        self.written = 0
+        self.dropped = 0
+        self.sampledOut = 0
+        self.failed = 0
+
+    # ------------------------------------------------------------------------------------------
+    # begin the background flushing task, called from the app startup event:
+    def start(self):
+        if self.running:
+            return
+        self.lock = asyncio.Lock()
+        self.wake = asyncio.Event()
+        self.running = True
+        self.task = asyncio.create_task( self.flush_loop() )
+
+    # ------------------------------------------------------------------------------------------
+    # stop the background task and flush whatever is still queued, called at app shutdown:
+    async def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wake_flush_loop()
+        await self.task
+        await self.flush()
+        log.info( f"ActionLogWriter: wrote {self.written}, dropped {self.dropped}, "
+                  f"sampled out {self.sampledOut}, failed {self.failed}" )
+
+    # ------------------------------------------------------------------------------------------
+    # true when this action should be kept under its level's 1-in-N sampling:
+    def sampled_in(self, actionLevel: int) -> bool:
+        rate = self.sampleRates.get(actionLevel, 1)
+        if rate <= 1:
+            return True
+        count = self.sampleCounts.get(actionLevel, 0)
+        self.sampleCounts[actionLevel] = count + 1
+        return count % rate == 0
+
+    # ------------------------------------------------------------------------------------------
+    # queue one action. Only waits when the queue is full and the action is not droppable:
+    async def remember(self, userid: int, actionLevel: int, actionCode: int, description: str):
+        row = { "userid": userid,
+                "actionLevel": actionLevel,
+                "actionCode": actionCode,
+                "description": description,
+                "created_date": datetime.now() }
+
+        key = (row["created_date"].date(), userid, actionLevel, actionCode)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+        if not self.running:
+            # not started (scripts, tests) or shutting down: write it now
+            await self.write_batch([row])
+            await self.write_counts()
+            return
+
+        if not self.sampled_in(actionLevel):
+            self.sampledOut += 1
+            return
+
+        if len(self.queue) >= self.maxQueued:
+            if actionLevel in self.droppableLevels:
+                self.dropped += 1
+                return
+            # backpressure: important actions wait for room
+            await self.flush()
+
+        self.queue.append(row)
+        if len(self.queue) >= self.batchSize:
+            self.wake_flush_loop()
+
+    # ------------------------------------------------------------------------------------------
+    # without start() there is no flush_loop waiting to be woken:
+    def wake_flush_loop(self):
+        if self.wake is not None:
+            self.wake.set()
+
+    # ------------------------------------------------------------------------------------------
+    async def flush_loop(self):
+        while self.running:
+            try:
+                await asyncio.wait_for( self.wake.wait(), timeout=self.flushSeconds )
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.info(f"ActionLogWriter: flush failed, {e}")
+            if self.lastMaintenance is None or time.monotonic() - self.lastMaintenance > MAINTENANCE_SECONDS:
+                self.lastMaintenance = time.monotonic()
+                try:
+                    await maintain_action_partitions(self.retentionMonths)
+                except Exception as e:
+                    log.info(f"ActionLogWriter: partition maintenance failed, {e}")
+
+    # ------------------------------------------------------------------------------------------
+    # write everything queued so far:
+    async def flush(self):
+        if self.lock is None:
+            # not started, so not racing the flush_loop, but other flushes on this loop:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while self.queue:
+                batch = self.queue[:self.batchSize]
+                del self.queue[:self.batchSize]
+                await self.write_batch(batch)
+            await self.write_counts()
+
+    # ------------------------------------------------------------------------------------------
+    # adds the counts gathered since the last flush into the action_daily rollups:
+    async def write_counts(self):
+        if not self.counts:
+            return
+        counts = self.counts
+        self.counts = {}
+        db_mgr: DatabaseMgr = get_database_mgr()
+        daily_tb = db_mgr.get_action_daily_table()
+        rows = [ { "day": day, "userid": userid, "actionLevel": level, "actionCode": code, "count": count }
+                 for (day, userid, level, code), count in counts.items() ]
+        query = pg_insert(daily_tb).values(rows)
+        query = query.on_conflict_do_update(
+            index_elements=[daily_tb.c.day, daily_tb.c.userid, daily_tb.c.actionLevel, daily_tb.c.actionCode],
+            set_={ "count": daily_tb.c.count + query.excluded.count } )
+        try:
+            await db_mgr.get_db().execute(query=query)
+        except Exception as e:
+            log.info(f"ActionLogWriter: failed writing {len(rows)} daily rollups, {e}")
+
+    # ------------------------------------------------------------------------------------------
+    # one multi-row INSERT; if the batch is rejected (for example an action naming a userid
+    # that does not exist) the rows are retried one at a time so only the bad ones are lost:
+    async def write_batch(self, batch: List[dict]):
+        db_mgr: DatabaseMgr = get_database_mgr()
+        action_tb = db_mgr.get_action_table()
+        try:
+            await db_mgr.get_db().execute( query=action_tb.insert().values(batch) )
+            self.written += len(batch)
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                self.failed += 1
+                log.info(f"ActionLogWriter: failed writing action {batch[0]}, {e}")
+                return
+            log.info(f"ActionLogWriter: batch of {len(batch)} failed, retrying singly, {e}")
+        for row in batch:
+            await self.write_batch([row])
+
+
+# ----------------------------------------------------------------------------------------------
+# creates the action log partitions for the months ahead, and drops whole partitions for
+# months older than retentionMonths (0 keeps everything). Returns the dropped partition names:
+async def maintain_action_partitions(retentionMonths: int) -> List[str]:
+    db_mgr: DatabaseMgr = get_database_mgr()
+    db = db_mgr.get_db()
+    dropped = []
+    async with db.transaction():
+        # several app workers run this, only one at a time does:
+        await db.execute(query="SELECT pg_advisory_xact_lock(:key)", values={"key": ACTION_MIGRATION_LOCK})
+
+        for month in action_partition_months(date.today(), ACTION_PARTITIONS_AHEAD):
+            await db.execute(query=action_partition_ddl(month))
+
+        if retentionMonths > 0:
+            # the first month kept:
+            today = date.today()
+            months = today.year * 12 + today.month - 1 - retentionMonths
+            cutoff = f"action_y{months // 12:04d}m{months % 12 + 1:02d}"
+            rows = await db.fetch_all(query="SELECT c.relname FROM pg_inherits i "
+                                            "JOIN pg_class c ON c.oid = i.inhrelid "
+                                            "JOIN pg_class p ON p.oid = i.inhparent "
+                                            "WHERE p.relname = 'action'")
+            for r in rows:
+                # partition names sort in month order:
+                if r['relname'].startswith('action_y') and r['relname'] < cutoff:
+                    await db.execute(query=f"DROP TABLE {r['relname']}")
+                    dropped.append(r['relname'])
+    if dropped:
+        log.info(f"maintain_action_partitions: dropped expired partitions {dropped}")
+    return dropped
+
+# ----------------------------------------------------------------------------------------------
+@lru_cache()
+def get_action_log_writer() -> ActionLogWriter:
+    # imported here because app.api.user_action imports crud, which imports this module:
+    from app.api.user_action import UserActionLevel
+
+    settings = get_settings()
+    sampleRates = {}
+    for levelName, rate in settings.ACTION_LOG_SAMPLE_RATES.items():
+        if levelName in UserActionLevel:
+            sampleRates[UserActionLevel.index(levelName)] = rate
+        else:
+            log.info(f"get_action_log_writer: unknown ACTION_LOG_SAMPLE_RATES level '{levelName}'")
+
+    return ActionLogWriter( batchSize = settings.ACTION_LOG_BATCH_SIZE,
+                            flushSeconds = settings.ACTION_LOG_FLUSH_SECONDS,
+                            maxQueued = settings.ACTION_LOG_MAX_QUEUED,
+                            sampleRates = sampleRates,
+                            droppableLevels = { UserActionLevel.index('NORMAL') },
+                            retentionMonths = settings.ACTION_LOG_RETENTION_MONTHS )
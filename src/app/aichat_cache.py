@@ -0,0 +1,91 @@
+# ----------------------------------------------------------------------------------------------
+# Chatbots have fixed prePrompts and the same questions are asked again and again, so AI chat
+# replies are cached in Redis by content: the key is a hash of everything deciding the reply,
+# (model, prePrompt, prompt, temperature, max_tokens), where the prompt is the conversation so
+# far. Only deterministic, temperature 0, requests are cached. The web app looks a reply up
+# before launching an OpenAI_Comm task, the worker stores each reply it completes.
+#
+# Entries expire after AICHAT_CACHE_TTL_SECONDS. A sorted set indexes the entries by the time
+# they were stored, and bounds them to the AICHAT_CACHE_MAX_ENTRIES newest; 0 disables the cache.
+# Hits and misses are counted for the admin stats endpoint.
+#
+import hashlib
+import json
+import time
+from typing import Optional
+
+import redis
+
+from app.config import get_settings, log
+from app.aichat_relay import get_sync_redis, get_async_redis
+
+# the sampling parameters of every AI chat request:
+AICHAT_SAMPLING = { "temperature": 0, "max_tokens": 900, "top_p": 1, "frequency_penalty": 0.0, "presence_penalty": 0.0 }
+
+CACHE_PREFIX = "aichatcache:"
+CACHE_INDEX = CACHE_PREFIX + "index"
+CACHE_HITS = CACHE_PREFIX + "hits"
+CACHE_MISSES = CACHE_PREFIX + "misses"
+
+
+# ----------------------------------------------------------------------------------------------
+# a conversation's (role, content) turns as the prompt text of its cache key:
+def aichat_conversation(turns) -> str:
+    return json.dumps( [ [role, content] for role, content in turns ] )
+
+# ----------------------------------------------------------------------------------------------
+# the cache key of a request, None when the request is not cacheable:
+def aichat_cache_key(model: str, prePrompt: str, prompt: str, sampling: dict = AICHAT_SAMPLING) -> Optional[str]:
+    if get_settings().AICHAT_CACHE_MAX_ENTRIES <= 0 or sampling["temperature"] != 0:
+        return None
+    content = json.dumps( [model, prePrompt, prompt, sampling["temperature"], sampling["max_tokens"]] )
+    return CACHE_PREFIX + hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+# ----------------------------------------------------------------------------------------------
+# web app side: returns the cached reply or None, counting the hit or miss:
+async def get_cached_reply(key: Optional[str]) -> Optional[str]:
+    if key is None:
+        return None
+    client = get_async_redis()
+    try:
+        reply = await client.get(key)
+        await client.incr( CACHE_HITS if reply is not None else CACHE_MISSES )
+    except redis.RedisError as e:
+        log.info(f"get_cached_reply: {e}")
+        return None
+    return reply.decode("utf-8") if reply is not None else None
+
+# ----------------------------------------------------------------------------------------------
+# worker side: stores a reply, then evicts index entries that expired or are beyond the bound:
+def store_cached_reply(key: Optional[str], reply: str):
+    if key is None:
+        return
+    settings = get_settings()
+    now = time.time()
+    client = get_sync_redis()
+    try:
+        with client.pipeline() as pipe:
+            pipe.set( key, reply, ex=settings.AICHAT_CACHE_TTL_SECONDS )
+            pipe.zadd( CACHE_INDEX, {key: now} )
+            pipe.zremrangebyscore( CACHE_INDEX, "-inf", now - settings.AICHAT_CACHE_TTL_SECONDS )
+            pipe.zcard( CACHE_INDEX )
+            count = pipe.execute()[-1]
+        excess = count - settings.AICHAT_CACHE_MAX_ENTRIES
+        if excess > 0:
+            evicted = [ k for k, score in client.zpopmin( CACHE_INDEX, excess ) ]
+            client.delete( *evicted )
+    except redis.RedisError as e:
+        log.info(f"store_cached_reply: {e}")
+
+# ----------------------------------------------------------------------------------------------
+async def get_cache_stats() -> dict:
+    client = get_async_redis()
+    hits, misses = await client.mget( CACHE_HITS, CACHE_MISSES )
+    hits = int(hits or 0)
+    misses = int(misses or 0)
+    return { "hits": hits,
+             "misses": misses,
+             "hitRate": hits / (hits + misses) if hits + misses else 0.0,
+             "entries": await client.zcard( CACHE_INDEX ),
+             "maxEntries": get_settings().AICHAT_CACHE_MAX_ENTRIES,
+             "ttlSeconds": get_settings().AICHAT_CACHE_TTL_SECONDS }
@@ -0,0 +1,128 @@
+# ----------------------------------------------------------------------------------------------
+# Long AI chat conversations cannot be sent whole: they cost more and answer slower each turn,
+# and eventually exceed the model's context window. build_aichat_context() assembles what is
+# sent: the chatbot's prePrompt, a rolling summary of the older turns when there is one, and
+# as many of the most recent turns as fit the model's token budget, the context window less
+# the reply's max_tokens.
+#
+# Tokens are counted with tiktoken, its encodings cached per model after the first use, and
+# each turn's count is kept on its aichat_message row so it is only counted once. Without
+# tiktoken installed, tokens are estimated from the text's length.
+#
+from typing import Dict, List, Optional
+from functools import lru_cache
+
+from app.aichat_cache import AICHAT_SAMPLING
+from app.config import log
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# the models chatbots may use: the chat models are sent messages, text-davinci-003 a prompt:
+CHAT_MODELS = ("gpt-3.5-turbo", "gpt-4")
+AICHAT_MODELS = CHAT_MODELS + ("text-davinci-003",)
+
+# context windows, in tokens:
+MODEL_CONTEXT_TOKENS = { "gpt-4": 8192, "gpt-3.5-turbo": 4096, "text-davinci-003": 4097 }
+DEFAULT_CONTEXT_TOKENS = 4096
+MESSAGE_OVERHEAD_TOKENS = 4     # role and separators the chat format adds to each message
+SUMMARY_MAX_TOKENS = 400        # the rolling summary's reply length
+
+SUMMARY_PROMPT = ( "Summarize the conversation below between a user and an AI assistant, keeping every "
+                   "fact, name, number and decision needed to continue it. If an earlier summary is "
+                   "given, fold it into the new summary." )
+
+
+# ----------------------------------------------------------------------------------------------
+@lru_cache()
+def get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # the encodings are fetched once then cached on disk, an offline first use lands here:
+        log.info(f"get_encoding: no tiktoken encoding for {model}, estimating, {e}")
+        return None
+
+def count_tokens(model: str, text: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+# the tokens a reply may have to itself:
+def context_budget(model: str) -> int:
+    return MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - AICHAT_SAMPLING["max_tokens"]
+
+
+# ----------------------------------------------------------------------------------------------
+# one turn of a conversation as the context builder sees it, tokens counted when missing:
+class AiChatTurn:
+    __slots__ = ('seq', 'role', 'content', 'tokens')
+    def __init__(self, seq: int, role: str, content: str, tokens: Optional[int]):
+        self.seq = seq
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+
+# ----------------------------------------------------------------------------------------------
+class AiChatContext:
+    def __init__(self):
+        self.messages: List[Dict[str, str]] = []    # system, summary & kept turns, oldest first
+        self.inputTokens = 0
+        self.unsummarized: List[AiChatTurn] = []    # turns left out that the summary does not cover
+
+    # the context as one completion model prompt:
+    def prompt(self) -> str:
+        return " \n".join( m["content"] for m in self.messages )
+
+# ----------------------------------------------------------------------------------------------
+# assembles the context of a conversation's next reply. summarySeq is the last turn the summary
+# covers. The newest turn, the question, is always kept:
+def build_aichat_context(model: str, prePrompt: str, turns: List[AiChatTurn],
+                         summary: Optional[str] = None, summarySeq: int = 0) -> AiChatContext:
+    context = AiChatContext()
+    for t in turns:
+        if t.tokens is None:
+            t.tokens = count_tokens(model, t.content)
+
+    head = [ {"role": "system", "content": prePrompt} ]
+    if summary:
+        head.append( {"role": "system", "content": "Summary of the earlier conversation: " + summary} )
+    used = sum( count_tokens(model, m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in head )
+    budget = context_budget(model)
+
+    kept = []
+    for t in reversed(turns):
+        cost = t.tokens + MESSAGE_OVERHEAD_TOKENS
+        if kept and used + cost > budget:
+            break
+        kept.append(t)
+        used += cost
+    kept.reverse()
+
+    # turns left out are either covered by the summary or need summarizing by the caller:
+    firstKept = kept[0].seq if kept else 0
+    context.unsummarized = [ t for t in turns if summarySeq < t.seq < firstKept ]
+    context.messages = head + [ {"role": t.role, "content": t.content} for t in kept ]
+    context.inputTokens = used
+    return context
+
+# ----------------------------------------------------------------------------------------------
+# the completion request folding turns into the rolling summary, in the model's own format:
+def summary_request(model: str, summary: Optional[str], turns: List[AiChatTurn]) -> dict:
+    text = "\n\n".join( f"{t.role}: {t.content}" for t in turns )
+    if summary:
+        text = f"Earlier summary: {summary}\n\n{text}"
+    request = dict( AICHAT_SAMPLING, max_tokens = SUMMARY_MAX_TOKENS )
+    if model == "text-davinci-003":
+        request["prompt"] = SUMMARY_PROMPT + " \n" + text
+    else:
+        request["messages"] = [ {"role": "system", "content": SUMMARY_PROMPT},
+                                {"role": "user", "content": text} ]
+    return request
@@ -0,0 +1,163 @@
+# ----------------------------------------------------------------------------------------------
+# AI chat completions are I/O bound: a Celery task spends its life waiting on OpenAI. Rather
+# than each in-flight chat holding a whole worker process in a blocking HTTP call, the
+# CompletionPool runs every completion of a worker process on one asyncio event loop in a
+# background thread. Tasks, run in the worker's thread pool (celery worker --pool threads),
+# hand their completion to the loop and wait on the result.
+#
+# The loop shares one keep-alive httpx.AsyncClient for all completions, limits each model to
+# AICHAT_MAX_CONCURRENCY_PER_MODEL completions at once, and retries 429 and 5xx responses and
+# connection errors up to AICHAT_MAX_RETRIES times with full-jitter exponential backoff.
+# A completion that has already streamed tokens is not retried, its tokens were relayed.
+#
+# Benchmark against a local stub of OpenAI with: python -m tests.bench_aichat_pool
+#
+import asyncio
+import json
+import random
+import threading
+from typing import Awaitable, Callable, Dict, Optional
+from functools import lru_cache
+
+import httpx
+
+from app.config import get_settings, log
+
+
+# ----------------------------------------------------------------------------------------------
+class CompletionError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(f"OpenAI responded {status}: {detail}")
+        self.status = status
+
+# ----------------------------------------------------------------------------------------------
+class CompletionPool:
+    def __init__(self,
+                 apiBase: str,
+                 apiKey: str,
+                 maxConcurrencyPerModel: int,
+                 maxRetries: int,
+                 backoffSeconds: float = 0.5,     # first retry waits up to this, doubling per retry
+                 maxBackoffSeconds: float = 20.0,
+                 timeoutSeconds: float = 120.0,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):  # tests pass a stub
+        self.apiBase = apiBase
+        self.apiKey = apiKey
+        self.maxConcurrencyPerModel = max(1, maxConcurrencyPerModel)
+        self.maxRetries = maxRetries
+        self.backoffSeconds = backoffSeconds
+        self.maxBackoffSeconds = maxBackoffSeconds
+        self.timeoutSeconds = timeoutSeconds
+        self.transport = transport
+        #
+        self.loop = None
+        self.thread = None
+        self.client = None                          # created on the loop
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.startLock = threading.Lock()
+        #
+        # counters:
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    # ------------------------------------------------------------------------------------------
+    # begin the event loop thread, done on first use:
+    def start(self):
+        with self.startLock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread( target=self.loop.run_forever, name="aichat-pool", daemon=True )
+            self.thread.start()
+
+    # ------------------------------------------------------------------------------------------
+    # run a coroutine on the pool's loop from any other thread, waiting for its result:
+    def run(self, coro: Awaitable):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    # ------------------------------------------------------------------------------------------
+    def stop(self):
+        if self.loop is None:
+            return
+        if self.client is not None:
+            self.run( self.client.aclose() )
+            self.client = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        log.info( f"CompletionPool: completed {self.completed}, retried {self.retried}, failed {self.failed}" )
+
+    # ------------------------------------------------------------------------------------------
+    # the shared client, keeping connections to OpenAI alive between completions:
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            connections = self.maxConcurrencyPerModel * 4
+            self.client = httpx.AsyncClient( base_url = self.apiBase,
+                                             headers = { "Authorization": f"Bearer {self.apiKey}" },
+                                             timeout = self.timeoutSeconds,
+                                             limits = httpx.Limits( max_connections = connections,
+                                                                    max_keepalive_connections = connections ),
+                                             transport = self.transport )
+        return self.client
+
+    # ------------------------------------------------------------------------------------------
+    def get_semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self.semaphores:
+            self.semaphores[model] = asyncio.Semaphore(self.maxConcurrencyPerModel)
+        return self.semaphores[model]
+
+    # ------------------------------------------------------------------------------------------
+    # one streamed completion. body holds either "messages" for a chat model or "prompt" for a
+    # completion model, plus any sampling parameters. onToken is awaited with each token:
+    async def complete(self, model: str, body: dict, onToken: Callable[[str], Awaitable] = None) -> str:
+        path = "/chat/completions" if "messages" in body else "/completions"
+        request = dict(body, model=model, stream=True)
+
+        async with self.get_semaphore(model):
+            attempt = 0
+            while True:
+                tokens = []
+                try:
+                    async with self.get_client().stream("POST", path, json=request) as response:
+                        if response.status_code != 200:
+                            detail = (await response.aread()).decode("utf-8", "replace")[:200]
+                            raise CompletionError(response.status_code, detail)
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[5:].strip()
+                            if data == "[DONE]":
+                                break
+                            choice = json.loads(data)["choices"][0]
+                            token = choice["delta"].get("content") if "delta" in choice else choice.get("text")
+                            if token:
+                                tokens.append(token)
+                                if onToken is not None:
+                                    await onToken(token)
+                    self.completed += 1
+                    return "".join(tokens)
+
+                except (CompletionError, httpx.TransportError) as e:
+                    retryable = not isinstance(e, CompletionError) or e.status == 429 or e.status >= 500
+                    if not retryable or tokens or attempt >= self.maxRetries:
+                        self.failed += 1
+                        raise
+                    # full jitter: a random wait up to the exponential backoff
+                    delay = random.uniform(0, min(self.maxBackoffSeconds, self.backoffSeconds * 2 ** attempt))
+                    attempt += 1
+                    self.retried += 1
+                    log.info(f"CompletionPool: {model} attempt {attempt} failed, {e}, retrying in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+
+
+# ----------------------------------------------------------------------------------------------
+@lru_cache()
+def get_completion_pool() -> CompletionPool:
+    settings = get_settings()
+    return CompletionPool( apiBase = settings.OPENAI_API_BASE,
+                           apiKey = settings.OPENAI_API_KEY,
+                           maxConcurrencyPerModel = settings.AICHAT_MAX_CONCURRENCY_PER_MODEL,
+                           maxRetries = settings.AICHAT_MAX_RETRIES )
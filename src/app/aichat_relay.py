@@ -0,0 +1,123 @@
+# ----------------------------------------------------------------------------------------------
+# AI chat replies are streamed to the browser as they are generated: the OpenAI_Comm Celery
+# task publishes each token it receives to the Redis channel "aichat:{aichatid}", and a final
+# message carrying the reply's status once the reply is written to the aichat row.
+#
+# Each app worker process holds one Redis pattern subscription to all aichat channels, and
+# fans the messages out to the local queues of the /aichat/{aichatid}/stream requests that are
+# waiting on that aichatid. The pattern subscription is opened with the first stream request
+# and kept until app shutdown.
+#
+import asyncio
+import json
+from typing import Dict, Optional, Set
+from functools import lru_cache
+
+import redis
+import redis.asyncio
+
+from app.config import get_settings, log
+
+AICHAT_CHANNEL_PREFIX = "aichat:"
+
+
+# ----------------------------------------------------------------------------------------------
+def aichat_channel(aichatid: int) -> str:
+    return f"{AICHAT_CHANNEL_PREFIX}{aichatid}"
+
+# ----------------------------------------------------------------------------------------------
+# used by the Celery worker, synchronous. message is one of {"token": str} or {"status": str}:
+@lru_cache()
+def get_sync_redis() -> redis.Redis:
+    return redis.Redis.from_url(get_settings().REDIS_URL)
+
+def publish_aichat_message(aichatid: int, message: dict):
+    try:
+        get_sync_redis().publish( aichat_channel(aichatid), json.dumps(message) )
+    except redis.RedisError as e:
+        # streaming is a nicety, the reply still reaches the aichat row:
+        log.info(f"publish_aichat_message: aichatid {aichatid}, {e}")
+
+# ----------------------------------------------------------------------------------------------
+# used by the worker's completion pool, on its event loop:
+@lru_cache()
+def get_async_redis() -> redis.asyncio.Redis:
+    return redis.asyncio.Redis.from_url(get_settings().REDIS_URL)
+
+async def publish_aichat_message_async(aichatid: int, message: dict):
+    try:
+        await get_async_redis().publish( aichat_channel(aichatid), json.dumps(message) )
+    except redis.RedisError as e:
+        log.info(f"publish_aichat_message_async: aichatid {aichatid}, {e}")
+
+
+# ----------------------------------------------------------------------------------------------
+class AiChatRelay:
+    def __init__(self, redisUrl: str):
+        self.redisUrl = redisUrl
+        self.subscribers: Dict[int, Set[asyncio.Queue]] = {}   # aichatid -> waiting queues
+        # made with each listen task, on its loop, as python 3.9 binds them to the loop they are made on:
+        self.subscribed: Optional[asyncio.Event] = None
+        self.task = None
+
+    # ------------------------------------------------------------------------------------------
+    # returns a queue receiving the aichatid's messages, once the Redis subscription is live:
+    async def subscribe(self, aichatid: int) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(aichatid, set()).add(queue)
+        if self.task is None or self.task.done() or self.task.get_loop() is not asyncio.get_running_loop():
+            self.subscribed = asyncio.Event()
+            self.task = asyncio.create_task( self.listen() )
+        await self.subscribed.wait()
+        return queue
+
+    # ------------------------------------------------------------------------------------------
+    def unsubscribe(self, aichatid: int, queue: asyncio.Queue):
+        queues = self.subscribers.get(aichatid)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[aichatid]
+
+    # ------------------------------------------------------------------------------------------
+    # called from the app shutdown event:
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # ------------------------------------------------------------------------------------------
+    # the one Redis subscription of this process, reconnecting after errors:
+    async def listen(self):
+        while True:
+            client = redis.asyncio.Redis.from_url(self.redisUrl, decode_responses=True)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(AICHAT_CHANNEL_PREFIX + "*")
+                self.subscribed.set()
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None:
+                        continue
+                    aichatid = int(message["channel"][len(AICHAT_CHANNEL_PREFIX):])
+                    for queue in self.subscribers.get(aichatid, ()):
+                        queue.put_nowait(message["data"])
+            except Exception as e:
+                log.info(f"AiChatRelay: subscription lost, {e}")
+                # let waiting subscribers proceed, streams fall back to reading the aichat row:
+                self.subscribed.set()
+                await asyncio.sleep(1.0)
+            finally:
+                await pubsub.close()
+                await client.close()
+
+
+# ----------------------------------------------------------------------------------------------
+@lru_cache()
+def get_aichat_relay() -> AiChatRelay:
+    return AiChatRelay( get_settings().REDIS_URL )
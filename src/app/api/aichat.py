@@ -1,28 +1,30 @@
 # -------------------------------------------------------------------------------------------------
 # This file contains the JSON endpoints for AI Chat posts, handling the CRUD operations with the db 
 #
-from fastapi import APIRouter, HTTPException, Path, Depends, status
+from fastapi import APIRouter, HTTPException, Path, Depends, Request, status
+from fastapi.responses import StreamingResponse
 
 from app.api import crud
 from typing import List
 from app.api.users import get_current_active_user, user_has_role
 from app.api.user_action import UserAction, UserActionLevel
-from app.api.models import UserInDB, ChatbotDB, AiChatDB, AiChatTask, AiChatCreate, AiChatCreateResponse
-from app.api.models import ProjectDB, TagDB, basicTextPayload
+from app.api.models import UserInDB, ChatbotDB, AiChatDB, AiChatTask, AiChatCreate, AiChatCreateResponse, AiChatMessageDB
+from app.api.models import ProjectDB, TagDB, basicTextPayload, AiChatListing
 
 from app.config import log, get_settings
+from app.aichat_relay import get_aichat_relay
+from app.aichat_cache import aichat_cache_key, aichat_conversation, get_cached_reply, get_cache_stats
+from app.aichat_context import AICHAT_MODELS
 import json
 
 import asyncio
 import openai
-
-from app.worker import celery_app
+import uuid
 
 # ---------------------------------------------------------------------------------------
 
 # Celery specific:
-from app.worker import OpenAI_Comm
-from celery.result import AsyncResult
+from app.worker import OpenAI_Comm, aichat_reply_html
 
 # ---------------------------------------------------------------------------------------
 
@@ -30,6 +32,47 @@ router = APIRouter()
 
 openai.api_key = get_settings().OPENAI_API_KEY
 
+# ----------------------------------------------------------------------------------------------
+# answers the aichat's latest question, the last turn of its conversation. From the reply cache 
+# when the same conversation was answered before, otherwise marks the aichat 'inuse' with its 
+# taskid, then sends a message to Celery that runs a Task to do the OpenAI communication. The 
+# Task writes the reply and 'ready' status back to the aichat row itself, so the row is marked 
+# first or a fast Task's result could be overwritten:
+async def launch_aichat_task( aichat: AiChatDB, question: str ) -> int:
+    
+    # the endpoints check this before writing anything, a Task for another model could only fail:
+    if aichat.model not in AICHAT_MODELS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail=f"Unknown or unsupported model '{aichat.model}'")
+    
+    turns = [ (m.role, m.content) for m in await crud.get_aichat_messages(aichat.aichatid) ]
+    cachedReply = await get_cached_reply( aichat_cache_key(aichat.model, aichat.prePrompt, aichat_conversation(turns)) )
+    if cachedReply is not None:
+        await crud.post_aichat_message( aichat.aichatid, 'assistant', cachedReply )
+        aichat.reply = aichat_reply_html( cachedReply )
+        aichat.status = 'ready'
+        aichat.taskid = 'cached'
+        return await crud.put_aichat( aichat )
+    
+    aichat.status = 'inuse'
+    aichat.taskid = str(uuid.uuid4())
+    #
+    retVal = await crud.put_aichat( aichat )
+    #
+    aichat_task = AiChatTask( prePrompt = aichat.prePrompt, 
+                              prompt = question, 
+                              reply = aichat.reply, 
+                              model = aichat.model,
+                              status = aichat.status,
+                              taskid = aichat.taskid,
+                              aichatid = aichat.aichatid )
+    #
+    OpenAI_Comm.apply_async( (aichat_task,), task_id=aichat.taskid )
+    #
+    log.info(f"launch_aichat_task: aichatid {aichat.aichatid} launched as task {aichat.taskid}")
+    
+    return retVal
+
 # ----------------------------------------------------------------------------------------------
 # declare a POST endpoint on the root 
 @router.post("/", response_model=AiChatCreateResponse, status_code=201)
@@ -69,6 +112,14 @@ async def create_aiChatExchange(payload: AiChatCreate,
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                             detail="Not Authorized to create AI Chats for project.")
     
+    if chatbot.model not in AICHAT_MODELS:
+        await crud.rememberUserAction( current_user.userid, 
+                                       UserActionLevel.index('WARNING'),
+                                       UserAction.index('FAILED_POST_NEW_AICHAT'), 
+                                       f"chatbot {chatbot.chatbotid}, unknown or unsupported model '{chatbot.model}'" )
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail=f"Unknown or unsupported model '{chatbot.model}'")
+    
         
     # first create a db entry for this new aichat 
     aichatid = await crud.post_aiChat(payload.prompt, chatbot, current_user)
@@ -82,34 +133,30 @@ async def create_aiChatExchange(payload: AiChatCreate,
     #
     aichat: AiChatDB = await crud.get_aiChat( aichatid )
     #
-    # sends a message to Celery that runs a Task to do this communication:
-    aichat_task = AiChatTask( prePrompt = aichat.prePrompt, 
-                              prompt = aichat.prompt, 
-                              reply = aichat.reply, 
-                              model = aichat.model,
-                              status = aichat.status,
-                              taskid = aichat.taskid,
-                              aichatid = aichat.aichatid )
-    #
-    log.info(f"create_aiChatExchange: created aichat_task, launching task...")
-    #
-    task = OpenAI_Comm.delay( aichat_task ) 
-    #
-    log.info(f"create_aiChatExchange: ...back from task launch, taskid is: {task.id}")
-    #
-    # update in db with 'inuse' status, which signals the get endpoints to check for the task finishing:
-    aichat.status = 'inuse'
-    aichat.taskid = task.id
-    #
-    retVal = await crud.put_aichat( aichat )
+    # 'inuse' status tells readers the reply is on its way:
+    retVal = await launch_aichat_task( aichat, payload.prompt )
     
     await crud.rememberUserAction( aichat.userid, 
                                    UserActionLevel.index('NORMAL'),
                                    UserAction.index('UPDATE_AICHAT'), 
-                                   f"aiChat {retVal} waiting on Celery as task {task.id}" )
+                                   f"aiChat {retVal}, task {aichat.taskid}" )
     
     return { "aichatid": aichatid }
 
+# ----------------------------------------------------------------------------------------------
+# reply cache hit rate and size, admin only:
+@router.get("/cache/stats")
+async def read_aichat_cache_stats(current_user: UserInDB = Depends(get_current_active_user)):
+    
+    if not user_has_role( current_user, 'admin' ):
+        await crud.rememberUserAction( current_user.userid, 
+                                       UserActionLevel.index('WARNING'),
+                                       UserAction.index('NONADMIN_REQUESTED_AICHAT_CACHE_STATS'), 
+                                       "Not Authorized" )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
+    
+    return await get_cache_stats()
+
 # ----------------------------------------------------------------------------------------------
 # Note: id's type is validated as greater than 0  
 @router.get("/{id}", response_model=AiChatDB)
@@ -154,12 +201,71 @@ async def read_aichatExchange(id: int = Path(..., gt=0),
     
     return aichat
 
+# ----------------------------------------------------------------------------------------------
+# The response_model is a List with a AiChatMessageDB subtype, the turns of the conversation in order
+@router.get("/{id}/messages", response_model=List[AiChatMessageDB])
+async def read_aichatMessages(id: int = Path(..., gt=0),
+                              current_user: UserInDB = Depends(get_current_active_user)) -> List[AiChatMessageDB]:
+    
+    # checks the aichat exists & is accessible:
+    await read_aichatExchange(id, current_user)
+    
+    return await crud.get_aichat_messages(id)
+
+# ----------------------------------------------------------------------------------------------
+# Server-Sent Events stream of an aichat's reply: a "token" event for each token as the Celery 
+# task receives it, then one "done" event with the final status. An aichat not 'inuse' gets 
+# its "done" event at once. Without messages for AICHAT_STREAM_KEEPALIVE seconds, a keepalive 
+# comment is sent and the row re-read, in case the task's final message was missed.
+AICHAT_STREAM_KEEPALIVE = 15.0
+
+@router.get("/{id}/stream")
+async def stream_aichatExchange(request: Request,
+                                id: int = Path(..., gt=0),
+                                current_user: UserInDB = Depends(get_current_active_user)):
+    
+    relay = get_aichat_relay()
+    queue = await relay.subscribe(id)
+    try:
+        # read after subscribing, so a reply finishing in between is not missed:
+        aichat: AiChatDB = await read_aichatExchange(id, current_user)
+    except Exception:
+        relay.unsubscribe(id, queue)
+        raise
+    
+    def sse( event: str, data: dict ) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    
+    async def events():
+        try:
+            aichatStatus = aichat.status
+            while aichatStatus == 'inuse':
+                try:
+                    message = json.loads( await asyncio.wait_for(queue.get(), timeout=AICHAT_STREAM_KEEPALIVE) )
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    aichatStatus = (await crud.get_aiChat(id)).status
+                    continue
+                if 'token' in message:
+                    yield sse( "token", message )
+                else:
+                    aichatStatus = message['status']
+            yield sse( "done", {"status": aichatStatus} )
+        finally:
+            relay.unsubscribe(id, queue)
+    
+    return StreamingResponse( events(), 
+                              media_type="text/event-stream",
+                              headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" } )
+
 # ----------------------------------------------------------------------------------------------
 # The response_model is a List with a AiChatDB subtype. See import of List top of file. 
 # Returns a list of the projects the user has access.
-@router.get("/project/{projectid}", response_model=List[AiChatDB])
+@router.get("/project/{projectid}", response_model=List[AiChatListing])
 async def read_all_project_aichats(projectid: int = Path(..., gt=0),
-                                   current_user: UserInDB = Depends(get_current_active_user)) -> List[AiChatDB]:
+                                   current_user: UserInDB = Depends(get_current_active_user)) -> List[AiChatListing]:
     
     proj, tag = await crud.get_project_and_tag(projectid)
     if proj is None:
@@ -245,35 +351,25 @@ async def update_aiChatExchange(payload: basicTextPayload,       # a new questio
                                        f"AIChat {id} still processing last request" )
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="AIChat still processing last request")
     
-    # new prompt is the prior conversation with our new question appended:
-    aichat.prompt = aichat.prompt + "<br><br>" + aichat.reply + "<br><br>" + payload.text
+    if aichat.model not in AICHAT_MODELS:
+        await crud.rememberUserAction( current_user.userid, 
+                                       UserActionLevel.index('WARNING'),
+                                       UserAction.index('FAILED_UPDATE_AICHAT'), 
+                                       f"AIChat {aichatid}, unknown or unsupported model '{aichat.model}'" )
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail=f"Unknown or unsupported model '{aichat.model}'")
+    
+    # the new question is appended to the conversation, the aichat's prompt stays its first question:
+    await crud.post_aichat_message( aichat.aichatid, 'user', payload.text )
     aichat.reply = ''
     
     #
-    # sends a message to Celery that runs a Task to do this OpenAI communication:
-    aichat_task = AiChatTask( prePrompt = aichat.prePrompt, 
-                              prompt = aichat.prompt, 
-                              reply = aichat.reply, 
-                              model = aichat.model,
-                              status = aichat.status,
-                              taskid = aichat.taskid,
-                              aichatid = aichat.aichatid )
-    #
-    log.info(f"update_aiChatExchange: created aichat_task, launching update task...")
-    #
-    task = OpenAI_Comm.delay( aichat_task ) 
-    #
-    log.info(f"update_aiChatExchange: ...back from update task launch, taskid is: {task.id}" )
-    #
-    aichat.status = 'inuse'
-    aichat.taskid = task.id
-    #
-    # remember this status and taskid
-    retVal = await crud.put_aichat( aichat )
+    # remember the 'inuse' status and launch the OpenAI communication:
+    retVal = await launch_aichat_task( aichat, payload.text )
     
     await crud.rememberUserAction( aichat.userid, 
                                    UserActionLevel.index('NORMAL'),
                                    UserAction.index('UPDATE_AICHAT'), 
-                                   f"aiChat {retVal} waiting on Celery as task {task.id}" )
+                                   f"aiChat {retVal}, task {aichat.taskid}" )
     
     return retVal
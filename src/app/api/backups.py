@@ -1,5 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 
 import glob
 from typing import List
@@ -8,6 +7,7 @@ from pathlib import Path
 from app import config
 from app.api import crud
 from app.api.users import get_current_active_user, user_has_role
+from app.api.fileserve import file_response
 from app.api.user_action import UserAction, UserActionLevel
 from app.api.models import UserInDB
 
@@ -47,7 +47,7 @@ async def read_all_backups(current_user: UserInDB = Depends(get_current_active_u
 # ----------------------------------------------------------------------------------------------
 # get the requested file (remember this endpoint is exposed with the prefix "/backups" )
 @router.get("/{expected_filename}", status_code=200)  
-async def read_backup(expected_filename: str, current_user: UserInDB = Depends(get_current_active_user)):
+async def read_backup(request: Request, expected_filename: str, current_user: UserInDB = Depends(get_current_active_user)):
     
     if not user_has_role(current_user,"admin"):
         await crud.rememberUserAction( current_user.userid, 
@@ -68,4 +68,4 @@ async def read_backup(expected_filename: str, current_user: UserInDB = Depends(g
                                    UserActionLevel.index('NORMAL'),
                                    UserAction.index('ADMIN_GET_BACKUP'), expected_filename )
     
-    return FileResponse(backup_path)
+    return file_response( request, backup_path )
@@ -11,6 +11,7 @@ from app.api.models import UserInDB, ChatbotDB, ChatbotCreate, ChatbotResponse
 from app.api.models import ProjectDB, TagDB, ChatbotUpdate
 
 from app.config import log, get_settings
+from app.aichat_context import AICHAT_MODELS
 
 # ---------------------------------------------------------------------------------------
 
@@ -57,11 +58,7 @@ async def create_aiChatRole(payload: ChatbotCreate,
                             detail="Not Authorized to create chatbots for project.")
         
     
-    if payload.model=="text-davinci-003":
-        pass 
-    elif payload.model=="gpt-3.5-turbo" or payload.model=="gpt-4" :
-        pass
-    else:
+    if payload.model not in AICHAT_MODELS:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('WARNING'),
                                        UserAction.index('FAILED_POST_NEW_AICHATROLE'), 
@@ -216,6 +213,13 @@ async def update_aiChatRole(payload: ChatbotUpdate,       # potentially updated
                                        "Not Authorized" )
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized to access project.")
         
+    if payload.model not in AICHAT_MODELS:
+        await crud.rememberUserAction( current_user.userid, 
+                                       UserActionLevel.index('WARNING'),
+                                       UserAction.index('FAILED_UPDATE_AICHATROLE'), 
+                                       f"Unknown or unsupported model '{payload.model}'" )
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail=f"Unknown or unsupported model '{payload.model}'")
     
     log.info(f"update_aiChatRole: here2!")
     
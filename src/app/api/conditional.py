@@ -0,0 +1,89 @@
+# ---------------------------------------------------------------------------------------------
+# Conditional requests (RFC 7232): validators for responses, and the checks answering a
+# client's If-None-Match / If-Modified-Since with 304 Not Modified, and deciding whether an
+# If-Range request gets its range or the whole file.
+#
+# Validators come from what the db already knows changes with the content: a project file's
+# version and checksum, a memo's or project's updated_date. Endpoints check them after their
+# access checks, so a 304 reveals nothing a 200 would not, and before the file is read or the
+# body rendered. Dates are naive UTC, as the app runs in UTC.
+#
+import hashlib
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response, status
+
+
+# ----------------------------------------------------------------------------------------------
+# a strong entity tag from the values that identify one version of a response's content:
+def strong_etag(*parts) -> str:
+    content = "\x1f".join( str(p) for p in parts )
+    return '"' + hashlib.sha256(content.encode("utf-8")).hexdigest()[:32] + '"'
+
+# ----------------------------------------------------------------------------------------------
+def http_date(moment) -> str:
+    if isinstance(moment, datetime):
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        moment = moment.timestamp()
+    return formatdate(moment, usegmt=True)
+
+def parse_http_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+# ----------------------------------------------------------------------------------------------
+# access is per user and can be revoked, so shared caches keep nothing and browsers revalidate:
+def validator_headers(etag: str, lastModified: str) -> dict:
+    return { "etag": etag, "last-modified": lastModified, "cache-control": "private, no-cache" }
+
+# ----------------------------------------------------------------------------------------------
+# True when the client's copy is current. If-None-Match is compared weakly, W/ ignored, and when
+# present If-Modified-Since is not consulted. lastModified is an http_date():
+def is_not_modified(request: Request, etag: str, lastModified: str) -> bool:
+    if request.method not in ("GET", "HEAD"):
+        return False
+    ifNoneMatch = request.headers.get("if-none-match")
+    if ifNoneMatch is not None:
+        if ifNoneMatch.strip() == "*":
+            return True
+        tags = [ t.strip().removeprefix("W/") for t in ifNoneMatch.split(",") ]
+        return etag.removeprefix("W/") in tags
+    since = parse_http_date(request.headers.get("if-modified-since"))
+    modified = parse_http_date(lastModified)
+    return since is not None and modified is not None and modified <= since
+
+def not_modified_response(etag: str, lastModified: str, headers: dict = None) -> Response:
+    return Response( status_code=status.HTTP_304_NOT_MODIFIED,
+                     headers={ **(headers or {}), **validator_headers(etag, lastModified) } )
+
+# ----------------------------------------------------------------------------------------------
+# for JSON endpoints of a db row: the 304 to return when the client's copy is current, else
+# None after setting the validators on the endpoint's response:
+def conditional_response(request: Request, response: Response, etag: str, updated: datetime) -> Optional[Response]:
+    lastModified = http_date(updated)
+    if is_not_modified(request, etag, lastModified):
+        return not_modified_response(etag, lastModified)
+    response.headers.update(validator_headers(etag, lastModified))
+    return None
+
+# ----------------------------------------------------------------------------------------------
+# True when a Range request should get its range: without If-Range, or when If-Range names the
+# current strong etag or exactly the current Last-Modified. Otherwise the whole file is sent:
+def if_range_matches(request: Request, etag: str, lastModified: str) -> bool:
+    ifRange = request.headers.get("if-range")
+    if ifRange is None:
+        return True
+    ifRange = ifRange.strip()
+    if ifRange.startswith('"') or ifRange.startswith("W/"):
+        return ifRange == etag and not etag.startswith("W/")
+    return ifRange == lastModified
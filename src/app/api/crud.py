@@ -1,26 +1,38 @@
 from typing import List, Tuple
+from datetime import date
 
-from sqlalchemy import asc 
+from sqlalchemy import asc, desc, and_, or_, func, false, select
+from sqlalchemy import union_all, literal_column, cast, null, Integer, Float
 
 from app.api.models import NoteSchema, MemoSchema, UserReg, UserInDB, UserPublic
 from app.api.models import MemoDB, NoteDB, CommentSchema, CommentDB, TagDB, basicTextPayload
 from app.api.models import ProjectSchema, ProjectDB, UserActionCreate, UserActionDB, ProjectFileCreate
 from app.api.models import ChatbotCreate, ChatbotDB, AiChatCreate, AiChatDB, ProjectInviteCreate
-from app.api.models import ProjectInviteDB, ProjectFileDB, ProjectInviteUpdate
+from app.api.models import ProjectInviteDB, ProjectFileDB, ProjectInviteUpdate, ProjectTaggedDB, AiChatMessageDB
+from app.api.models import MemoListing, AiChatListing, SearchResult
 
-from app.db import DatabaseMgr, get_database_mgr
+from app.db import DatabaseMgr, get_database_mgr, aichat_message_insert, memo_excerpt, SEARCH_CONFIG
 
-from app.api.users import user_has_role
+from app.api.users import Principal, get_principal, AccessContext
 
 from app.config import log
 
-from app.worker import celery_app
-from celery.exceptions import TimeoutError
+from app.action_log import get_action_log_writer
+from app.export_public import get_public_exporter
+from app.cache_events import broadcast
 
 # ---------------------------------------------------------------------------------------
+# every public page lists the public memos, so changes to memos that are or were public access,
+# and to site_config, clear the rendered page cache of every worker and schedule a static export
+# of the public site:
+async def public_pages_changed():
+    await broadcast("pages")
+    get_public_exporter().schedule()
+
+# ---------------------------------------------------------------------------------------
+# user actions are queued and written in batches off the request path, see app/action_log.py:
 async def rememberUserAction( userid: int, actionLevel: int, action: int, desc: str ):
-    payload = UserActionCreate(actionLevel=actionLevel, actionCode=action, description=desc)
-    await post_user_action( payload, userid )
+    await get_action_log_writer().remember( userid, actionLevel, action, desc )
     
 # -----------------------------------------------------------------------------------------
 # for creating new user actions
@@ -44,12 +56,35 @@ async def get_user_action(actionid: int) -> UserActionDB:
     return await db_mgr.get_db().fetch_one(query=query)
 
 # -----------------------------------------------------------------------------------------
-# returns all user actions:
-async def get_all_user_actions() -> List[UserActionDB]:
+# returns a select of user actions with their username, keyset ordered by actionid from after:
+def user_actions_query(after: int = 0):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    action_tb = db_mgr.get_action_table()
+    users_tb = db_mgr.get_users_table()
+    
+    joined = action_tb.outerjoin( users_tb, action_tb.c.userid == users_tb.c.userid )
+    
+    return select( action_tb, func.coalesce(users_tb.c.username, '').label('username') )\
+                .select_from(joined)\
+                .where(action_tb.c.actionid > after)\
+                .order_by(asc(action_tb.c.actionid))
+
+# -----------------------------------------------------------------------------------------
+# returns one page of user actions following the actionid after, the next page follows
+# the last actionid returned:
+async def get_all_user_actions(after: int = 0, limit: int = 100) -> List[UserActionDB]:
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_action_table().select().order_by(asc(db_mgr.get_action_table().c.actionid))
+    query = user_actions_query(after).limit(limit)
     return await db_mgr.get_db().fetch_all(query=query)   
 
+# -----------------------------------------------------------------------------------------
+# yields every user action following the actionid after, read through a server-side cursor
+# so exporting the whole log holds only one row at a time:
+async def iterate_user_actions(after: int = 0):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    async for a in db_mgr.get_db().iterate(query=user_actions_query(after)):
+        yield a
+
 # -----------------------------------------------------------------------------------------
 # returns all user actions attributed to a user
 async def get_all_this_users_actions(user: UserInDB, limit: int = 25, offset: int = 0) -> List[UserActionDB]:
@@ -57,29 +92,37 @@ async def get_all_this_users_actions(user: UserInDB, limit: int = 25, offset: in
     # log.info(f"get_all_this_users_actions: limit is {limit}, offset is {offset}")
     
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_action_table().select().where(user.userid == db_mgr.get_action_table().c.userid).limit(limit).offset(offset)
+    query = db_mgr.get_action_table().select().where(user.userid == db_mgr.get_action_table().c.userid)\
+                .order_by(asc(db_mgr.get_action_table().c.actionid)).limit(limit).offset(offset)
     actionList = await db_mgr.get_db().fetch_all(query=query)   
             
     return actionList
 
 # -----------------------------------------------------------------------------------------
-# returns the number of the user actions attributed to a user
+# returns the number of the user actions attributed to a user, from the daily rollups:
 async def get_this_users_action_count(user: UserInDB):
     
     # log.info(f"get_this_users_action_count: user is {user.userid}, {user.username}")
     
     db_mgr: DatabaseMgr = get_database_mgr()
-    
-    # query = db_mgr.get_action_table().select().filter_by().count()
-    query = "SELECT COUNT(*) FROM action WHERE userid=" + str(user.userid)
+    daily_tb = db_mgr.get_action_daily_table()
+    query = select( func.coalesce(func.sum(daily_tb.c.count), 0).label('count') )\
+                .where(user.userid == daily_tb.c.userid)
     
     result = await db_mgr.get_db().fetch_one(query=query)
     
-    # log.info(f"get_this_users_action_count: result is {result['count']}:")
-    # log.info({**result})
-    
     return result['count']
 
+# -----------------------------------------------------------------------------------------
+# returns a user's daily activity since a date, per actionCode and actionLevel, newest first:
+async def get_this_users_action_summary(user: UserInDB, since: date):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    daily_tb = db_mgr.get_action_daily_table()
+    query = daily_tb.select().where(user.userid == daily_tb.c.userid)\
+                             .where(daily_tb.c.day >= since)\
+                             .order_by(desc(daily_tb.c.day), asc(daily_tb.c.actionCode))
+    return await db_mgr.get_db().fetch_all(query=query)
+
 
 
 # -----------------------------------------------------------------------------------------
@@ -90,14 +133,21 @@ async def post_tag(payload: basicTextPayload):
     # Creates a SQLAlchemy insert object expression query
     query = db_mgr.get_tag_table().insert().values(text=payload.text)
     # Executes the query and returns the generated ID
-    return await db_mgr.get_db().execute(query=query)
+    tagid = await db_mgr.get_db().execute(query=query)
+    await link_tag_to_memos( tagid, payload.text )
+    return tagid
 
 # -----------------------------------------------------------------------------------------
 # for getting tags:
-async def get_tag(id: int) -> TagDB:
+async def get_tag(id: int, access: AccessContext = None) -> TagDB:
+    if access and id in access.tags:
+        return access.tags[id]
     db_mgr: DatabaseMgr = get_database_mgr()
     query = db_mgr.get_tag_table().select().where(id == db_mgr.get_tag_table().c.tagid)
-    return await db_mgr.get_db().fetch_one(query=query)
+    tag = await db_mgr.get_db().fetch_one(query=query)
+    if access:
+        access.tags[id] = tag
+    return tag
 
 # -----------------------------------------------------------------------------------------
 # for getting tags:
@@ -114,22 +164,44 @@ async def get_all_tags() -> List[TagDB]:
     return await db_mgr.get_db().fetch_all(query=query)   
 
 # -----------------------------------------------------------------------------------------
-# update a tag:
+# update a tag. Tags are roles too, held by name in users' roles strings, so a renamed tag is
+# renamed in the roles strings of its holders in the same transaction; their user_role rows
+# keep the tagid:
 async def put_tag(tagid: int, payload: basicTextPayload):
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = (
-        db_mgr.get_tag_table()
-        .update()
-        .where(tagid == db_mgr.get_tag_table().c.tagid)
-        .values(text=payload.text)
-        .returning(db_mgr.get_tag_table().c.tagid)
-    )
-    return await db_mgr.get_db().execute(query=query)
+    db = db_mgr.get_db()
+    renamedHolders = []
+    async with db.transaction():
+        old = await db.fetch_one(query="SELECT text FROM tag WHERE tagid = :tagid FOR UPDATE", 
+                                 values={"tagid": tagid})
+        query = (
+            db_mgr.get_tag_table()
+            .update()
+            .where(tagid == db_mgr.get_tag_table().c.tagid)
+            .values(text=payload.text)
+            .returning(db_mgr.get_tag_table().c.tagid)
+        )
+        id = await db.execute(query=query)
+        if old and old['text'] != payload.text:
+            query = """
+                UPDATE users 
+                SET roles = array_to_string(array_replace(string_to_array(roles, ' '), :old, :new), ' ')
+                WHERE :old = ANY(string_to_array(roles, ' '))
+                RETURNING userid
+            """
+            renamedHolders = await db.fetch_all(query=query, values={"old": old['text'], "new": payload.text})
+    for r in renamedHolders:
+        await broadcast(f"user:{r['userid']}")
+    return id
 
 # -----------------------------------------------------------------------------------------
-# delete a tag. 
+# delete a tag, and any user_role rows granting it and memo_tag rows holding it. 
 async def delete_tag(id: int):
     db_mgr: DatabaseMgr = get_database_mgr()
+    query = db_mgr.get_user_role_table().delete().where(id == db_mgr.get_user_role_table().c.tagid)
+    await db_mgr.get_db().execute(query=query)
+    query = db_mgr.get_memo_tag_table().delete().where(id == db_mgr.get_memo_tag_table().c.tagid)
+    await db_mgr.get_db().execute(query=query)
     query = db_mgr.get_tag_table().delete().where(id == db_mgr.get_tag_table().c.tagid)
     return await db_mgr.get_db().execute(query=query)
 
@@ -139,16 +211,16 @@ async def delete_tag(id: int):
 # a utility for getting the permission to access a project
 def user_has_project_access( user: UserInDB, proj: ProjectDB, projTag: TagDB ) -> bool:
     # first unverified automatically get denied access:
-    weAreAllowed = not user_has_role(user, 'unverified')
+    weAreAllowed = not get_principal(user).is_unverified
     if weAreAllowed:
         # next admins automatically get access:
-        weAreAllowed = user_has_role(user, 'admin')
+        weAreAllowed = get_principal(user).is_admin
         if not weAreAllowed:
             # if we're the creator:
             if proj.userid == user.userid:
                 weAreAllowed = True
             # for everyone else must be project member and project is published:
-            elif user_has_role(user, projTag.text) and proj.status == 'published':
+            elif get_principal(user).has_role(projTag.text) and proj.status == 'published':
                 weAreAllowed = True
                 
     return weAreAllowed
@@ -157,31 +229,44 @@ def user_has_project_access( user: UserInDB, proj: ProjectDB, projTag: TagDB ) -
 # a utility for getting chatbotEditor permission on a project
 def user_has_project_chatbotEditor_access( user: UserInDB, proj: ProjectDB, cbeTag: TagDB ) -> bool:
     # first unverified automatically get denied access:
-    weAreAllowed = not user_has_role(user, 'unverified')
+    weAreAllowed = not get_principal(user).is_unverified
     if weAreAllowed:
         # next admins automatically get access:
-        weAreAllowed = user_has_role(user, 'admin')
+        weAreAllowed = get_principal(user).is_admin
         if not weAreAllowed:
             # if we're the creator:
             if proj.userid == user.userid:
                 weAreAllowed = True
             # for everyone else must be project member and project is published:
-            elif user_has_role(user, cbeTag.text) and proj.status == 'published':
+            elif get_principal(user).has_role(cbeTag.text) and proj.status == 'published':
                 weAreAllowed = True
                 
     return weAreAllowed
 
 # ----------------------------------------------------------------------------------------------
-# a utility for getting the permission to access a project
-async def user_has_project_access_by_id( user: UserInDB, projectid: int ) -> bool:
+# the user's Principal, the request's AccessContext's when it is theirs:
+def access_principal( user: UserInDB, access: AccessContext = None ) -> Principal:
+    if access and access.user is user:
+        return access.principal
+    return get_principal(user)
+
+# ----------------------------------------------------------------------------------------------
+# a utility for getting the permission to access a project. The AccessContext's project & tag
+# rows serve any user, its access decisions only the user it was made for:
+async def user_has_project_access_by_id( user: UserInDB, projectid: int, access: AccessContext = None ) -> bool:
+    decisions = access.projectAccess if access and access.user is user else None
+    # this request may have already asked:
+    if decisions is not None and projectid in decisions:
+        return decisions[projectid]
+    principal = access_principal(user, access)
     # first unverified automatically get denied access:
-    weAreAllowed = not user_has_role(user, 'unverified')
+    weAreAllowed = not principal.is_unverified
     if weAreAllowed:
         # next admins automatically get access:
-        weAreAllowed = user_has_role(user, 'admin')
+        weAreAllowed = principal.is_admin
         if not weAreAllowed:
             # for everyone else:
-            proj, tag = await get_project_and_tag(projectid)
+            proj, tag = await get_project_and_tag(projectid, access)
             # proj: ProjectDB = await get_project(projectid)
             if not proj:
                 weAreAllowed = False
@@ -191,6 +276,8 @@ async def user_has_project_access_by_id( user: UserInDB, projectid: int ) -> boo
                     weAreAllowed = False
                 else:
                     weAreAllowed = user_has_project_access(user, proj, tag)
+    if decisions is not None:
+        decisions[projectid] = weAreAllowed
     return weAreAllowed
 
 # -----------------------------------------------------------------------------------------
@@ -213,44 +300,95 @@ async def post_project(payload: ProjectSchema):
 
 # -----------------------------------------------------------------------------------------
 # for getting projects:
-async def get_project(id: int) -> ProjectDB:
+async def get_project(id: int, access: AccessContext = None) -> ProjectDB:
+    if access and id in access.projects:
+        return access.projects[id]
     db_mgr: DatabaseMgr = get_database_mgr()
     query = db_mgr.get_project_table().select().where(id == db_mgr.get_project_table().c.projectid)
-    return await db_mgr.get_db().fetch_one(query=query)
+    proj = await db_mgr.get_db().fetch_one(query=query)
+    if access:
+        access.projects[id] = proj
+    return proj
 
 # -----------------------------------------------------------------------------------------
-async def get_project_and_tag(projectid: int) -> Tuple:
-    
-    proj: ProjectDB = await get_project(projectid)
-    if not proj:
-        return (None, None)
+# returns a select of projects joined with their access tag and chatbot edit tag, with the 
+# tag texts labeled 'tag_text' and 'cbetag_text'. Missing tags come back as None:
+def project_tags_query():
+    db_mgr: DatabaseMgr = get_database_mgr()
+    proj_tb = db_mgr.get_project_table()
+    tag_tb = db_mgr.get_tag_table()
+    cbetag_tb = tag_tb.alias('cbetag')
     
-    # access permission for this project
-    tag: TagDB = await get_tag(proj.tagid)
-    if not tag:
-        return (proj, None)
+    joined = proj_tb.outerjoin( tag_tb, proj_tb.c.tagid == tag_tb.c.tagid )\
+                    .outerjoin( cbetag_tb, proj_tb.c.cbetagid == cbetag_tb.c.tagid )
     
-    return (proj, tag)
+    return select( proj_tb, 
+                   tag_tb.c.text.label('tag_text'), 
+                   cbetag_tb.c.text.label('cbetag_text') ).select_from(joined)
+
+# -----------------------------------------------------------------------------------------
+# converts a project_tags_query() row into a ProjectTaggedDB: 
+def tagged_project( p ) -> ProjectTaggedDB:
+    return ProjectTaggedDB( projectid = p.projectid,
+                            name = p.name,
+                            text = p.text,
+                            userid = p.userid,
+                            username = p.username,
+                            status = p.status,
+                            tagid = p.tagid,
+                            cbetagid = p.cbetagid,
+                            created_date = p.created_date,
+                            updated_date = p.updated_date,
+                            tag = p.tag_text,
+                            cbetag = p.cbetag_text )
 
 # -----------------------------------------------------------------------------------------
-async def get_project_both_tags(projectid: int) -> Tuple:
+# fetches a project with both its tags in one query, memoizing them in access when given:
+async def get_project_both_tags(projectid: int, access: AccessContext = None) -> Tuple:
+    
+    if access and projectid in access.projects:
+        proj = access.projects[projectid]
+        if not proj:
+            return (None, None, None)
+        if proj.tagid in access.tags and proj.cbetagid in access.tags:
+            return (proj, access.tags[proj.tagid], access.tags[proj.cbetagid])
+    
+    db_mgr: DatabaseMgr = get_database_mgr()
+    query = project_tags_query().where(projectid == db_mgr.get_project_table().c.projectid)
+    row = await db_mgr.get_db().fetch_one(query=query)
+    
+    proj, tag, cbetag = None, None, None
+    if row:
+        proj = tagged_project(row)
+        # access permission for this project
+        if row.tag_text is not None:
+            tag = TagDB( tagid = proj.tagid, text = row.tag_text )
+        # chatbot edit permission for this project
+        if row.cbetag_text is not None:
+            cbetag = TagDB( tagid = proj.cbetagid, text = row.cbetag_text )
+        
+    if access:
+        access.projects[projectid] = proj
+        if proj:
+            access.tags[proj.tagid] = tag
+            access.tags[proj.cbetagid] = cbetag
     
-    proj: ProjectDB = await get_project(projectid)
     if not proj:
         return (None, None, None)
-    
-    # access permission for this project
-    tag: TagDB = await get_tag(proj.tagid)
     if not tag:
         return (proj, None, None)
-    
-    # chatbot edit permission for this project
-    cbetag: TagDB = await get_tag(proj.cbetagid)
     if not cbetag:
         return (proj, tag, None)
     
     return (proj, tag, cbetag)
 
+# -----------------------------------------------------------------------------------------
+async def get_project_and_tag(projectid: int, access: AccessContext = None) -> Tuple:
+    
+    proj, tag, cbetag = await get_project_both_tags(projectid, access)
+    
+    return (proj, tag)
+
 # -----------------------------------------------------------------------------------------
 # for getting projects by their name:
 async def get_project_by_name(name: str) -> ProjectDB:
@@ -266,24 +404,18 @@ async def get_project_by_tagid(tagid: int) -> ProjectDB:
     return await db_mgr.get_db().fetch_one(query=query)
 
 # -----------------------------------------------------------------------------------------
-# returns all projects user has access
-async def get_all_projects(user: UserInDB) -> List[ProjectDB]:
+# returns all projects user has access, with their tags attached, filtered by a single query:
+async def get_all_projects(user: UserInDB) -> List[ProjectTaggedDB]:
     
     # log.info(f"get_all_projects: user is {user}")
     
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_project_table().select().order_by(asc(db_mgr.get_project_table().c.projectid))
+    proj_tb = db_mgr.get_project_table()
+    query = project_tags_query().where( project_access_clause(user, proj_tb, db_mgr.get_tag_table()) )\
+                                .order_by(asc(proj_tb.c.projectid))
     projectList = await db_mgr.get_db().fetch_all(query=query)   
-
-    # now filter them by the roles held by the user:
-    finalList = []
-    for proj in projectList:
-        tag: TagDB = await get_tag(proj.tagid)
-        if tag:
-            if user_has_project_access( user, proj, tag ):
-                finalList.append(proj)
             
-    return finalList
+    return [tagged_project(p) for p in projectList]
 
 # -----------------------------------------------------------------------------------------
 # update a project:
@@ -329,6 +461,9 @@ async def post_projectfile(payload: ProjectFileCreate, userid: int ):
     query = db_mgr.get_projectfile_table().insert().values(filename=payload.filename, 
                                                            projectid=payload.projectid,
                                                            modifiable=payload.modifiable,
+                                                           size=payload.size,
+                                                           mimetype=payload.mimetype,
+                                                           checksum=payload.checksum,
                                                            userid=userid,
                                                            version=1,
                                                            status="latest",
@@ -354,13 +489,17 @@ async def get_projectfile_by_filename(filename: str, projectid: int) -> ProjectF
     return await db_mgr.get_db().fetch_one(query=query)
 
 # -----------------------------------------------------------------------------------------
-# returns all projects user has access
-async def get_project_projectfiles(projectid: int) -> List[ProjectDB]:
+# returns all projectfiles of a project, with the size, mime type & checksum stored when each 
+# was written, in one query:
+async def get_project_projectfiles(projectid: int) -> List[ProjectFileDB]:
     
     log.info(f"get_project_projectfiles: projectid {projectid}")
     
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_projectfile_table().select().where(projectid == db_mgr.get_projectfile_table().c.projectid)
+    projectfile_tb = db_mgr.get_projectfile_table()
+    query = projectfile_tb.select()\
+                          .where(projectid == projectfile_tb.c.projectid)\
+                          .order_by(asc(projectfile_tb.c.filename))
     projectFileList = await db_mgr.get_db().fetch_all(query=query)   
             
     return projectFileList
@@ -376,7 +515,10 @@ async def put_projectfile(projFile: ProjectFileDB):
         .values(filename=projFile.filename, 
                 version=projFile.version, 
                 checked_userid=projFile.checked_userid,
-                checked_date=projFile.checked_date)
+                checked_date=projFile.checked_date,
+                size=projFile.size,
+                mimetype=projFile.mimetype,
+                checksum=projFile.checksum)
         .returning(db_mgr.get_projectfile_table().c.pfid)
     )
     return await db_mgr.get_db().execute(query=query)
@@ -392,12 +534,12 @@ async def delete_projectfile(id: int):
 
 # ----------------------------------------------------------------------------------------------
 # a utility for getting the permission to access a memo
-async def user_has_memo_access( user: UserInDB, memo: MemoDB ) -> bool:
+async def user_has_memo_access( user: UserInDB, memo: MemoDB, access: AccessContext = None ) -> bool:
     # first admins automatically get access:
-    weAreAllowed = user_has_role(user, 'admin') or memo.access == 'public'
+    weAreAllowed = access_principal(user, access).is_admin or memo.access == 'public'
     if not weAreAllowed:
         # for everyone else, first make sure user has the memo's project access:
-        weAreAllowed = await user_has_project_access_by_id(user, memo.projectid)
+        weAreAllowed = await user_has_project_access_by_id(user, memo.projectid, access)
         if weAreAllowed:
             # user has project access, is the memo published?
             if memo.status == 'published':
@@ -426,11 +568,16 @@ async def post_memo(payload: MemoSchema, user_id: int):
                                                     status=payload.status,
                                                     access=payload.access,
                                                     tags=payload.tags,
+                                                    excerpt=memo_excerpt(payload.text),
                                                     userid=payload.userid,
                                                     username=payload.username,
                                                     projectid=payload.projectid)
     # Executes the query and returns the generated ID
-    return await db_mgr.get_db().execute(query=query)
+    memoid = await db_mgr.get_db().execute(query=query)
+    await sync_memo_tags( memoid, payload.tags )
+    if payload.access == 'public':
+        await public_pages_changed()
+    return memoid
 
 # -----------------------------------------------------------------------------------------
 # for getting memos:
@@ -439,103 +586,352 @@ async def get_memo(id: int) -> MemoDB:
     query = db_mgr.get_memo_table().select().where(id == db_mgr.get_memo_table().c.memoid)
     return await db_mgr.get_db().fetch_one(query=query)
     
+# ----------------------------------------------------------------------------------------------
+# the SQL form of Principal.has_role(): true where the text in column is exactly one of the
+# user's project roles, an IN list the planner can match against tag_tb's text index
+def user_role_clause( user: UserInDB, column ):
+    return column.in_( sorted(get_principal(user).projects) )
+
+# ----------------------------------------------------------------------------------------------
+# the SQL form of user_has_project_access(), for a select joining project_tb with the project's 
+# access tag_tb. Lets project access be evaluated inside the query rather than per row in Python:
+def project_access_clause( user: UserInDB, proj_tb, tag_tb ):
+    # first unverified automatically get denied access:
+    if get_principal(user).is_unverified:
+        return false()
+    # the project and its tag must exist, as projects listed without their tag are skipped:
+    tagExists = tag_tb.c.tagid.isnot(None)
+    # next admins automatically get access:
+    if get_principal(user).is_admin:
+        return tagExists
+    # then user is creator or a member of a published project:
+    return and_( tagExists,
+                 or_( proj_tb.c.userid == user.userid,
+                      and_( user_role_clause(user, tag_tb.c.text), 
+                            proj_tb.c.status == 'published' ) ) )
+
+# ----------------------------------------------------------------------------------------------
+# the SQL form of user_has_memo_access(), for a select joining memo_tb to its project_tb and the 
+# project's access tag_tb. Returns None when the user has access to every memo:
+def memo_access_clause( user: UserInDB, memo_tb, proj_tb, tag_tb ):
+    # admins automatically get access:
+    if get_principal(user).is_admin:
+        return None
+    # public memos are open to all, everything else requires the memo's project access, 
+    # and then either a published staff memo or being the author of an unpublished memo:
+    return or_( memo_tb.c.access == 'public',
+                and_( project_access_clause(user, proj_tb, tag_tb),
+                      or_( and_( memo_tb.c.status == 'published', memo_tb.c.access == 'staff' ),
+                           and_( memo_tb.c.status != 'published', memo_tb.c.userid == user.userid ) ) ) )
+
 # -----------------------------------------------------------------------------------------
-# returns all memo posts:
-async def get_all_memos(user: UserInDB) -> List[MemoDB]:
+# the memo columns of a listing, everything but the text:
+def memo_listing_columns( memo_tb ):
+    return [ memo_tb.c.memoid, memo_tb.c.title, memo_tb.c.status, memo_tb.c.access, memo_tb.c.tags,
+             memo_tb.c.userid, memo_tb.c.username, memo_tb.c.projectid, memo_tb.c.excerpt,
+             memo_tb.c.created_date, memo_tb.c.updated_date ]
+
+# -----------------------------------------------------------------------------------------
+# returns a select of memo listings joined with their project and project tag, filtered in SQL
+# by the memo access held by user. An optional projectid restricts to that project's memos:
+def memo_access_query( user: UserInDB, projectid: int = None ):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    memo_tb = db_mgr.get_memo_table()
+    proj_tb = db_mgr.get_project_table()
+    tag_tb = db_mgr.get_tag_table()
+    
+    joined = memo_tb.outerjoin( proj_tb, memo_tb.c.projectid == proj_tb.c.projectid )\
+                    .outerjoin( tag_tb, proj_tb.c.tagid == tag_tb.c.tagid )
+    query = select( memo_listing_columns(memo_tb) ).select_from(joined)
+    
+    if projectid is not None:
+        query = query.where(memo_tb.c.projectid == projectid)
+        
+    accessClause = memo_access_clause( user, memo_tb, proj_tb, tag_tb )
+    if accessClause is not None:
+        query = query.where(accessClause)
+        
+    return query.order_by(asc(memo_tb.c.memoid))
+
+# -----------------------------------------------------------------------------------------
+def memo_listing( m ) -> MemoListing:
+    return MemoListing( memoid = m.memoid,
+                        title = m.title,
+                        status = m.status,
+                        access = m.access,
+                        tags = m.tags,
+                        userid = m.userid,
+                        username = m.username,
+                        projectid = m.projectid,
+                        excerpt = m.excerpt,
+                        created_date = m.created_date,
+                        updated_date = m.updated_date )
+
+# -----------------------------------------------------------------------------------------
+# database rows are read-only, so memo listings are converted to MemoListing before their 
+# titles are decorated with status, access and author for display:
+def decorated_memo( m ) -> MemoListing:
+    memo = memo_listing( m )
+    if memo.status == 'unpublished':
+        memo.title += ' (unpublished)'
+    elif memo.status == 'archived':
+        memo.title += ' (archived)'
+    if memo.access == 'admin':
+        memo.title += ' (admin)'
+    memo.title += ' - by ' + memo.username
+    return memo
+
+# -----------------------------------------------------------------------------------------
+# returns listings of all memo posts the user has access, filtered by a single query:
+async def get_all_memos(user: UserInDB) -> List[MemoListing]:
     
     # log.info(f"get_all_memos: working with user {user}")
     
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_memo_table().select().order_by(asc(db_mgr.get_memo_table().c.memoid))
-    
-    memoList = await db_mgr.get_db().fetch_all(query=query)
+    memoList = await db_mgr.get_db().fetch_all(query=memo_access_query(user))
     
-    # now filter them by the roles held by the user:
-    finalMemoList = []
-    for m in memoList:
-        # log.info(f"get_all_memos: working with memo.memoid {m.memoid}")
-        # log.info(f"get_all_memos: memo.access {m.access}")
-        user_access = await user_has_memo_access( user, m )
-        if user_access:
-            if m.status == 'unpublished':
-                m.title += ' (unpublished)'
-            elif m.status == 'archived':
-                m.title += ' (archived)'
-            if m.access == 'admin':
-                m.title += ' (admin)'
-            m.title += ' - by ' + m.username
-            finalMemoList.append(m)
-            
-    return finalMemoList
+    return [decorated_memo(m) for m in memoList]
 
 # -----------------------------------------------------------------------------------------
-# returns all public access memo posts:
-async def get_all_public_memos() -> List[MemoDB]:
+# returns listings of all published public access memo posts:
+async def get_all_public_memos() -> List[MemoListing]:
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_memo_table().select().order_by(asc(db_mgr.get_memo_table().c.memoid))
+    memo_tb = db_mgr.get_memo_table()
+    query = select( memo_listing_columns(memo_tb) )\
+            .where(and_(memo_tb.c.access == 'public', memo_tb.c.status == 'published'))\
+            .order_by(asc(memo_tb.c.memoid))
     
     memoList = await db_mgr.get_db().fetch_all(query=query)
-    
-    # now filter them for memos with 'public' in their access strings:
-    finalMemoList = []
-    for m in memoList:
-        if 'public' == m.access and 'published' == m.status:
-            finalMemoList.append(m)
             
-    return finalMemoList
+    return [memo_listing(m) for m in memoList]
 
 # -----------------------------------------------------------------------------------------
-# returns all project memo posts:
-async def get_all_project_memos(user: UserInDB, projectid: int) -> List[MemoDB]:
+# returns listings of all project memo posts the user has access, filtered by a single query:
+async def get_all_project_memos(user: UserInDB, projectid: int) -> List[MemoListing]:
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_memo_table().select().where(projectid == db_mgr.get_memo_table().c.projectid)\
-                                            .order_by(asc(db_mgr.get_memo_table().c.memoid))
-    
-    memoList = await db_mgr.get_db().fetch_all(query=query)
-            
-     # now filter them by the roles held by the user:
-    finalMemoList = []
-    for m in memoList:
-        user_access = await user_has_memo_access( user, m )
-        if user_access:
-            if m.status == 'unpublished':
-                m.title += ' (unpublished)'
-            elif m.status == 'archived':
-                m.title += ' (archived)'
-            if m.access == 'admin':
-                m.title += ' (admin)'
-            m.title += ' - by ' + m.username
-            finalMemoList.append(m)
+    memoList = await db_mgr.get_db().fetch_all(query=memo_access_query(user, projectid))
             
-    return finalMemoList
+    return [decorated_memo(m) for m in memoList]
 
 # -----------------------------------------------------------------------------------------
-# update a memo:
+# full text search of memos, comments and projects. Each kind is matched against its generated
+# search_vector column and filtered in SQL by the user's access: memos as memo_access_clause(),
+# comments as their memo, projects as project_access_clause(). The ranked page is selected
+# first, so headlines are only generated for the rows returned:
+SEARCH_KINDS = ('memo', 'comment', 'project')
+SEARCH_BARE_AMPERSAND = '&(?!#[0-9]+;|#[xX][0-9a-fA-F]+;|[A-Za-z][A-Za-z0-9]*;)'
+SEARCH_HEADLINE_OPTIONS = 'MaxFragments=2, MaxWords=24, MinWords=8, StartSel=<mark>, StopSel=</mark>'
+
+def search_query( user: UserInDB, terms: str, kinds = SEARCH_KINDS, limit: int = 20, offset: int = 0 ):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    memo_tb = db_mgr.get_memo_table()
+    comm_tb = db_mgr.get_comment_table()
+    proj_tb = db_mgr.get_project_table()
+    tag_tb = db_mgr.get_tag_table()
+    
+    searchConfig = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+    tsquery = func.websearch_to_tsquery(searchConfig, terms)
+    def matched( table: str ):
+        vector = literal_column(f'{table}.search_vector')
+        return vector.op('@@')(tsquery), func.ts_rank(vector, tsquery, type_=Float).label('rank')
+    
+    memoJoined = memo_tb.outerjoin( proj_tb, memo_tb.c.projectid == proj_tb.c.projectid )\
+                        .outerjoin( tag_tb, proj_tb.c.tagid == tag_tb.c.tagid )
+    memoAccess = memo_access_clause( user, memo_tb, proj_tb, tag_tb )
+    
+    ranked = []
+    if 'memo' in kinds:
+        match, rank = matched('memo')
+        query = select( literal_column("'memo'").label('kind'), memo_tb.c.memoid.label('id'), 
+                        memo_tb.c.memoid, memo_tb.c.projectid, memo_tb.c.title, 
+                        memo_tb.c.username, memo_tb.c.created_date, rank )\
+                .select_from(memoJoined).where(match)
+        ranked.append( query if memoAccess is None else query.where(memoAccess) )
+        
+    if 'comment' in kinds:
+        match, rank = matched('comment')
+        query = select( literal_column("'comment'").label('kind'), comm_tb.c.commid.label('id'), 
+                        memo_tb.c.memoid, memo_tb.c.projectid, memo_tb.c.title, 
+                        comm_tb.c.username, comm_tb.c.created_date, rank )\
+                .select_from(comm_tb.join( memoJoined, comm_tb.c.memoid == memo_tb.c.memoid )).where(match)
+        ranked.append( query if memoAccess is None else query.where(memoAccess) )
+        
+    if 'project' in kinds:
+        match, rank = matched('project')
+        query = select( literal_column("'project'").label('kind'), proj_tb.c.projectid.label('id'),
+                        cast(null(), Integer).label('memoid'), proj_tb.c.projectid, proj_tb.c.name.label('title'),
+                        proj_tb.c.username, proj_tb.c.created_date, rank )\
+                .select_from(proj_tb.outerjoin( tag_tb, proj_tb.c.tagid == tag_tb.c.tagid ))\
+                .where(and_( match, project_access_clause(user, proj_tb, tag_tb) ))
+        ranked.append( query )
+    
+    page = union_all( *ranked ).order_by( desc('rank'), 'kind', 'id' ).limit(limit).offset(offset).subquery('page')
+    
+    # the page's rows joined back to their text, html stripped and escaped before highlighting, so
+    # the headline is html. The text is html, so its character references are kept and only bare
+    # ampersands are escaped, first:
+    text = func.coalesce( memo_tb.c.text, comm_tb.c.text, proj_tb.c.text, '' )
+    text = func.regexp_replace( text, '<[^>]*>', ' ', 'g' )
+    text = func.regexp_replace( text, SEARCH_BARE_AMPERSAND, '&amp;', 'g' )
+    text = func.replace( func.replace( text, '<', '&lt;' ), '>', '&gt;' )
+    headline = func.ts_headline( searchConfig, text, tsquery, SEARCH_HEADLINE_OPTIONS ).label('headline')
+    
+    joined = page.outerjoin( memo_tb, and_(page.c.kind == 'memo', memo_tb.c.memoid == page.c.id) )\
+                 .outerjoin( comm_tb, and_(page.c.kind == 'comment', comm_tb.c.commid == page.c.id) )\
+                 .outerjoin( proj_tb, and_(page.c.kind == 'project', proj_tb.c.projectid == page.c.id) )
+    return select( page.c.kind, page.c.id, page.c.memoid, page.c.projectid, page.c.title, 
+                   page.c.username, page.c.created_date, page.c.rank, headline )\
+           .select_from(joined)\
+           .order_by( desc(page.c.rank), page.c.kind, page.c.id )
+
+# -----------------------------------------------------------------------------------------
+async def search(user: UserInDB, terms: str, kinds = SEARCH_KINDS, limit: int = 20, offset: int = 0) -> List[SearchResult]:
+    db_mgr: DatabaseMgr = get_database_mgr()
+    rows = await db_mgr.get_db().fetch_all(query=search_query(user, terms, kinds, limit, offset))
+    
+    return [ SearchResult( kind = r.kind,
+                           id = r.id,
+                           memoid = r.memoid,
+                           projectid = r.projectid,
+                           title = r.title or '',
+                           username = r.username or '',
+                           headline = r.headline,
+                           rank = r.rank,
+                           created_date = r.created_date ) for r in rows ]
+
+# -----------------------------------------------------------------------------------------
+# update a memo. The memo as it was is joined as 'old', for its access before the update:
 async def put_memo(memoid: int, userid: int, payload: MemoSchema):
     db_mgr: DatabaseMgr = get_database_mgr()
+    old = db_mgr.get_memo_table().alias('old')
     query = (
         db_mgr.get_memo_table()
         .update()
         .where(memoid == db_mgr.get_memo_table().c.memoid)
+        .where(old.c.memoid == db_mgr.get_memo_table().c.memoid)
         .values(title=payload.title, 
                 text=payload.text, 
                 status=payload.status, 
                 access=payload.access, 
                 tags=payload.tags,
+                excerpt=memo_excerpt(payload.text),
                 userid=payload.userid,
                 username=payload.username,
                 projectid=payload.projectid)
-        .returning(db_mgr.get_memo_table().c.memoid)
+        .returning(db_mgr.get_memo_table().c.memoid, old.c.access)
     )
-    return await db_mgr.get_db().execute(query=query)
+    updated = await db_mgr.get_db().fetch_one(query=query)
+    if updated is None:
+        return None
+    await sync_memo_tags( memoid, payload.tags )
+    if 'public' in (payload.access, updated['access']):
+        await public_pages_changed()
+    return updated['memoid']
+
+# -----------------------------------------------------------------------------------------
+# marks every memo of a project as archived in one statement, used when archiving projects:
+async def archive_project_memos(projectid: int):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    query = (
+        db_mgr.get_memo_table()
+        .update()
+        .where(projectid == db_mgr.get_memo_table().c.projectid)
+        .values(status='archived')
+        .returning(db_mgr.get_memo_table().c.memoid, db_mgr.get_memo_table().c.access)
+    )
+    archived = await db_mgr.get_db().fetch_all(query=query)
+    if any( m['access'] == 'public' for m in archived ):
+        await public_pages_changed()
+    return archived
 
 # -----------------------------------------------------------------------------------------
 # delete a memo. Note: this does not validate if the current user should be able to do this;
 # that logic is in the delete_memo() router.delete endpoint handler. 
 async def delete_memo(id: int):
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_memo_table().delete().where(id == db_mgr.get_memo_table().c.memoid)
-    return await db_mgr.get_db().execute(query=query)
+    query = db_mgr.get_memo_tag_table().delete().where(id == db_mgr.get_memo_tag_table().c.memoid)
+    await db_mgr.get_db().execute(query=query)
+    query = db_mgr.get_memo_table().delete().where(id == db_mgr.get_memo_table().c.memoid)\
+                  .returning(db_mgr.get_memo_table().c.memoid, db_mgr.get_memo_table().c.access)
+    deleted = await db_mgr.get_db().fetch_one(query=query)
+    if deleted is None:
+        return None
+    if deleted['access'] == 'public':
+        await public_pages_changed()
+    return deleted['memoid']
+
+# -----------------------------------------------------------------------------------------
+# brings a memo's memo_tag rows in step with its tags string in one statement, as 
+# sync_user_roles() does for users: tags that are tags get a row, rows no longer held are removed. 
+async def sync_memo_tags(memoid: int, tags: str):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    query = """
+        WITH wanted AS ( SELECT tagid FROM tag WHERE text = ANY(string_to_array(:tags, ' ')) ),
+             gone AS ( DELETE FROM memo_tag 
+                       WHERE memoid = :memoid AND tagid NOT IN (SELECT tagid FROM wanted) )
+        INSERT INTO memo_tag (memoid, tagid) SELECT :memoid, tagid FROM wanted 
+        ON CONFLICT DO NOTHING
+    """
+    return await db_mgr.get_db().execute(query=query, values={"memoid": memoid, "tags": tags or ''})
+
+# -----------------------------------------------------------------------------------------
+# a new tag is linked to the memos already carrying its text in their tags strings:
+async def link_tag_to_memos(tagid: int, text: str):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    query = """
+        INSERT INTO memo_tag (memoid, tagid)
+        SELECT memoid, :tagid FROM memo WHERE :text = ANY(string_to_array(tags, ' '))
+        ON CONFLICT DO NOTHING
+    """
+    return await db_mgr.get_db().execute(query=query, values={"tagid": tagid, "text": text})
+
+# -----------------------------------------------------------------------------------------
+# a one time migration filling memo_tag from the memo.tags strings; only runs if memo_tag
+# is empty, so is safe to call at every startup. Returns the number of rows created:
+async def backfill_memo_tags() -> int:
+    db_mgr: DatabaseMgr = get_database_mgr()
+    existing = await db_mgr.get_db().fetch_one(query="SELECT 1 FROM memo_tag LIMIT 1")
+    if existing:
+        return 0
+    query = """
+        INSERT INTO memo_tag (memoid, tagid) 
+        SELECT DISTINCT m.memoid, t.tagid 
+        FROM memo m CROSS JOIN LATERAL unnest(string_to_array(m.tags, ' ')) AS mt(text)
+             JOIN tag t ON t.text = mt.text
+        ON CONFLICT DO NOTHING
+        RETURNING memoid
+    """
+    rows = await db_mgr.get_db().fetch_all(query=query)
+    return len(rows)
+
+# -----------------------------------------------------------------------------------------
+# returns a select of the memo listings user has access holding every one of tags, answered from
+# memo_tag's tagid index: the memos holding any of the tags, grouped, keeping those holding all.
+# Paged by memoid, as the other listings:
+def tagged_memos_query( user: UserInDB, tags: List[str], after: int = 0, limit: int = 100 ):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    memo_tb = db_mgr.get_memo_table()
+    memo_tag_tb = db_mgr.get_memo_tag_table()
+    wanted_tb = db_mgr.get_tag_table().alias('wanted')
+    
+    # tags are space separated words, as in the memo.tags strings:
+    wanted = sorted( set( word for t in tags for word in t.split() ) )
+    tagged = select( memo_tag_tb.c.memoid )\
+             .select_from(memo_tag_tb.join( wanted_tb, memo_tag_tb.c.tagid == wanted_tb.c.tagid ))\
+             .where(wanted_tb.c.text == func.any(func.string_to_array(' '.join(wanted), ' ')))\
+             .group_by(memo_tag_tb.c.memoid)\
+             .having(func.count() == len(wanted))
+    
+    return memo_access_query( user )\
+           .where(and_( memo_tb.c.memoid.in_(tagged), memo_tb.c.memoid > after ))\
+           .limit(limit)
+
+# -----------------------------------------------------------------------------------------
+async def get_tagged_memos(user: UserInDB, tags: List[str], after: int = 0, limit: int = 100) -> List[MemoListing]:
+    db_mgr: DatabaseMgr = get_database_mgr()
+    memoList = await db_mgr.get_db().fetch_all(query=tagged_memos_query(user, tags, after, limit))
+    
+    return [decorated_memo(m) for m in memoList]
 
 
 
@@ -632,11 +1028,31 @@ async def get_note_by_title(title: str) -> NoteDB:
     return await db_mgr.get_db().fetch_one(query=query)
 
 # -----------------------------------------------------------------------------------------
-# returns all notes:
-async def get_all_notes() -> List[NoteDB]:
+# returns a select of notes, keyset ordered by id from after, all of them or one page of limit:
+def notes_query(after: int = 0, limit: int = None):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    notes_tb = db_mgr.get_notes_table()
+    query = notes_tb.select().where(notes_tb.c.id > after).order_by(asc(notes_tb.c.id))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+# -----------------------------------------------------------------------------------------
+# returns the notes following the id after, all of them or one page of limit:
+async def get_all_notes(after: int = 0, limit: int = None) -> List[NoteDB]:
     db_mgr = get_database_mgr()
-    query = db_mgr.get_notes_table().select().order_by(asc(db_mgr.get_notes_table().c.id))
-    return await db_mgr.get_db().fetch_all(query=query)
+    return await db_mgr.get_db().fetch_all(query=notes_query(after, limit))
+
+# -----------------------------------------------------------------------------------------
+# yields every note following the id after, read through a server-side cursor:
+async def iterate_notes(after: int = 0):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    async for n in db_mgr.get_db().iterate(query=notes_query(after)):
+        yield n
+
+# -----------------------------------------------------------------------------------------
+# the note holding the site's configuration, its changes clear the public page cache:
+SITE_CONFIG_NOTE = 1
 
 # -----------------------------------------------------------------------------------------
 # update a note:
@@ -652,14 +1068,20 @@ async def put_note(id: int, payload: NoteSchema, owner: int):
                 owner=owner)
         .returning(db_mgr.get_notes_table().c.id)
     )
-    return await db_mgr.get_db().execute(query=query)
+    result = await db_mgr.get_db().execute(query=query)
+    if id == SITE_CONFIG_NOTE:
+        await public_pages_changed()
+    return result
 
 # -----------------------------------------------------------------------------------------
 # delete a note:
 async def delete_note(id: int):
     db_mgr: DatabaseMgr = get_database_mgr()
     query = db_mgr.get_notes_table().delete().where(id == db_mgr.get_notes_table().c.id)
-    return await db_mgr.get_db().execute(query=query)
+    result = await db_mgr.get_db().execute(query=query)
+    if id == SITE_CONFIG_NOTE:
+        await public_pages_changed()
+    return result
 
 
 
@@ -677,8 +1099,11 @@ async def post_user(user: UserReg,
                                                       verify_code=verify_code,
                                                       email=user.email,
                                                       roles=roles )
-    # Executes the query and returns the generated ID
-    return await db_mgr.get_db().execute(query)
+    # Executes the query and returns the generated ID, with the user's user_role rows:
+    async with db_mgr.get_db().transaction():
+        userid = await db_mgr.get_db().execute(query)
+        await sync_user_roles( userid, roles )
+    return userid
     
 
 # -----------------------------------------------------------------------------------------
@@ -699,10 +1124,21 @@ async def get_user_by_email(email: str):
     return await db_mgr.get_db().fetch_one(query)
 
 # -----------------------------------------------------------------------------------------
-# returns all users:
-async def get_all_users() -> List[UserPublic]:
+# returns a select of the public user columns, keyset ordered by userid from after:
+def users_public_query(after: int = 0):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    users_tb = db_mgr.get_users_table()
+    return select( users_tb.c.username, users_tb.c.userid, users_tb.c.roles, users_tb.c.email )\
+                .where(users_tb.c.userid > after)\
+                .order_by(asc(users_tb.c.userid))
+
+# -----------------------------------------------------------------------------------------
+# returns the users following the userid after, all of them or one page of limit:
+async def get_all_users(after: int = 0, limit: int = None) -> List[UserPublic]:
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_users_table().select().order_by(asc(db_mgr.get_users_table().c.userid))
+    query = users_public_query(after)
+    if limit is not None:
+        query = query.limit(limit)
     
     userList = await db_mgr.get_db().fetch_all(query=query)
             
@@ -714,48 +1150,46 @@ async def get_all_users() -> List[UserPublic]:
             
     return finalUserList
 
+# -----------------------------------------------------------------------------------------
+# yields every user following the userid after as a UserPublic, read through a server-side cursor:
+async def iterate_users(after: int = 0):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    async for u in db_mgr.get_db().iterate(query=users_public_query(after)):
+        yield UserPublic(username = u.username, userid = u.userid, roles = u.roles, email = u.email)
+
+
+# -----------------------------------------------------------------------------------------
+# returns a select of users holding role, answered through user_role's tagid index:
+def users_by_role_query(role: str):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    users_tb = db_mgr.get_users_table()
+    user_role_tb = db_mgr.get_user_role_table()
+    tag_tb = db_mgr.get_tag_table()
+    
+    joined = users_tb.join( user_role_tb, users_tb.c.userid == user_role_tb.c.userid )\
+                     .join( tag_tb, user_role_tb.c.tagid == tag_tb.c.tagid )
+    
+    return users_tb.select().select_from(joined).where(tag_tb.c.text == role)\
+                            .order_by(asc(users_tb.c.userid))
 
 # -----------------------------------------------------------------------------------------
 # returns all users by role:
 async def get_all_users_by_role(role: str) -> List[UserPublic]:
-    # first get all the users:
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_users_table().select().order_by(asc(db_mgr.get_users_table().c.userid))
-    userList = await db_mgr.get_db().fetch_all(query=query)
+    userList = await db_mgr.get_db().fetch_all(query=users_by_role_query(role))
             
-    # now filter them:
     finalUserList = []
     for u in userList:
-        # break the user's role string into tokens, one for each role:
-        roleList = u.roles.split()
-        # loop over the roleList retaining those matching the input:
-        for r in roleList:
-            if r == role:
-                up = UserPublic(username = u.username, userid = u.userid, roles = u.roles, email = u.email) 
-                finalUserList.append(up)
+        up = UserPublic(username = u.username, userid = u.userid, roles = u.roles, email = u.email) 
+        finalUserList.append(up)
     
     return finalUserList
 
 # -----------------------------------------------------------------------------------------
 # returns all UserDBs by role:
 async def get_all_UserDBs_by_role(role: str) -> List[UserInDB]:
-    # first get all the users:
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_users_table().select().order_by(asc(db_mgr.get_users_table().c.userid))
-    userList = await db_mgr.get_db().fetch_all(query=query)
-            
-    # now filter them:
-    finalUserList = []
-    for u in userList:
-        log.info( f"get_all_UserDBs_by_role: user {u.userid} has roles {u.roles}")
-        # break the user's role string into tokens, one for each role:
-        roleList = u.roles.split()
-        # loop over the roleList retaining those matching the input:
-        for r in roleList:
-            if r == role: 
-                finalUserList.append(u)
-    
-    return finalUserList
+    return await db_mgr.get_db().fetch_all(query=users_by_role_query(role))
 
 # -----------------------------------------------------------------------------------------
 # update a user passed an user id and an updated UserInDB. 
@@ -774,7 +1208,64 @@ async def put_user(id: int, user: UserInDB):
                ).returning(db_mgr.get_users_table().c.userid)
         # .returning(db_mgr.get_users_table().c.userid)
     )
-    return await db_mgr.get_db().execute(query=query)
+    # the roles string and its user_role rows change together:
+    async with db_mgr.get_db().transaction():
+        userid = await db_mgr.get_db().execute(query=query)
+        if userid:
+            await sync_user_roles( userid, user.roles )
+    if userid:
+        await broadcast(f"user:{userid}")
+    return userid
+
+# -----------------------------------------------------------------------------------------
+# brings a user's user_role rows in step with their roles string in one statement: roles 
+# that are tags get a row, rows for tags no longer in the string are removed. 
+async def sync_user_roles(userid: int, roles: str):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    query = """
+        WITH wanted AS ( SELECT tagid FROM tag WHERE text = ANY(string_to_array(:roles, ' ')) ),
+             gone AS ( DELETE FROM user_role 
+                       WHERE userid = :userid AND tagid NOT IN (SELECT tagid FROM wanted) )
+        INSERT INTO user_role (userid, tagid) SELECT :userid, tagid FROM wanted 
+        ON CONFLICT DO NOTHING
+    """
+    return await db_mgr.get_db().execute(query=query, values={"userid": userid, "roles": roles or ''})
+
+# -----------------------------------------------------------------------------------------
+# revokes the role named by tag from every user holding it, in one statement that removes 
+# their user_role rows and the role from their roles strings. Returns the userids changed:
+async def revoke_tag_from_users(tag: TagDB) -> List[int]:
+    db_mgr: DatabaseMgr = get_database_mgr()
+    query = """
+        WITH gone AS ( DELETE FROM user_role WHERE tagid = :tagid RETURNING userid )
+        UPDATE users 
+        SET roles = array_to_string(array_remove(string_to_array(users.roles, ' '), :text), ' ')
+        FROM gone WHERE users.userid = gone.userid
+        RETURNING users.userid
+    """
+    rows = await db_mgr.get_db().fetch_all(query=query, values={"tagid": tag.tagid, "text": tag.text})
+    for r in rows:
+        await broadcast(f"user:{r['userid']}")
+    return [r['userid'] for r in rows]
+
+# -----------------------------------------------------------------------------------------
+# a one time migration filling user_role from the users.roles strings; only runs if user_role
+# is empty, so is safe to call at every startup. Returns the number of rows created:
+async def backfill_user_roles() -> int:
+    db_mgr: DatabaseMgr = get_database_mgr()
+    existing = await db_mgr.get_db().fetch_one(query="SELECT 1 FROM user_role LIMIT 1")
+    if existing:
+        return 0
+    query = """
+        INSERT INTO user_role (userid, tagid)
+        SELECT DISTINCT u.userid, t.tagid 
+        FROM users u CROSS JOIN LATERAL unnest(string_to_array(u.roles, ' ')) AS r(text)
+             JOIN tag t ON t.text = r.text
+        ON CONFLICT DO NOTHING
+        RETURNING userid
+    """
+    rows = await db_mgr.get_db().fetch_all(query=query)
+    return len(rows)
 
 # -----------------------------------------------------------------------------------------
 # note: there is no user delete, that is accomplished by disabling a user. 
@@ -908,132 +1399,100 @@ async def post_aiChat(prompt: str, chatbot: ChatbotDB, user: UserInDB):
     
     log.info(f"post_aiChat: query build...")
     
-    # Executes the query and returns the generated ID
+    # Executes the query, and the question is the conversation's first message:
+    aichatid = await db_mgr.get_db().execute(query=query)
+    await post_aichat_message(aichatid, 'user', prompt)
+    
+    return aichatid
+
+# -----------------------------------------------------------------------------------------
+# appends a turn to an AI Chat conversation:
+async def post_aichat_message(aichatid: int, role: str, content: str, tokens: int = None):
+    db_mgr: DatabaseMgr = get_database_mgr()
+    query = aichat_message_insert(db_mgr.get_aichat_message_table(), aichatid, role, content, tokens)
     return await db_mgr.get_db().execute(query=query)
 
-# ------------------------------------------------------------------------------------------------
-# communications with OpenAI take place in a Celery Task, and this is used to recover the results:
-async def resolve_aichat_task_results( aichat: AiChatDB ) -> AiChatDB:
-    # Celery task results recovery logic:
-    task_result = celery_app.AsyncResult(aichat.taskid)
-    if task_result.status == 'SUCCESS':
-        try:
-            resObj = task_result.get(timeout=0.001)
-            aichat.reply = resObj.reply 
-            aichat.reply = "<p>" + aichat.reply.replace("\n", "<br>") + "</p>"
-            aichat.status = resObj.status 
-            await put_aichat( aichat )
-        except TimeoutError:
-            log.info(f"resolve_aichat_task_results: TimeoutError!")
-    elif task_result.status == 'FAILURE':
-        task_result.forget()
-        aichat.status = 'failed'
-        await put_aichat( aichat )
-            
-    return aichat
+# -----------------------------------------------------------------------------------------
+# returns the turns of an AI Chat conversation, in order:
+async def get_aichat_messages(aichatid: int) -> List[AiChatMessageDB]:
+    db_mgr: DatabaseMgr = get_database_mgr()
+    msg_tb = db_mgr.get_aichat_message_table()
+    query = msg_tb.select().where(msg_tb.c.aichatid == aichatid).order_by(asc(msg_tb.c.seq))
+    return await db_mgr.get_db().fetch_all(query=query)
+
+# -----------------------------------------------------------------------------------------
+# converts an aichat row into an AiChatDB. Communications with OpenAI take place in a Celery 
+# Task that writes its reply and status directly to the row, so rows are read as they are:
+def aichat_db(c) -> AiChatDB:
+    return AiChatDB( aichatid = c.aichatid,
+                     prePrompt = c.prePrompt,
+                     prompt = c.prompt,
+                     reply = c.reply,
+                     model = c.model,
+                     status = c.status,
+                     taskid = c.taskid,
+                     chatbotid = c.chatbotid,
+                     projectid = c.projectid,
+                     userid = c.userid,
+                     username = c.username,
+                     input_tokens = c.input_tokens,
+                     created_date = c.created_date,
+                     updated_date = c.updated_date)
 
 # -----------------------------------------------------------------------------------------
 # for getting AI Chat exchanges:
 async def get_aiChat(aichatid: int) -> AiChatDB:
     
-    # log.info(f"get_aiChat: getting aichatid {aichatid}")
-    
     db_mgr: DatabaseMgr = get_database_mgr()
     query = db_mgr.get_aichat_table().select().where(aichatid == db_mgr.get_aichat_table().c.aichatid)
     
-    # log.info(f"get_aiChat: query built...")
-    
-    aichat: AiChatDB = await db_mgr.get_db().fetch_one(query=query)
-    
-    # special Celery task results recovery logic:
-    if aichat.status == 'inuse':
-        aichat = await resolve_aichat_task_results( aichat )
+    aichat = await db_mgr.get_db().fetch_one(query=query)
+    if aichat is None:
+        return None
             
-    return aichat
+    return aichat_db(aichat)
 
 
 # -----------------------------------------------------------------------------------------
-# returns all AiChatDB for a given project:
-async def get_all_project_aiChats(projectid: int) -> List[AiChatDB]:
-    
-    # log.info(f"get_all_project_aiChats: getting ai chats for project with id {projectid}")
+AICHAT_EXCERPT_LENGTH = 200
+
+# returns listings of all AiChats for a given project, their prompts cut to an excerpt by the db:
+async def get_all_project_aiChats(projectid: int) -> List[AiChatListing]:
     
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_aichat_table().select().where(projectid == db_mgr.get_aichat_table().c.projectid)
-    
-    # log.info(f"get_all_project_aiChats: query built...")
+    aichat_tb = db_mgr.get_aichat_table()
+    query = select( aichat_tb.c.aichatid, aichat_tb.c.chatbotid, aichat_tb.c.projectid,
+                    aichat_tb.c.userid, aichat_tb.c.username, aichat_tb.c.model, aichat_tb.c.status,
+                    func.substr(aichat_tb.c.prompt, 1, AICHAT_EXCERPT_LENGTH).label('excerpt'),
+                    aichat_tb.c.created_date, aichat_tb.c.updated_date )\
+            .where(aichat_tb.c.projectid == projectid)\
+            .order_by(asc(aichat_tb.c.aichatid))
     
     chatList = await db_mgr.get_db().fetch_all(query=query)
-        
-    finalList = []
-    for c in chatList:
-        # aichatid = c.aichatid
-        # log.info(f"get_all_project_aiChats: preping comment with id {aichatid}")
-        aiChatExchange = AiChatDB( aichatid = c.aichatid,
-                                   prePrompt = c.prePrompt,
-                                   prompt = c.prompt,
-                                   reply = c.reply,
-                                   model = c.model,
-                                   status = c.status,
-                                   taskid = c.taskid,
-                                   chatbotid = c.chatbotid,
-                                   projectid = c.projectid,
-                                   userid = c.userid,
-                                   username = c.username,
-                                   created_date = c.created_date,
-                                   updated_date = c.updated_date)
-        #
-        # special Celery task results recovery logic:
-        if aiChatExchange.status == 'inuse':
-            aiChatExchange = await resolve_aichat_task_results( aiChatExchange )
-        #
-        finalList.append(aiChatExchange)
             
-    # log.info(f"get_all_project_aiChats: finalList {finalList}")
-            
-    return finalList
+    return [ AiChatListing( aichatid = c.aichatid,
+                            chatbotid = c.chatbotid,
+                            projectid = c.projectid,
+                            userid = c.userid,
+                            username = c.username,
+                            model = c.model,
+                            status = c.status,
+                            excerpt = c.excerpt or '',
+                            created_date = c.created_date,
+                            updated_date = c.updated_date ) for c in chatList ]
 
 # -----------------------------------------------------------------------------------------
-# returns all AiChatDB for a given "conversation":
+# returns all AiChatDB for a given "conversation". Its turns are aichat_message rows, see
+# get_aichat_messages(); the aichat row is only the conversation's header, so there is one:
 async def get_all_conversation_aiChats(projectid: int, aichatid: int) -> List[AiChatDB]:
     
-    # log.info(f"get_all_conversation_aiChats: getting ai chats for aichatid {aichatid}")
-    
     db_mgr: DatabaseMgr = get_database_mgr()
-    query = db_mgr.get_aichat_table().select().where(projectid == db_mgr.get_aichat_table().c.projectid)
-    
-    # log.info(f"get_all_conversation_aiChats: query built...")
+    aichat_tb = db_mgr.get_aichat_table()
+    query = aichat_tb.select().where(and_(aichat_tb.c.projectid == projectid, aichat_tb.c.aichatid == aichatid))
     
     chatList = await db_mgr.get_db().fetch_all(query=query)
-        
-    finalList = []
-    for c in chatList:
-        aichatid = c.aichatid
-        parent = c.parent
-        if c.aichatid == aichatid or c.parent == aichatid:
-            # log.info(f"get_all_conversation_aiChats: preping comment with id {aichatid}")
-            aiChatExchange = AiChatDB( aichatid = c.aichatid,
-                                       prePrompt = c.prePrompt,
-                                       prompt = c.prompt,
-                                       reply = c.reply,
-                                       model = c.model,
-                                       status = c.status,
-                                       taskid = c.taskid,
-                                       chatbotid = c.chatbotid,
-                                       projectid = c.projectid,
-                                       userid = c.userid,
-                                       username = c.username,
-                                       created_date = c.created_date)
-            #
-            # special Celery task results recovery logic:
-            if aiChatExchange.status == 'inuse':
-                aiChatExchange = await resolve_aichat_task_results( aiChatExchange )
-            #
-            finalList.append(aiChatExchange)
             
-    # log.info(f"get_all_conversation_aiChats: finalList {finalList}")
-            
-    return finalList
+    return [ aichat_db(c) for c in chatList ]
 
 # -----------------------------------------------------------------------------------------
 # update an AiChatDB. 
@@ -0,0 +1,189 @@
+# ---------------------------------------------------------------------------------------------
+# Serving files from disk, shared by project file downloads, project videos and backups.
+# file_response() answers a request for a file with the whole file or, given a Range header,
+# the one byte range asked for (RFC 7233). The body is handed to the ASGI server when it can
+# send files itself: the "http.response.pathsend" extension for whole files, and the
+# "http.response.zerocopysend" extension, sendfile() from an open file, for whole files and
+# ranges. Otherwise the body is read in FILE_CHUNK_SIZE async reads, off the event loop.
+#
+# Responses carry ETag and Last-Modified validators. If-None-Match / If-Modified-Since get 304
+# without the file being opened, and a Range with a stale If-Range gets the whole file, see
+# app/api/conditional.py.
+#
+# With Settings.FILE_OFFLOAD set, files within the app directory are not sent at all: the
+# endpoint still authorizes and records the download, then answers with an X-Accel-Redirect
+# (nginx) or X-Sendfile (Apache, lighttpd) header naming the file under FILE_OFFLOAD_PREFIX,
+# and the front proxy sends the file, ranges included. See nginx/offload.conf.
+#
+# Benchmark against the previous 10,000 byte generator with: python -m tests.bench_fileserve
+#
+import os
+import re
+import stat
+import mimetypes
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+import aiofiles
+from fastapi import HTTPException, Request, status
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from app.config import get_settings, get_base_path
+from app.api.conditional import strong_etag, http_date, validator_headers, is_not_modified, \
+                                not_modified_response, if_range_matches
+
+FILE_CHUNK_SIZE = 1024*1024
+
+
+# ----------------------------------------------------------------------------------------------
+# the inclusive (start, end) of a "bytes=start-end", "bytes=start-" or "bytes=-suffix" Range
+# header, or None to send the whole file. Multiple ranges are answered with the whole file,
+# and a Range that is not valid syntax is ignored, as RFC 7233 permits:
+BYTE_RANGE = re.compile(r"\s*([0-9]*)\s*-\s*([0-9]*)\s*")
+
+def parse_range_header(rangeHeader: Optional[str], fileSize: int) -> Optional[Tuple[int, int]]:
+    if not rangeHeader:
+        return None
+    units, _, ranges = rangeHeader.partition("=")
+    if units.strip().lower() != "bytes" or "," in ranges:
+        return None
+    byteRange = BYTE_RANGE.fullmatch(ranges)
+    if byteRange is None or byteRange.group(1) == byteRange.group(2) == "":
+        return None
+    first, last = byteRange.groups()
+    # a last byte before the first is invalid syntax too:
+    if first != "" and last != "" and int(last) < int(first):
+        return None
+    if first == "":
+        # the final 'last' bytes:
+        start = max(0, fileSize - int(last))
+        end = fileSize - 1
+    else:
+        start = int(first)
+        end = min(int(last), fileSize - 1) if last != "" else fileSize - 1
+    # a valid range not overlapping the file:
+    if start > end or start >= fileSize:
+        raise HTTPException( status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                             detail=f"Range not satisfiable (Range:{rangeHeader!r})",
+                             headers={"content-range": f"bytes */{fileSize}"} )
+    return start, end
+
+# ----------------------------------------------------------------------------------------------
+class FileRangeResponse(Response):
+    def __init__(self, path, start: int, end: int, fileSize: int, status_code: int, headers: dict,
+                 media_type: str, sendBody: bool = True):
+        self.path = os.path.abspath(path)
+        self.start = start
+        self.count = end - start + 1 if fileSize else 0
+        self.fileSize = fileSize
+        self.sendBody = sendBody
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send( { "type": "http.response.start", "status": self.status_code, "headers": self.raw_headers } )
+        if not self.sendBody or self.count == 0:
+            await send( { "type": "http.response.body", "body": b"", "more_body": False } )
+            return
+
+        extensions = scope.get("extensions") or {}
+        if "http.response.pathsend" in extensions and self.count == self.fileSize:
+            await send( { "type": "http.response.pathsend", "path": self.path } )
+        elif "http.response.zerocopysend" in extensions:
+            async with aiofiles.open(self.path, mode="rb") as f:
+                await send( { "type": "http.response.zerocopysend", "file": f.fileno(),
+                              "offset": self.start, "count": self.count, "more_body": False } )
+        else:
+            async with aiofiles.open(self.path, mode="rb") as f:
+                await f.seek(self.start)
+                remaining = self.count
+                while remaining > 0:
+                    chunk = await f.read(min(FILE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send( { "type": "http.response.body", "body": chunk, "more_body": remaining > 0 } )
+                if remaining > 0:
+                    # the file shrank while being sent:
+                    await send( { "type": "http.response.body", "body": b"", "more_body": False } )
+
+# ----------------------------------------------------------------------------------------------
+# the response handing the file at path to the front proxy to send, None when the file is not
+# one the proxy can reach, outside the app directory, or has a name the header cannot carry:
+def offload_response(offload: str, path, media_type: str, headers: dict) -> Optional[Response]:
+    try:
+        relative = Path(path).resolve().relative_to(get_base_path())
+    except ValueError:
+        return None
+    prefix = get_settings().FILE_OFFLOAD_PREFIX.rstrip("/")
+    if offload == "x-accel-redirect":
+        headers["x-accel-redirect"] = prefix + "/" + quote(relative.as_posix())
+    elif offload == "x-sendfile":
+        target = prefix + "/" + relative.as_posix()
+        if not target.isascii():
+            return None
+        headers["x-sendfile"] = target
+    else:
+        return None
+    return Response(status_code=status.HTTP_200_OK, headers=headers, media_type=media_type)
+
+# ----------------------------------------------------------------------------------------------
+# the response sending the file at path, or the byte range of it the request asks for, or 304
+# when the client's copy is current. Raises 404 when there is no such file. filename, when
+# given, names the download. etag, when given, replaces the one made from the file's mtime
+# and size, for callers knowing the file's content by other means:
+def file_response(request: Request, path, media_type: str = None, filename: str = None,
+                  headers: dict = None, etag: str = None) -> Response:
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File Not Found")
+
+    fileSize = st.st_size
+    if media_type is None:
+        media_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+
+    lastModified = http_date(st.st_mtime)
+    if etag is None:
+        etag = strong_etag(st.st_mtime_ns, fileSize)
+    if is_not_modified(request, etag, lastModified):
+        return not_modified_response(etag, lastModified, headers)
+
+    responseHeaders = {}
+    if filename is not None:
+        responseHeaders["content-disposition"] = f'attachment; filename="{filename}"'
+    if headers:
+        responseHeaders.update(headers)
+
+    offload = get_settings().FILE_OFFLOAD.lower()
+    if offload:
+        response = offload_response(offload, path, media_type, dict(responseHeaders))
+        if response is not None:
+            return response
+
+    responseHeaders = {
+        "accept-ranges": "bytes",
+        **validator_headers(etag, lastModified),
+        **responseHeaders,
+    }
+
+    # a range of a file changed since the client's If-Range is answered with the whole file:
+    start, end = 0, fileSize - 1
+    status_code = status.HTTP_200_OK
+    byteRange = None
+    if if_range_matches(request, etag, lastModified):
+        byteRange = parse_range_header(request.headers.get("range"), fileSize)
+    if byteRange is not None:
+        start, end = byteRange
+        responseHeaders["content-range"] = f"bytes {start}-{end}/{fileSize}"
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+    responseHeaders["content-length"] = str(end - start + 1 if fileSize else 0)
+
+    return FileRangeResponse( path, start, end, fileSize, status_code, responseHeaders, media_type,
+                              sendBody = request.method != "HEAD" )
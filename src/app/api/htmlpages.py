@@ -8,13 +8,15 @@ from datetime import datetime
 from starlette.responses import RedirectResponse
 
 import json
+from typing import List
 
 from app import config
 from app.api import crud
-from app.api.users import get_current_active_user, user_has_role
+from app.api.users import get_current_active_user, get_principal, get_access_context, AccessContext
 from app.api.user_action import UserAction, UserActionLevel
-from app.api.models import User, MemoDB, ProjectDB, NoteDB, AiChatDB, ChatbotDB
+from app.api.models import User, MemoDB, ProjectDB, NoteDB, AiChatDB, ChatbotDB, MemoListing
 from app.api.utils import convertDateToLocal
+from app.page_cache import get_page_cache
 # from app.send_email import send_email_async
 
 # page_frag.py contains common page fragments, like .header & .footer.
@@ -43,25 +45,30 @@ def favicon():
 
 
 # ------------------------------------------------------------------------------------------------------------------
-# serve homepage thru a Jinja2 template:
-@router.get("/", status_code=200, response_class=HTMLResponse)
-async def root( request: Request ):
-
-    site_config: NoteDB = await crud.get_note(1) # site_config has id 1
+# the home page is the same for every visitor, so is rendered without a request, once for all
+# visitors by the page cache and by the static export of the public site, app/export_public.py:
+async def render_home_page() -> bytes:
+    
+    site_config: NoteDB = await crud.get_note(crud.SITE_CONFIG_NOTE)
     if site_config:
         site_config.data = json.loads(site_config.data)
         
     memoList = await crud.get_all_public_memos()
     
-    return TEMPLATES.TemplateResponse(
-        "home.html",
-        {"request": request, 
-         "frags": FRAGS, 
+    return TEMPLATES.get_template("home.html").render(
+        {"frags": FRAGS, 
          "regers": site_config.data['public_registration'],
          "access": "public", 
          "memos": memoList}, 
         # 'access' key is for template left sidebar construction
-    )
+    ).encode("utf-8")
+
+# ------------------------------------------------------------------------------------------------------------------
+# serve homepage thru a Jinja2 template, rendered once for all visitors by the page cache:
+@router.get("/", status_code=200, response_class=HTMLResponse)
+async def root( request: Request ):
+
+    return HTMLResponse( await get_page_cache().get( "/", render_home_page ) )
     
 
 # ------------------------------------------------------------------------------------------------------------------
@@ -135,9 +142,10 @@ async def profilePage( request: Request,
 # serve the requested page thru a Jinja2 template:
 @router.get("/projectPage/{projectid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def projectPage( request: Request, projectid: int, 
-                       current_user: User = Depends(get_current_active_user) ):
+                       current_user: User = Depends(get_current_active_user),
+                       access: AccessContext = Depends(get_access_context) ):
      
-    proj, tag, cbetag = await crud.get_project_both_tags(projectid)
+    proj, tag, cbetag = await crud.get_project_both_tags(projectid, access)
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -186,7 +194,7 @@ async def projectPage( request: Request, projectid: int,
         proj.name += ' (archived)'
         proj.text = '<h3>(Embedded files do not display in archived projects)</h3>' + proj.text 
         
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
      
     # returns list of all project users:
@@ -227,9 +235,10 @@ async def projectPage( request: Request, projectid: int,
 @router.get("/projectEditor/{id}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def projectEditor( request: Request, 
                          id: int, 
-                         current_user: User = Depends(get_current_active_user) ):
+                         current_user: User = Depends(get_current_active_user),
+                         access: AccessContext = Depends(get_access_context) ):
     
-    proj, tag, cbetag = await crud.get_project_both_tags(id)
+    proj, tag, cbetag = await crud.get_project_both_tags(id, access)
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -281,7 +290,7 @@ async def projectEditor( request: Request,
                                        f"ProjectPage {id}, '{proj.name}', is archived, cannot be edited" )
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized, archived project.") 
         
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
         
     memoList = await crud.get_all_project_memos(current_user, id)
@@ -316,7 +325,7 @@ async def projectEditor( request: Request,
 async def newProjectEditor( request: Request, 
                             current_user: User = Depends(get_current_active_user) ):
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     
     """ allowing non-admins to create projects:
     if not isAdmin:
@@ -367,7 +376,8 @@ async def newProjectEditor( request: Request,
 @router.get("/memoPage/{id}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def memoPage( request: Request, 
                     id: int, 
-                    current_user: User = Depends(get_current_active_user) ):
+                    current_user: User = Depends(get_current_active_user),
+                    access: AccessContext = Depends(get_access_context) ):
     
     memo: MemoDB = await crud.get_memo(id)
     if not memo:
@@ -377,7 +387,7 @@ async def memoPage( request: Request,
                                        f"memoPage {id}, not found" )
         raise HTTPException(status_code=404, detail="Memo not found")
     
-    proj: ProjectDB = await crud.get_project(memo.projectid)
+    proj: ProjectDB = await crud.get_project(memo.projectid, access)
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -385,7 +395,7 @@ async def memoPage( request: Request,
                                        f"memoPage {id}, Project {memo.projectid} not found" )
         raise HTTPException(status_code=404, detail="Memo Project not found")
     
-    weAreAllowed = await crud.user_has_memo_access( current_user, memo )
+    weAreAllowed = await crud.user_has_memo_access( current_user, memo, access )
     if not weAreAllowed:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('WARNING'),
@@ -403,7 +413,7 @@ async def memoPage( request: Request,
     localCreated_dt = convertDateToLocal( memo.created_date )
     localUpdated_dt = convertDateToLocal( memo.updated_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
     
     return TEMPLATES.TemplateResponse(
@@ -424,11 +434,9 @@ async def memoPage( request: Request,
     )
     
 # ------------------------------------------------------------------------------------------------------------------
-# serve the requested page thru a Jinja2 template:
-@router.get("/publicmemo/{id}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
-async def memoPublic( request: Request, id: int  ):
-    
-    # config.log.info(f"memoPublic: got {id}")
+# a public memo's page, like the home page rendered without a request for the page cache and 
+# the static export. memoList, the public memos of the left sidebar, is fetched when not given:
+async def render_public_memo_page( id: int, memoList: List[MemoListing] = None ) -> bytes:
     
     memo: MemoDB = await crud.get_memo(id)
     if not memo:
@@ -441,15 +449,14 @@ async def memoPublic( request: Request, id: int  ):
         
     # config.log.info(f"memoPublic: yep, we are public")
     
-    memoList = await crud.get_all_public_memos()
+    if memoList is None:
+        memoList = await crud.get_all_public_memos()
     
     localCreated_dt = convertDateToLocal( memo.created_date )
     localUpdated_dt = convertDateToLocal( memo.updated_date )
     
-    return TEMPLATES.TemplateResponse(
-        "index.html",
-        { "request": request, 
-          "contentPost": memo, 
+    return TEMPLATES.get_template("index.html").render(
+        { "contentPost": memo, 
           "memoCreated": localCreated_dt.strftime("%c"),
           "memoUpdated": localUpdated_dt.strftime("%c"),
           "frags": FRAGS, 
@@ -457,7 +464,16 @@ async def memoPublic( request: Request, id: int  ):
           "memos": memoList 
         }, 
         # 'access' key is for template left sidebar construction
-    )
+    ).encode("utf-8")
+
+# ------------------------------------------------------------------------------------------------------------------
+# serve the requested page thru a Jinja2 template, rendered once for all visitors by the page cache:
+@router.get("/publicmemo/{id}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
+async def memoPublic( request: Request, id: int  ):
+    
+    # config.log.info(f"memoPublic: got {id}")
+    
+    return HTMLResponse( await get_page_cache().get( f"/publicmemo/{id}", lambda: render_public_memo_page(id) ) )
     
 
 # ------------------------------------------------------------------------------------------------------------------
@@ -465,7 +481,8 @@ async def memoPublic( request: Request, id: int  ):
 @router.get("/memoEditor/{memoid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def memoEditor( request: Request, 
                       memoid: int, 
-                      current_user: User = Depends(get_current_active_user) ):
+                      current_user: User = Depends(get_current_active_user),
+                      access: AccessContext = Depends(get_access_context) ):
     
     memo: MemoDB = await crud.get_memo(memoid)
     if not memo:
@@ -475,7 +492,7 @@ async def memoEditor( request: Request,
                                        f"requested memo {memoid}, not found" )
         raise HTTPException(status_code=404, detail="Memo not found")
     
-    proj: ProjectDB = await crud.get_project(memo.projectid)
+    proj: ProjectDB = await crud.get_project(memo.projectid, access)
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -483,7 +500,7 @@ async def memoEditor( request: Request,
                                        f"requested memo {id}, Project {memo.projectid} not found" )
         raise HTTPException(status_code=404, detail="Memo Project not found")
 
-    weAreAllowed = await crud.user_has_memo_access( current_user, memo )
+    weAreAllowed = await crud.user_has_memo_access( current_user, memo, access )
     if not weAreAllowed:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('WARNING'),
@@ -502,7 +519,7 @@ async def memoEditor( request: Request,
     localCreated_dt = convertDateToLocal( memo.created_date )
     localUpdated_dt = convertDateToLocal( memo.updated_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
 
     return TEMPLATES.TemplateResponse(
@@ -527,9 +544,10 @@ async def memoEditor( request: Request,
 @router.get("/newProjectMemo/{projectid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def newMemoEditor( request: Request, 
                          projectid: int,
-                         current_user: User = Depends(get_current_active_user) ):
+                         current_user: User = Depends(get_current_active_user),
+                         access: AccessContext = Depends(get_access_context) ):
     
-    proj: ProjectDB = await crud.get_project(projectid)
+    proj: ProjectDB = await crud.get_project(projectid, access)
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -537,7 +555,7 @@ async def newMemoEditor( request: Request,
                                        f"Project {projectid} not found" )
         raise HTTPException(status_code=404, detail="Memo Project not found")
     
-    tag = await crud.get_tag( proj.tagid )
+    tag = await crud.get_tag( proj.tagid, access )
     if not tag:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -562,7 +580,7 @@ async def newMemoEditor( request: Request,
     created_date = datetime.now()
     local_dt = convertDateToLocal( created_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
     
     memo = MemoDB( memoid=0,
@@ -604,9 +622,10 @@ async def newMemoEditor( request: Request,
 @router.get("/newChatbot/{projectid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def newChatbotPage( request: Request, 
                       projectid: int, 
-                      current_user: User = Depends(get_current_active_user) ):
+                      current_user: User = Depends(get_current_active_user),
+                      access: AccessContext = Depends(get_access_context) ):
     
-    proj, tag, cbetag = await crud.get_project_both_tags(projectid)
+    proj, tag, cbetag = await crud.get_project_both_tags(projectid, access)
     # proj, tag = await crud.get_project_and_tag(projectid) 
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
@@ -639,7 +658,7 @@ async def newChatbotPage( request: Request,
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized to access project.")
     #
     # verify project chatbot editor access:
-    if not user_has_role(current_user, cbetag.text):
+    if not get_principal(current_user).has_role(cbetag.text):
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('WARNING'),
                                        UserAction.index('FAILED_GET_AICHATROLE'), 
@@ -661,7 +680,7 @@ async def newChatbotPage( request: Request,
     localCreated_dt = convertDateToLocal( created_date )
     localUpdated_dt = convertDateToLocal( created_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
     
     return TEMPLATES.TemplateResponse(
@@ -687,13 +706,14 @@ async def newChatbotPage( request: Request,
 @router.get("/ChatbotEditor/{chatbotid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def chatbotEditor( request: Request, 
                        chatbotid: int, 
-                       current_user: User = Depends(get_current_active_user) ):
+                       current_user: User = Depends(get_current_active_user),
+                       access: AccessContext = Depends(get_access_context) ):
     
     chatbot: ChatbotDB = await crud.get_Chatbot(chatbotid)
     if not chatbot:
         raise HTTPException(status_code=404, detail="chatbot not found")
     
-    proj, tag, cbetag = await crud.get_project_both_tags(chatbot.projectid)
+    proj, tag, cbetag = await crud.get_project_both_tags(chatbot.projectid, access)
     # proj, tag = await crud.get_project_and_tag(chatbot.projectid) 
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
@@ -725,7 +745,7 @@ async def chatbotEditor( request: Request,
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized to access project.")
     #
     # verify project chatbot editor access:
-    if not user_has_role(current_user, cbetag.text):
+    if not get_principal(current_user).has_role(cbetag.text):
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('WARNING'),
                                        UserAction.index('FAILED_GET_AICHATROLE'), 
@@ -748,7 +768,7 @@ async def chatbotEditor( request: Request,
     localCreated_dt = convertDateToLocal( created_date )
     localUpdated_dt = convertDateToLocal( updated_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
     
     return TEMPLATES.TemplateResponse(
@@ -774,13 +794,14 @@ async def chatbotEditor( request: Request,
 @router.get("/ChatbotPage/{chatbotid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def chatbotPage( request: Request, 
                        chatbotid: int, 
-                       current_user: User = Depends(get_current_active_user) ):
+                       current_user: User = Depends(get_current_active_user),
+                       access: AccessContext = Depends(get_access_context) ):
     
     chatbot: ChatbotDB = await crud.get_Chatbot(chatbotid)
     if not chatbot:
         raise HTTPException(status_code=404, detail="chatbot not found")
     
-    proj, tag = await crud.get_project_and_tag(chatbot.projectid) 
+    proj, tag = await crud.get_project_and_tag(chatbot.projectid, access) 
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -819,7 +840,7 @@ async def chatbotPage( request: Request,
     localCreated_dt = convertDateToLocal( created_date )
     localUpdated_dt = convertDateToLocal( updated_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
     
     return TEMPLATES.TemplateResponse(
@@ -845,7 +866,8 @@ async def chatbotPage( request: Request,
 @router.get("/newChatbotExchange/{chatbotid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def newAichatPage( request: Request, 
                          chatbotid: int, 
-                         current_user: User = Depends(get_current_active_user) ):
+                         current_user: User = Depends(get_current_active_user),
+                         access: AccessContext = Depends(get_access_context) ):
     
     chatbot: ChatbotDB = await crud.get_Chatbot(chatbotid)
     if not chatbot:
@@ -855,7 +877,7 @@ async def newAichatPage( request: Request,
                                        f"newAichat, chatbot {chatbotid}, not found" )
         raise HTTPException(status_code=404, detail="chatbot not found")
     
-    proj, tag = await crud.get_project_and_tag(chatbot.projectid) 
+    proj, tag = await crud.get_project_and_tag(chatbot.projectid, access) 
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -893,7 +915,7 @@ async def newAichatPage( request: Request,
     localCreated_dt = convertDateToLocal( created_date )
     localUpdated_dt = convertDateToLocal( created_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
     
     return TEMPLATES.TemplateResponse(
@@ -925,7 +947,8 @@ async def newAichatPage( request: Request,
 @router.get("/chatbotExchange/{aichatid}", status_code=status.HTTP_200_OK, response_class=HTMLResponse)
 async def aichatPage( request: Request, 
                       aichatid: int, 
-                      current_user: User = Depends(get_current_active_user) ):
+                      current_user: User = Depends(get_current_active_user),
+                      access: AccessContext = Depends(get_access_context) ):
     
     aichat: AiChatDB = await crud.get_aiChat(aichatid)
     if not aichat:
@@ -939,7 +962,7 @@ async def aichatPage( request: Request,
                                        f"aichat, chatbot {aichat.chatbotid}, not found" )
         raise HTTPException(status_code=404, detail="chatbot not found")
     
-    proj, tag = await crud.get_project_and_tag(aichat.projectid) 
+    proj, tag = await crud.get_project_and_tag(aichat.projectid, access) 
     if not proj:
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('SITEBUG'),
@@ -978,7 +1001,7 @@ async def aichatPage( request: Request,
     localCreated_dt = convertDateToLocal( created_date )
     localUpdated_dt = convertDateToLocal( updated_date )
     
-    isAdmin = user_has_role(current_user,"admin")
+    isAdmin = get_principal(current_user).is_admin
     isOwner = current_user.userid == proj.userid
     
     return TEMPLATES.TemplateResponse(
@@ -1024,7 +1047,7 @@ async def user_settings_page( request: Request,
         
     # if an ordinary user get user_page, if admin get admin_page: 
     page = 'user_page.html'
-    if user_has_role( current_user, "admin"):
+    if get_principal(current_user).is_admin:
         page = 'admin_page.html'
         
         # get site_config note to add to the admin page 
@@ -1,12 +1,13 @@
 # ----------------------------------------------------------------------------------------------
 # This file contains the JSON endpoints for memo posts, handling the CRUD operations with the db 
 #
-from fastapi import APIRouter, HTTPException, Path, Depends, status
+from fastapi import APIRouter, HTTPException, Path, Query, Depends, Request, Response, status
 
 from app.api import crud
 from app.api.users import get_current_active_user, user_has_role
 from app.api.user_action import UserAction, UserActionLevel
-from app.api.models import UserInDB, MemoDB, MemoSchema, MemoResponse, ProjectDB, TagDB
+from app.api.conditional import strong_etag, conditional_response
+from app.api.models import UserInDB, MemoDB, MemoSchema, MemoResponse, ProjectDB, TagDB, MemoListing
 
 from typing import List
 
@@ -45,7 +46,7 @@ async def create_memo(payload: MemoSchema,
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                             detail="Not Authorized to create memo for project.")
     
-    if not tag.text in payload.tags:
+    if not tag.text in payload.tags.split():
         payload.tags += ' '
         payload.tags += tag.text
     
@@ -58,10 +59,24 @@ async def create_memo(payload: MemoSchema,
     
     return { "memoid": memoid }
 
+# ----------------------------------------------------------------------------------------------
+# browse memos by tag: the memos the user has access holding every tag given, as in
+# /memo/tagged?tag=contracts&tag=2023. Paged by memoid, pass the last memoid seen as after.
+# Declared before /{id} so "tagged" is not taken for an id:
+@router.get("/tagged", response_model=List[MemoListing])
+async def read_tagged_memos(tag: List[str] = Query(..., min_items=1, max_items=10),
+                            after: int = Query(0, ge=0),
+                            limit: int = Query(100, ge=1, le=1000),
+                            current_user: UserInDB = Depends(get_current_active_user)) -> List[MemoListing]:
+    
+    return await crud.get_tagged_memos( current_user, tag, after, limit )
+
 # ----------------------------------------------------------------------------------------------
 # Note: id's type is validated as greater than 0  
 @router.get("/{id}", response_model=MemoDB)
-async def read_memo(id: int = Path(..., gt=0),
+async def read_memo(request: Request,
+                    response: Response,
+                    id: int = Path(..., gt=0),
                     current_user: UserInDB = Depends(get_current_active_user)) -> MemoDB:
     
     memo = await crud.get_memo(id)
@@ -84,13 +99,20 @@ async def read_memo(id: int = Path(..., gt=0),
                                    UserActionLevel.index('NORMAL'),
                                    UserAction.index('GET_MEMO'), 
                                    f"memo {memo.memoid}, '{memo.title}'" )
+    
+    # the client's copy is current when the memo has not been updated since:
+    notModified = conditional_response( request, response,
+                                        strong_etag("memo", memo.memoid, memo.updated_date.isoformat()),
+                                        memo.updated_date )
+    if notModified:
+        return notModified
      
     return memo
 
 # ----------------------------------------------------------------------------------------------
-# The response_model is a List with a MemoDB subtype. See import of List top of file. 
-@router.get("/", response_model=List[MemoDB])
-async def read_all_memos(current_user: UserInDB = Depends(get_current_active_user)) -> List[MemoDB]:
+# The response_model is a List of memo listings, memos without their text. See import of List top of file. 
+@router.get("/", response_model=List[MemoListing])
+async def read_all_memos(current_user: UserInDB = Depends(get_current_active_user)) -> List[MemoListing]:
     
     # get all the memos, they are filtered by the user's roles:
     memoList = await crud.get_all_memos( current_user )
@@ -146,7 +168,7 @@ async def update_memo(payload: MemoSchema,
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized to change other's Memos")
     
     # making sure the project tag is one of the memo tags:
-    if not tag.text in payload.tags:
+    if not tag.text in payload.tags.split():
         payload.tags += ' '
         payload.tags += tag.text
     
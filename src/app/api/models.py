@@ -1,5 +1,5 @@
 from typing import Union
-from pydantic import BaseModel, Field, EmailStr, constr
+from pydantic import BaseModel, Field, EmailStr, PrivateAttr, constr
 from datetime import datetime
 import json
 
@@ -41,6 +41,20 @@ class MemoDB(MemoSchema):
     
 class MemoResponse(BaseModel):
     memoid: int
+
+# a memo as listed in sidebars and memo lists, without its text:
+class MemoListing(BaseModel):
+    memoid: int
+    title: str
+    status: str
+    access: str
+    tags: str
+    userid: int
+    username: str
+    projectid: int
+    excerpt: Union[str, None]   # plain text start of the memo, kept up to date on write
+    created_date: datetime
+    updated_date: datetime
     
 
 # a file uploaded for a project 
@@ -49,6 +63,9 @@ class ProjectFileCreate(BaseModel):
     filename: str = Field(index=True)  # uploaded filename+extension only, not full path, that's calc'ed from project
     projectid: int = Field(index=True) # project this file is associated
     modifiable: bool = Field(...)
+    size: Union[int,None] = None       # bytes, with mimetype & checksum set when the file is written
+    mimetype: Union[str,None] = None
+    checksum: Union[str,None] = None   # sha256 hex digest
     
 class ProjectFileDB(ProjectFileCreate):
     pfid: int = Field(index=True)
@@ -141,11 +158,36 @@ class AiChatDB(BaseModel):
     projectid: int = Field(..., foreign_key="ProjectDB.projectid")
     userid: int = Field(...,foreign_key="UserInDB.userid")
     username: str = Field(..., foreign_key="UserInDB.userid")
+    input_tokens: Union[int, None]          # context tokens sent for the latest reply
+    created_date: datetime
+    updated_date: datetime
+#
+# an AIChat exchange as listed, without its prePrompt and reply; excerpt is the start of its prompt:
+class AiChatListing(BaseModel):
+    aichatid: int
+    chatbotid: int
+    projectid: int
+    userid: int
+    username: str
+    model: str
+    status: str
+    excerpt: str
     created_date: datetime
     updated_date: datetime
 #
-# used to pass less than an entire AiChatDB to a Celery task:
+# one turn of an AIChat conversation:
+class AiChatMessageDB(BaseModel):
+    aichatid: int = Field(..., foreign_key="AiChatDB.aichatid")
+    seq: int                                # turn order, from 1
+    role: str                               # 'user' or 'assistant'
+    content: str
+    tokens: Union[int, None]
+    created_date: datetime
+#
+# used to pass less than an entire AiChatDB to a Celery task. Slots keep each instance small, 
+# and the fields are listed once for the JSON codec below:
 class  AiChatTask:
+    __slots__ = ('prePrompt', 'prompt', 'reply', 'model', 'status', 'taskid', 'aichatid')
     prePrompt: str
     prompt: str
     reply: str
@@ -163,20 +205,30 @@ class  AiChatTask:
         self.taskid = taskid
         self.aichatid = aichatid
 #
+# JSON codec for Celery messages carrying AiChatTasks, registered as the "aichatjson" serializer 
+# in app/worker.py. An AiChatTask is encoded as an object holding its slots plus a type marker:
+AICHAT_TASK_MARKER = '__aichattask__'
+#
 class AiChatTaskEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, AiChatTask):
-            return {
-                'prePrompt': obj.prePrompt,
-                'prompt': obj.prompt,
-                'reply': obj.reply,
-                'model': obj.model,
-                'status': obj.status,
-                'taskid': obj.taskid,
-                'aichatid': obj.aichatid
-            }
+            encoded = { name: getattr(obj, name) for name in AiChatTask.__slots__ }
+            encoded[AICHAT_TASK_MARKER] = 1
+            return encoded
         return super(AiChatTaskEncoder, self).default(obj)
-    
+#
+def aichat_task_object_hook(obj: dict):
+    if obj.pop(AICHAT_TASK_MARKER, None):
+        return AiChatTask(**obj)
+    return obj
+#
+def aichat_task_dumps(obj) -> str:
+    return json.dumps(obj, cls=AiChatTaskEncoder, separators=(',', ':'))
+#
+def aichat_task_loads(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data, object_hook=aichat_task_object_hook)
     
     
 
@@ -208,6 +260,12 @@ class ProjectSchema(BaseModel):
 class ProjectDB(ProjectSchema):
     projectid: int = Field(index=True)
     created_date: datetime
+    updated_date: Union[datetime,None] = None
+
+# a project with the text of its access tag and chatbot edit tag attached:
+class ProjectTaggedDB(ProjectDB):
+    tag: Union[str,None]                                        # project tag text
+    cbetag: Union[str,None]                                     # chatbot edit tag text
 
 
 class ProjectInviteCreate(BaseModel):
@@ -246,6 +304,7 @@ class UserInDB(User):
     userid: int = Field(index=True)
     verify_code: str
     hashed_password: str
+    _principal = PrivateAttr(default=None)  # their parsed roles, see users.get_principal()
 
 # info for user registration
 class UserReg(BaseModel):
@@ -265,6 +324,18 @@ class UserPublic(BaseModel):
 class basicTextPayload(BaseModel):
     text: str
     
+# one full text search hit, ranked; headline is html with the matching words in <mark> tags:
+class SearchResult(BaseModel):
+    kind: str                           # 'memo', 'comment' or 'project'
+    id: int                             # memoid, commid or projectid, per kind
+    memoid: Union[int,None]             # the memo of a memo or comment
+    projectid: int
+    title: str                          # memo title, commented memo's title or project name
+    username: str
+    headline: str
+    rank: float
+    created_date: datetime
+    
 
 
 class UserActionCreate(BaseModel):
@@ -279,8 +350,16 @@ class UserActionDB(UserActionCreate):
     created_date: datetime
     
 class UserActionResponse(BaseModel):
+    actionid: int                       # the cursor for the next page of a listing
     action: str
     level: str
     username: str
     description: str
-    created_date: str
\ No newline at end of file
+    created_date: str
+
+# one day of a user's activity for one action, read from the daily rollups:
+class UserActionSummary(BaseModel):
+    day: str
+    action: str
+    level: str
+    count: int
\ No newline at end of file
@@ -1,13 +1,14 @@
 # ---------------------------------------------------------------------------------------------
 # This file contains the JSON endpoints for notes, handling the CRUD operations with the db 
 #
-from fastapi import APIRouter, HTTPException, Path, Depends, status
+from fastapi import APIRouter, HTTPException, Path, Query, Depends, status
 import json
 from typing import List
 
 from app.api import crud
 from app.api.models import UserInDB, NoteDB, NoteSchema
 from app.api.users import get_current_active_user, user_has_role
+from app.api.utils import ndjsonResponse
 
 
 
@@ -61,13 +62,32 @@ async def read_note(id: int = Path(..., gt=0),
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                         detail="Not Authorized to access other's notes")
 
+# ----------------------------------------------------------------------------------------------
+# stream all notes following id 'after' as newline delimited JSON, only works for admin
+# Declared before "/{id}" so "export" is not taken for an id
+@router.get("/export")
+async def export_notes(after: int = Query(0, ge=0),
+                       current_user: UserInDB = Depends(get_current_active_user)):
+    if user_has_role( current_user, "admin"):
+        return ndjsonResponse( crud.iterate_notes(after), 
+                               lambda n: NoteDB( id=n.id, title=n.title, description=n.description, 
+                                                 data=n.data, owner=n.owner ).json() )
+    
+    else:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
+                            detail="Not Authorized to access all notes")
+
 # ----------------------------------------------------------------------------------------------
 # return list of notes, only works for admin
 # The response_model is a List with a NoteDB subtype. See import of List top of file. 
+# Returns one page of at most 'limit' notes following id 'after'; request the next page 
+# with 'after' set to the last id returned. 
 @router.get("/", response_model=List[NoteDB])
-async def read_all_notes(current_user: UserInDB = Depends(get_current_active_user)) -> List[NoteDB]:
+async def read_all_notes(after: int = Query(0, ge=0), 
+                         limit: int = Query(100, gt=0, le=1000),
+                         current_user: UserInDB = Depends(get_current_active_user)) -> List[NoteDB]:
     if user_has_role( current_user, "admin"):
-        return await crud.get_all_notes()
+        return await crud.get_all_notes(after, limit)
     
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
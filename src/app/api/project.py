@@ -4,16 +4,17 @@
 import os
 import glob
 
-from fastapi import APIRouter, HTTPException, Path, Depends, status
+from fastapi import APIRouter, HTTPException, Path, Depends, Request, Response, status
 
 from app import config
 from app.api import crud
 from app.api.utils import zipFileList
 from app.api.users import get_current_active_user, user_has_role
 from app.api.user_action import UserAction, UserActionLevel
+from app.api.conditional import strong_etag, conditional_response
 from app.api.memo import delete_memo
 from app.api.upload import get_project_projectfiles
-from app.api.models import UserInDB, basicTextPayload, ProjectRequest, ProjectUpdate, ProjectSchema, ProjectDB, TagDB, MemoSchema
+from app.api.models import UserInDB, basicTextPayload, ProjectRequest, ProjectUpdate, ProjectSchema, ProjectDB, ProjectTaggedDB, TagDB
 
 from typing import List
 
@@ -130,12 +131,12 @@ async def create_project(payload: ProjectRequest,
     
     didRoleAdjustment = False
     old_roles = current_user.roles
-    if not payload.tag in current_user.roles:
+    if not user_has_role(current_user, payload.tag):
         # make creating user automagically a member of the project:
         current_user.roles += " " + payload.tag
         didRoleAdjustment = True
         #
-    if not cbEditTag in current_user.roles:
+    if not user_has_role(current_user, cbEditTag):
         # make creating user automagically a member of the project and a project chatbot editor:
         current_user.roles += " " + cbEditTag
         didRoleAdjustment = True
@@ -159,7 +160,9 @@ async def create_project(payload: ProjectRequest,
 # ----------------------------------------------------------------------------------------------
 # Note: id's type is validated as greater than 0  
 @router.get("/{id}", response_model=ProjectDB)
-async def read_project(id: int = Path(..., gt=0),
+async def read_project(request: Request,
+                       response: Response,
+                       id: int = Path(..., gt=0),
                        current_user: UserInDB = Depends(get_current_active_user)) -> ProjectDB:
     
     # proj, tag = await crud.get_project_and_tag(id)
@@ -191,13 +194,21 @@ async def read_project(id: int = Path(..., gt=0),
                                    UserActionLevel.index('NORMAL'),
                                    UserAction.index('GET_PROJECT'), 
                                    f"project {id}, '{proj.name}'" )
+    
+    # the client's copy is current when the project has not been updated since:
+    notModified = conditional_response( request, response,
+                                        strong_etag("project", proj.projectid, proj.updated_date.isoformat()),
+                                        proj.updated_date )
+    if notModified:
+        return notModified
+    
     return proj
 
 # ----------------------------------------------------------------------------------------------
 # The response_model is a List with a ProjectDB subtype. See import of List top of file. 
-# Returns a list of the projects the user has access.
-@router.get("/", response_model=List[ProjectDB])
-async def read_all_projects(current_user: UserInDB = Depends(get_current_active_user)) -> List[ProjectDB]:
+# Returns a list of the projects the user has access, with their tags attached.
+@router.get("/", response_model=List[ProjectTaggedDB])
+async def read_all_projects(current_user: UserInDB = Depends(get_current_active_user)) -> List[ProjectTaggedDB]:
     
     # get all the projects this user has access:
     projList = await crud.get_all_projects(current_user)
@@ -258,26 +269,11 @@ async def update_project(payload: ProjectUpdate,
     return projectid
 
 # ----------------------------------------------------------------------------------------------
-async def remove_tag_from_users( tag: TagDB ):
-    errorCount = 0
-    # get list of all project users and remove their project role   
-    userList = await crud.get_all_UserDBs_by_role( tag.text )
-    for u in userList:
-        # from here till the line break is removing 'tag.text' from roles: 
-        role_list = u.roles.split()
-        u.roles = ''
-        first = True
-        for role in role_list:
-            if role != tag.text:
-                if not first:
-                    u.roles += ' '
-                u.roles += role
-            first = False
-        # update user in the database: 
-        id = await crud.put_user( u.userid, u )
-        if id != u.userid:
-            errorCount += 1
-    return errorCount
+# removes the role named by tag from every user holding it, returning how many users changed:
+async def remove_tag_from_users( tag: TagDB ) -> int:
+    changedUsers = await crud.revoke_tag_from_users( tag )
+    log.info( f"remove_tag_from_users: removed '{tag.text}' from {len(changedUsers)} users" )
+    return len(changedUsers)
                 
 # ----------------------------------------------------------------------------------------------
 # Note: id's type is validated as greater than 0  
@@ -336,13 +332,9 @@ async def delete_project(id: int = Path(..., gt=0),
     
     if len(uploaded_files) == 0 and len(projFileList) == 0 and len(projMemoList) == 0:
         # if any users are project chatbot editors, remove that permission:
-        errorCount = await remove_tag_from_users( cbetag )
-        if errorCount > 0:
-            log.info( f"delete_project: remove_tag_from_users reports {errorCount} errors" )
+        await remove_tag_from_users( cbetag )
         # if any users are members, remove them from the project:
-        errorCount = await remove_tag_from_users( tag )
-        if errorCount > 0:
-            log.info( f"delete_project: remove_tag_from_users reports {errorCount} errors" )
+        await remove_tag_from_users( tag )
         # this is a project with no memos and no uploaded files, just delete it:
         await crud.delete_project(id)
         # its upload directory is empty, so delete that too:
@@ -380,14 +372,10 @@ async def delete_project(id: int = Path(..., gt=0),
     # this project has at least one memo or uploaded file, so archive it:
     
     # if any users are project chatbot editors, remove that permission:
-    errorCount = await remove_tag_from_users( cbetag )
-    if errorCount > 0:
-        log.info( f"delete_project: remove_tag_from_users reports {errorCount} errors" )
+    await remove_tag_from_users( cbetag )
     #
     # if any users are members, remove them from the project:
-    errorCount = await remove_tag_from_users( tag )
-    if errorCount > 0:
-        log.info( f"delete_project: remove_tag_from_users reports {errorCount} errors" )
+    await remove_tag_from_users( tag )
             
     # archive any files:
     if len(uploaded_files) > 0:
@@ -403,22 +391,8 @@ async def delete_project(id: int = Path(..., gt=0),
                 log.info(f"delete_project: error {error}")
                 log.info(f"File path {f} cannot be removed")
                 
-    # at this location we:
-    # 1) get all memos associated with this project 
-    # 2) delete them one by one (which also deletes their comments)
-    # 3) finally delete the project itself 
-    #
-    for memo in projMemoList:
-        # set each memo as 'archived'
-        pm = MemoSchema( title=memo.title,
-                         text=memo.text,
-                         status='archived',
-                         tags=memo.tags,
-                         access=memo.access,
-                         userid=memo.userid,
-                         username=memo.username,
-                         projectid=memo.projectid )
-        await crud.put_memo( memo.memoid, current_user, pm )
+    # set all memos of this project as 'archived':
+    await crud.archive_project_memos( project.projectid )
     #
     # finally mark the project as archived:
     ps = ProjectSchema( name=project.name, 
@@ -426,7 +400,8 @@ async def delete_project(id: int = Path(..., gt=0),
                         userid=project.userid,
                         username=project.username,
                         status='archived',
-                        tagid=project.tagid)
+                        tagid=project.tagid,
+                        cbetagid=project.cbetagid)
     await crud.put_project( project.projectid, ps)
     
     # todo:
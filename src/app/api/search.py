@@ -0,0 +1,36 @@
+# ---------------------------------------------------------------------------------------------
+# This file contains the full text search endpoint over memos, comments and projects. Matching,
+# access filtering, ranking and highlighting are done by the db, see crud.search_query()
+#
+# Benchmark the search queries against 100k generated memos with: python -m tests.bench_search
+#
+from fastapi import APIRouter, Query, Depends
+from typing import List, Optional
+
+from app.api import crud
+from app.api.models import UserInDB, SearchResult
+from app.api.users import get_current_active_user
+from app.api.user_action import UserAction, UserActionLevel
+
+
+router = APIRouter()
+
+# ----------------------------------------------------------------------------------------------
+# q takes web search syntax: words, "quoted phrases", or, and -excluded words. kind restricts
+# the search to one of memo, comment or project. Results are paged by limit & offset:
+@router.get("/", response_model=List[SearchResult])
+async def search(q: str = Query(..., min_length=2, max_length=256),
+                 kind: Optional[str] = Query(None, regex="^(memo|comment|project)$"),
+                 limit: int = Query(20, ge=1, le=100),
+                 offset: int = Query(0, ge=0, le=10000),
+                 current_user: UserInDB = Depends(get_current_active_user)) -> List[SearchResult]:
+
+    kinds = crud.SEARCH_KINDS if kind is None else (kind,)
+    results = await crud.search( current_user, q, kinds, limit, offset )
+
+    await crud.rememberUserAction( current_user.userid,
+                                   UserActionLevel.index('NORMAL'),
+                                   UserAction.index('SEARCH'),
+                                   f"'{q}', {kind or 'all'}, offset {offset}, {len(results)} results" )
+
+    return results
@@ -1,16 +1,18 @@
 from typing import Annotated
-from fastapi import APIRouter, Path, File, UploadFile, Depends, HTTPException, status, Form
+from fastapi import APIRouter, Path, File, UploadFile, Depends, HTTPException, status, Form, Request
 from fastapi.responses import FileResponse
 
 import aiofiles
 
 import glob
-from typing import List
+from typing import List, Optional, Tuple
 
 from app import config
 from app.api import crud
-from app.api.users import get_current_active_user, user_has_role
+from app.api.users import get_current_active_user, get_principal
 from app.api.user_action import UserAction, UserActionLevel
+from app.api.fileserve import file_response
+from app.api.conditional import strong_etag
 from app.api.models import UserInDB, ProjectFileDB, ProjectFileCreate, TagDB, ProjectDB, ProjectSchema, basicTextPayload
 
 from app.config import log
@@ -20,18 +22,43 @@ from app.api.utils import convertDateToLocal
 import os
 import mimelib  # problem is with VSCode local resolution, in the Docker container we're fine. 
 import json
+import hashlib
+from starlette.concurrency import run_in_threadpool
 
 from datetime import datetime
 
 router = APIRouter()
 
+CHUNK_SIZE = 1024*1024
+
+# ------------------------------------------------------------------------------------------------------------------
+# a project file's size, mime type and sha256 checksum as kept on its projectfile row. Uploads compute these 
+# as they write, this reads the file back so is run in the threadpool by the reconciliation pass:
+def projectfile_metadata(path) -> Tuple[int, str, str]:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, mimelib.url(str(path)).mime_type, digest.hexdigest()
+
+# ------------------------------------------------------------------------------------------------------------------
+# the strong etag of a project file's current version, from its projectfile row's version and checksum. None 
+# for a file without a row or checksum, which is then validated by its mtime and size:
+async def projectfile_etag(projectid: int, filename: str) -> Optional[str]:
+    projFile: ProjectFileDB = await crud.get_projectfile_by_filename(filename, projectid)
+    if projFile is None or not projFile.checksum:
+        return None
+    return strong_etag(projFile.pfid, projFile.version, projFile.checksum)
+
 # ------------------------------------------------------------------------------------------------------------------
 # endpoint for general uploads, restricted to admin accounts, once uploaded downloads are not restricted
 @router.post("/", status_code=200)
 async def upload(file: UploadFile = File(...), 
                  current_user: UserInDB = Depends(get_current_active_user)):
     
-    if not user_has_role(current_user,"admin") and not user_has_role(current_user,"staff"):
+    if not get_principal(current_user).is_admin and not get_principal(current_user).has_role("staff"):
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('WARNING'),
                                        UserAction.index('FAILED_FILE_UPLOAD'), 
@@ -46,7 +73,6 @@ async def upload(file: UploadFile = File(...),
         #
         async with aiofiles.open(upload_path, 'wb') as f:
             log.info(f"upload: file opened for writing...")
-            CHUNK_SIZE = 1024*1024
             while contents := await file.read(CHUNK_SIZE):
                 await f.write(contents)
                 
@@ -74,7 +100,7 @@ async def read_all_uploads(current_user: UserInDB = Depends(get_current_active_u
     
     # log.info(f"read_all_uploads: here!")
     
-    if not user_has_role(current_user,"admin") and not user_has_role(current_user,"staff"):
+    if not get_principal(current_user).is_admin and not get_principal(current_user).has_role("staff"):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not Authorized")
     
     upload_path = config.get_base_path() / 'static/uploads/*' 
@@ -161,8 +187,8 @@ async def upload_projectfile(projectid: int,
                                        f"Project Tag {proj.tagid} Not Found" )
         raise HTTPException(status_code=500, detail="Project Tag not found")
     
-    isAdmin = user_has_role(current_user,"admin")
-    isProjMember = user_has_role(current_user, tag.text)
+    isAdmin = get_principal(current_user).is_admin
+    isProjMember = get_principal(current_user).has_role(tag.text)
     
     log.info( f"upload_projectfile: isAdmin is {isAdmin}, isProjMember is {isProjMember}")
     
@@ -201,15 +227,18 @@ async def upload_projectfile(projectid: int,
     
     # upload_path = config.get_base_path() / 'static/uploads' / tag.text / file.filename
     upload_path = config.get_base_path() / 'uploads' / tag.text / file.filename
+    digest = hashlib.sha256()
+    size = 0
     try:
         #
         log.info(f"upload: attempting {upload_path}")
         #
         async with aiofiles.open(upload_path, 'wb') as f:
             log.info(f"upload: file opened for writing...")
-            CHUNK_SIZE = 1024*1024
             while contents := await file.read(CHUNK_SIZE):
                 await f.write(contents)
+                digest.update(contents)
+                size += len(contents)
                 
     except Exception:
         await crud.rememberUserAction( current_user.userid, 
@@ -221,7 +250,8 @@ async def upload_projectfile(projectid: int,
         await file.close()
 
     modBool = modifiable == 'true'
-    pfc = ProjectFileCreate( filename=file.filename, projectid=projectid, modifiable=modBool )
+    pfc = ProjectFileCreate( filename=file.filename, projectid=projectid, modifiable=modBool,
+                             size=size, mimetype=mimelib.url(file.filename).mime_type, checksum=digest.hexdigest() )
     pfid = await crud.post_projectfile( pfc, current_user.userid )
     if not pfid:
         await crud.rememberUserAction( current_user.userid, 
@@ -351,9 +381,14 @@ async def check_project_uploads_for_orphans(current_user: UserInDB):
                                 # let's look inside:
                                 await check_project_upload_directory_for_orphans(dirname, proj, current_user)
                                 
-# slave to the above routine:
+# slave to the above routine, also reconciles the project's projectfile rows with its files on disk: 
+# untracked files are recovered, and files whose size on disk differs from their row, or written 
+# before rows kept size, mime type & checksum, get those recomputed:
 async def check_project_upload_directory_for_orphans(dirname: str, proj: ProjectDB, current_user: UserInDB):
     
+    # the project's projectfile rows, by filename, in one query:
+    tracked = { pf.filename: pf for pf in await crud.get_project_projectfiles( proj.projectid ) }
+    
     # we have a project and a tag for it, let's look inside that directory:
     project_upload_path = config.get_base_path() / 'uploads' / dirname / '*' 
     #
@@ -367,15 +402,26 @@ async def check_project_upload_directory_for_orphans(dirname: str, proj: Project
         pufname = puparts[pucount-1]
         #
         if os.path.isfile(proj_upload_file_path):
-            pfid = await crud.get_projectfile_by_filename( pufname, proj.projectid )
-            if not pfid:
+            projFile = tracked.pop( pufname, None )
+            if not projFile:
                 # located an untracked file inside that recovered project upload directory, let's recover the file too:
-                pfc = ProjectFileCreate( filename=pufname, projectid=proj.projectid, modifiable=True ) 
+                size, mimetype, checksum = await run_in_threadpool( projectfile_metadata, proj_upload_file_path )
+                pfc = ProjectFileCreate( filename=pufname, projectid=proj.projectid, modifiable=True,
+                                         size=size, mimetype=mimetype, checksum=checksum ) 
                 pfid = await crud.post_projectfile( pfc, current_user.userid )
                 if not pfid:
                     log.info(f"check_project_upload_directory_for_orphans: failed recovering orphaned file '{pufname}' for project '{proj.name}'")
                 else:
                     log.info(f"check_project_upload_directory_for_orphans: recovered orphaned file '{pufname}' for project '{proj.name}'")
+            elif projFile.size is None or projFile.checksum is None or projFile.size != os.path.getsize(proj_upload_file_path):
+                # the file changed on disk, or predates the stored metadata:
+                size, mimetype, checksum = await run_in_threadpool( projectfile_metadata, proj_upload_file_path )
+                projFile = ProjectFileDB( **projFile._mapping )
+                projFile.size = size
+                projFile.mimetype = mimetype
+                projFile.checksum = checksum
+                await crud.put_projectfile( projFile )
+                log.info(f"check_project_upload_directory_for_orphans: updated size, type & checksum of '{pufname}' for project '{proj.name}'")
             else:
                 log.info(f"check_project_upload_directory_for_orphans: noticed and validated file '{pufname}' for project '{proj.name}'")
                 
@@ -383,6 +429,10 @@ async def check_project_upload_directory_for_orphans(dirname: str, proj: Project
             # we've got a directory within a project upload directory that is untracked:
             log.info(f"check_project_upload_directory_for_orphans: orphaned directory inside project upload dir at '{proj_upload_file_path}'")
     
+    # rows left have no file on disk:
+    for filename in tracked:
+        log.info(f"check_project_upload_directory_for_orphans: projectfile '{filename}' of project '{proj.name}' is missing on disk")
+    
 # ----------------------------------------------------------------------------------------------
 # returns a list of the projectfiles for the passed project via it's projectid 
 @router.get("/{projectid}", response_model=List)
@@ -406,8 +456,8 @@ async def get_project_projectfiles(projectid: int,
                                        f"Project Tag {proj.tagid} Not found" )
         raise HTTPException(status_code=500, detail="Project Tag not found")
     
-    isAdmin = user_has_role(current_user,"admin")
-    isProjMember = user_has_role(current_user, tag.text)
+    isAdmin = get_principal(current_user).is_admin
+    isProjMember = get_principal(current_user).has_role(tag.text)
     
     if not isAdmin and not isProjMember:
         await crud.rememberUserAction( current_user.userid, 
@@ -439,58 +489,32 @@ async def get_project_projectfiles(projectid: int,
                                        "Not Authorized (not Project member)" )
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not Authorized")
     
-    # generate a list of the (long path) files in the given directory:
-    upload_path = config.get_base_path() / 'uploads' / tag.text / '*' 
-    result = []
-    result.extend(glob.glob(str(upload_path)))
+    # the listing is the project's projectfile rows, files on disk are not touched. Files changed 
+    # on disk behind the app's back are reconciled by check_project_uploads_for_orphans() at startup: 
+    projFileList = await crud.get_project_projectfiles( proj.projectid )
     
     ret = []
-    for longPath in result:
-        if os.path.isfile(longPath):
-            fileSize = os.path.getsize(longPath)
-            
-            parts = longPath.split('/')
-            count = len(parts)
-            filename = parts[count-1]
-    
-            version = 0
-            checked_userid = None
-            checked_date = None
-            modifiable = False
-            #
-            projFileDB: ProjectFileDB = await crud.get_projectfile_by_filename(filename, proj.projectid)
-            # log.info( f"get_project_projectfiles: projFileDB.pfid is {projFileDB.pfid}")
-            if projFileDB:
-                modifiable = projFileDB.modifiable
-                version = projFileDB.version
-                checked_userid = projFileDB.checked_userid
-                checked_date   = projFileDB.checked_date
-                if checked_date:
-                    # fix date to be local time:
-                    checked_date = convertDateToLocal( checked_date )
-            else:
-                log.info(f"get_project_projectfiles: untracked file '{filename}' for project '{proj.name}'")
-                    
-            # returns mimeObject:
-            mo = mimelib.url(longPath)
-        
-            # link = '/static/uploads/' + tag.text + '/' + filename
-            link = '/upload/projectFile/' + str(proj.projectid) + '/' + filename
-        
-            fdesc = {
-                "filename": filename,
-                "pfid": projFileDB.pfid,
-                "projectid": proj.projectid,
-                "type": mo.file_type,
-                "link": link,
-                "size": fileSize,
-                "modifiable": modifiable,
-                "version": version,
-                "checked_userid": checked_userid,
-                "checked_date": checked_date
-            }
+    for projFileDB in projFileList:
+        checked_date = projFileDB.checked_date
+        if checked_date:
+            # fix date to be local time:
+            checked_date = convertDateToLocal( checked_date )
         
-            ret.append( fdesc )
+        fdesc = {
+            "filename": projFileDB.filename,
+            "pfid": projFileDB.pfid,
+            "projectid": proj.projectid,
+            "type": mimelib.url(projFileDB.filename).file_type,
+            "mimetype": projFileDB.mimetype,
+            "link": '/upload/projectFile/' + str(proj.projectid) + '/' + projFileDB.filename,
+            "size": projFileDB.size,
+            "checksum": projFileDB.checksum,
+            "modifiable": projFileDB.modifiable,
+            "version": projFileDB.version,
+            "checked_userid": projFileDB.checked_userid,
+            "checked_date": checked_date
+        }
+        ret.append( fdesc )
         
     await crud.rememberUserAction( current_user.userid, 
                                    UserActionLevel.index('NORMAL'),
@@ -501,8 +525,9 @@ async def get_project_projectfiles(projectid: int,
 
 
 # ----------------------------------------------------------------------------------------------
-@router.get("/projectFile/{projectid}/{filename}", response_class=FileResponse)
-async def get_projectfile(projectid: int, 
+@router.get("/projectFile/{projectid}/{filename}")
+async def get_projectfile(request: Request,
+                          projectid: int, 
                           filename: str,
                           current_user: UserInDB = Depends(get_current_active_user)):
     
@@ -523,8 +548,8 @@ async def get_projectfile(projectid: int,
                                        f"Project Tag {proj.tagid} Not found" )
         raise HTTPException(status_code=500, detail="Project Tag not found")
     
-    isAdmin = user_has_role(current_user,"admin")
-    isProjMember = user_has_role(current_user, tag.text)
+    isAdmin = get_principal(current_user).is_admin
+    isProjMember = get_principal(current_user).has_role(tag.text)
     
     if not isAdmin and not isProjMember:
         await crud.rememberUserAction( current_user.userid, 
@@ -565,7 +590,7 @@ async def get_projectfile(projectid: int,
                                        UserActionLevel.index('NORMAL'),
                                        UserAction.index('GET_PROJECT_FILE'), 
                                        f"Project '{proj.name}', file {upload_path}" )
-        return upload_path
+        return file_response( request, upload_path, etag = await projectfile_etag(projectid, filename) )
     else:
         # the file is missing! oh nos!
         upload_path = config.get_base_path() / 'static' / 'missingOrArchivedFile.jpg'
@@ -574,7 +599,7 @@ async def get_projectfile(projectid: int,
                                        UserActionLevel.index('WARNING'),
                                        UserAction.index('GET_PROJECT_FILE'), 
                                        f"Project '{proj.name}', file {upload_path} was missing, gave missing file image" )
-        return upload_path
+        return file_response( request, upload_path )
 
 
 # ----------------------------------------------------------------------------------------------
@@ -594,8 +619,8 @@ async def checkout_projectfile(pfid: int,
     if tag is None:
         raise HTTPException(status_code=500, detail="Project Tag not found")
     
-    isAdmin = user_has_role(current_user,"admin")
-    isProjMember = user_has_role(current_user, tag.text)
+    isAdmin = get_principal(current_user).is_admin
+    isProjMember = get_principal(current_user).has_role(tag.text)
     isModifiable = projFile.modifiable
     
     if not isAdmin and not isProjMember or not isModifiable:
@@ -647,8 +672,8 @@ async def checkcancel_projectfile(pfid: int,
     if tag is None:
         raise HTTPException(status_code=500, detail="Project Tag not found")
     
-    isAdmin = user_has_role(current_user,"admin")
-    # isProjMember = user_has_role(current_user, tag.text)
+    isAdmin = get_principal(current_user).is_admin
+    # isProjMember = get_principal(current_user).has_role(tag.text)
     isChecker    = projFile.checked_userid == current_user.userid
     
     if not isAdmin:
@@ -700,8 +725,8 @@ async def checkin_projectfile(pfid: int,
     if not projFile.modifiable:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not Authorized")
     
-    isAdmin = user_has_role(current_user,"admin")
-    isProjMember = user_has_role(current_user, tag.text)
+    isAdmin = get_principal(current_user).is_admin
+    isProjMember = get_principal(current_user).has_role(tag.text)
     isChecker    = projFile.checked_userid == current_user.userid
     
     log.info( f"checkin_projectfile: isAdmin is {isAdmin}, isProjMember is {isProjMember}, is checker {isChecker}, checked_userid is {projFile.checked_userid}")
@@ -739,15 +764,18 @@ async def checkin_projectfile(pfid: int,
     log.info(f"checkin_projectfile: about to try...")
     
     upload_path = config.get_base_path() / 'uploads' / tag.text / file.filename
+    digest = hashlib.sha256()
+    size = 0
     try:
         #
         log.info(f"checkin_projectfile: attempting {upload_path}")
         #
         async with aiofiles.open(upload_path, 'wb') as f:
             log.info(f"checkin_projectfile: file opened for writing...")
-            CHUNK_SIZE = 1024*1024
             while contents := await file.read(CHUNK_SIZE):
                 await f.write(contents)
+                digest.update(contents)
+                size += len(contents)
                 
     except Exception:
         await crud.rememberUserAction( current_user.userid, 
@@ -761,6 +789,9 @@ async def checkin_projectfile(pfid: int,
     projFile.version += 1
     projFile.checked_userid = None
     projFile.checked_date = None 
+    projFile.size = size
+    projFile.mimetype = mimelib.url(file.filename).mime_type
+    projFile.checksum = digest.hexdigest()
     ret = await crud.put_projectfile( projFile )
     if ret != projFile.pfid:
         return {"message": f"Near success checked in {tag.text} {file.filename}, final put failed!"}
@@ -794,8 +825,8 @@ async def delete_projectfile(pfid: int = Path(..., gt=0),
     if projFile.checked_userid != None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Project file is checked out; cancel check out or check in the file first")
 
-    isAdmin = user_has_role(current_user,"admin")
-    isProjOwner = user_has_role(current_user, tag.text) and proj.userid == current_user.userid
+    isAdmin = get_principal(current_user).is_admin
+    isProjOwner = get_principal(current_user).has_role(tag.text) and proj.userid == current_user.userid
     
     log.info( f"delete_projectfile: isAdmin is {isAdmin}, isProjOwner is {isProjOwner}")
     
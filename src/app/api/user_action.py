@@ -1,15 +1,16 @@
 # ----------------------------------------------------------------------------------------------
 # This file contains the JSON endpoints for "user action" posts, handling the CRUD operations with the db 
 #
-from fastapi import APIRouter, HTTPException, Path, Depends, status
+from fastapi import APIRouter, HTTPException, Path, Query, Depends, status
 from fastapi.responses import JSONResponse
 
 from app.api import crud 
 from app.api.users import get_current_active_user, user_has_role
-from app.api.models import UserInDB, UserActionDB, UserActionResponse
-from app.api.utils import convertDateToLocal
+from app.api.models import UserInDB, UserActionDB, UserActionResponse, UserActionSummary
+from app.api.utils import convertDateToLocal, ndjsonResponse
 
 from typing import List
+from datetime import date, timedelta
 
 from app.config import log
 
@@ -122,7 +123,38 @@ UserAction = [
     'ADMIN_GET_BACKUPS_LIST',
     'NONADMIN_REQUESTED_BACKUP',
     'FAILED_ADMIN_REQUESTED_BACKUP',
-    'ADMIN_GET_BACKUP']
+    'ADMIN_GET_BACKUP',
+    'NONADMIN_REQUESTED_AICHAT_CACHE_STATS',
+    'SEARCH']
+
+# ----------------------------------------------------------------------------------------------
+# converts a user action row carrying its username into a UserActionResponse:
+def user_action_response(a) -> UserActionResponse:
+    # the app runs in UTC local time:
+    local_dt = convertDateToLocal( a.created_date )
+    return UserActionResponse( actionid=a.actionid,
+                               level=UserActionLevel[a.actionLevel], # convert enum int to enum string
+                               action=UserAction[a.actionCode],
+                               username=a.username,
+                               description=a.description,
+                               created_date=local_dt.strftime("%c") )
+
+# ----------------------------------------------------------------------------------------------
+# streams every user action following actionid 'after' as newline delimited JSON, read from a
+# server-side cursor so exporting the whole log uses constant memory. Declared before "/{id}"
+# so "export" is not taken for an id:
+@router.get("/export")
+async def export_user_actions(after: int = Query(0, ge=0),
+                              current_user: UserInDB = Depends(get_current_active_user)):
+    
+    if not user_has_role( current_user, 'admin' ):
+        await crud.rememberUserAction( current_user.userid, 
+                                       UserActionLevel.index('BANNED_ACTION'),
+                                       UserAction.index('NONADMIN_USER_ACTION_REQUEST'), 
+                                       "tried to export all user actions" )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
+    
+    return ndjsonResponse( crud.iterate_user_actions(after), lambda a: user_action_response(a).json() )
 
 # ----------------------------------------------------------------------------------------------
 # Note: id's type is validated as greater than 0  
@@ -143,6 +175,7 @@ async def read_user_action(id: int = Path(..., gt=0),
     
     local_dt = convertDateToLocal( action.created_date )
     retAction = UserActionResponse(
+                    actionid=action.actionid,
                     level=UserActionLevel[action.actionLevel], # convert enum int to enum string
                     action=UserAction[action.actionCode], # convert enum int to enum string
                     username=current_user.username,
@@ -154,8 +187,12 @@ async def read_user_action(id: int = Path(..., gt=0),
 
 # ----------------------------------------------------------------------------------------------
 # The response_model is a List with a UserActionResponse subtype. See import of List top of file. 
+# Returns one page of at most 'limit' actions following actionid 'after'; request the next page 
+# with 'after' set to the last actionid returned. 
 @router.get("/", response_model=List[UserActionResponse])
-async def read_all_user_actions(current_user: UserInDB = Depends(get_current_active_user)) -> List[UserActionResponse]:
+async def read_all_user_actions(after: int = Query(0, ge=0), 
+                                limit: int = Query(100, gt=0, le=1000),
+                                current_user: UserInDB = Depends(get_current_active_user)) -> List[UserActionResponse]:
     
     if not user_has_role( current_user, 'admin' ):
         await crud.rememberUserAction( current_user.userid, 
@@ -164,26 +201,10 @@ async def read_all_user_actions(current_user: UserInDB = Depends(get_current_act
                                        "tried to get all user actions" )
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
     
-    # get all user actions:
-    actionList = await crud.get_all_user_actions()
+    # get one page of user actions, each with its username:
+    actionList = await crud.get_all_user_actions(after, limit)
     
-    userList = await crud.get_all_users()
-    
-    retList = []
-    for a in actionList:
-        for u in userList:
-            if a.userid==u.userid:
-                local_dt = convertDateToLocal( a.created_date )
-                retAction = UserActionResponse(
-                    level=UserActionLevel[a.actionLevel], # convert enum int to enum string
-                    action=UserAction[a.actionCode],
-                    username=u.username,
-                    description=a.description,
-                    created_date=local_dt.strftime("%c")
-                )
-        retList.append(retAction)
-        
-    return retList
+    return [ user_action_response(a) for a in actionList ]
 
 # ----------------------------------------------------------------------------------------------
 # The response_model is a List with a UserActionDB subtype. See import of List top of file. 
@@ -210,6 +231,7 @@ async def read_all_this_users_actions(userid: int, limit: int,  offset: int,
         # the app runs in UTC local time:
         local_dt = convertDateToLocal( a.created_date )
         retAction = UserActionResponse(
+            actionid=a.actionid,
             level=UserActionLevel[a.actionLevel], # convert enum int to enum string
             action=UserAction[a.actionCode],
             username=user.username,
@@ -243,3 +265,32 @@ async def count_all_this_users_actions(userid: int,
     log.info(f"count_all_this_users_actions: userid is {user.userid}, count is {count}")
     
     return JSONResponse(content={"count": count})
+
+# ----------------------------------------------------------------------------------------------
+# The response_model is a List with a UserActionSummary subtype, the requested user's activity 
+# per day over the last 'days' days, read from the daily rollups rather than the raw action log 
+@router.get("/summary/{userid}", response_model=List[UserActionSummary])
+async def summarize_this_users_actions(userid: int, days: int = 30,
+                                       current_user: UserInDB = Depends(get_current_active_user)) -> List[UserActionSummary]:
+    
+    user = await crud.get_user_by_id(userid)
+    
+    if not user_has_role( current_user, 'admin' ):
+        await crud.rememberUserAction( current_user.userid, 
+                                       UserActionLevel.index('BANNED_ACTION'),
+                                       UserAction.index('NONADMIN_USER_ACTION_REQUEST'), 
+                                       f"tried to get user action summary of {userid}" )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
+    
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    
+    dailyList = await crud.get_this_users_action_summary(user, date.today() - timedelta(days=days))
+    
+    retList = []
+    for d in dailyList:
+        retList.append( UserActionSummary( day=d.day.isoformat(),
+                                           action=UserAction[d.actionCode],
+                                           level=UserActionLevel[d.actionLevel],
+                                           count=d.count ) )
+    return retList
@@ -3,6 +3,7 @@ from fastapi import HTTPException, Depends, status, Request, BackgroundTasks
 from app.config import get_settings, log
 from app.api.models import UserInDB, UserReg
 from app.api import encrypt, crud
+from app.user_cache import get_user_cache
 #
 # from fastapi.security import OAuth2PasswordBearer
 from app.api.utils import OAuth2PasswordBearerWithCookie
@@ -43,6 +44,18 @@ async def get_user(username: str) -> UserInDB:
                     email=email,
                     roles=roles)
 
+# -------------------------------------------------------------------------------------
+# get_user() through the user cache, see app/user_cache.py:
+async def get_cached_user(username: str) -> UserInDB:
+    cache = get_user_cache()
+    user = cache.get(username)
+    if user is None:
+        generation = cache.generation
+        user = await get_user(username)
+        if user:
+            cache.put(user, generation)
+    return user
+
 # -------------------------------------------------------------------------------------
 async def get_user_by_email(email: str) -> UserInDB:
     user = await crud.get_user_by_email(email)
@@ -118,9 +131,40 @@ def user_initial_roles( isAdmin: bool ) -> str:
     ret += ' MiniCMS' # site documentation project
     return ret
 
+# -------------------------------------------------------------------------------------
+# the roles that are site permissions rather than project memberships:
+SITE_ROLES = frozenset(('staff', 'unverified', 'admin', 'disabled'))
+
+# -------------------------------------------------------------------------------------
+# a user's roles string parsed once, so permission checks are set lookups. Roles match
+# exactly: holding the project tag "MiniCMSCBEdit" is not holding "MiniCMS". 
+class Principal:
+    __slots__ = ('rolesText', 'roles', 'projects', 'is_admin', 'is_disabled', 'is_unverified')
+    
+    def __init__(self, rolesText: str):
+        self.rolesText = rolesText
+        self.roles = frozenset(rolesText.split())
+        self.projects = self.roles - SITE_ROLES     # project tags, project & chatbot edit memberships
+        self.is_admin = 'admin' in self.roles
+        self.is_disabled = 'disabled' in self.roles
+        self.is_unverified = 'unverified' in self.roles
+        
+    def has_role(self, role: str) -> bool:
+        return role in self.roles
+
+# -------------------------------------------------------------------------------------
+# the user's Principal, memoized on the user for the rest of the request and rebuilt when
+# their roles string is changed, as endpoints granting roles do before put_user():
+def get_principal( user: UserInDB ) -> Principal:
+    principal = user._principal
+    if principal is None or principal.rolesText != user.roles:
+        principal = Principal(user.roles)
+        user._principal = principal
+    return principal
+
 # -------------------------------------------------------------------------------------
 def user_has_role( user: UserInDB, role: str) -> bool:
-    return role in user.roles
+    return get_principal(user).has_role(role)
 
 # -------------------------------------------------------------------------------------
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
@@ -152,7 +196,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
     except JWTError:
         raise credentials_exception
     
-    user = await get_user(username) 
+    user = await get_cached_user(username) 
     if user is None:
         log.info("get_current_user: user is None!")
         raise credentials_exception
@@ -196,10 +240,29 @@ async def get_refresh_user(request: Request) -> UserInDB:
 
 # -------------------------------------------------------------------------------------
 async def get_current_active_user(current_user: UserInDB = Depends(get_current_user)) -> UserInDB:
-    if user_has_role(current_user, 'disabled'):
+    if get_principal(current_user).is_disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
+# -------------------------------------------------------------------------------------
+# An AccessContext lives for the length of one request. It holds the current user and their
+# Principal, and memoizes the project & tag rows and project access decisions the crud access
+# helpers look up, so a request asking the same question twice only goes to the database once. 
+# The crud helpers accepting an optional 'access' parameter consult it when given. 
+class AccessContext:
+    def __init__(self, user: UserInDB):
+        self.user = user
+        self.principal = get_principal(user)
+        self.projects = {}      # projectid -> project row
+        self.tags = {}          # tagid -> tag row
+        self.projectAccess = {} # projectid -> bool, user_has_project_access_by_id() results
+
+# -------------------------------------------------------------------------------------
+# FastAPI caches dependencies per request, so every Depends(get_access_context) in one
+# request receives the same AccessContext:
+async def get_access_context(current_user: UserInDB = Depends(get_current_active_user)) -> AccessContext:
+    return AccessContext(current_user)
+
 
 
 
@@ -1,5 +1,5 @@
 
-from fastapi import APIRouter, HTTPException, Depends, status, Request, Response, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, Query, status, Request, Response, BackgroundTasks
 from app.api.models import Token, UserInDB, UserPublic, UserReg, basicTextPayload, NoteDB
 from app.api.users import get_current_active_user, user_has_role, validate_new_user_info
 from app.api.user_action import UserAction, UserActionLevel
@@ -14,10 +14,11 @@ import json
 
 from pydantic import EmailStr
 
-from typing import List
+from typing import List, Union
 
 from app.config import get_settings, log 
 from app.api import crud, users 
+from app.api.utils import ndjsonResponse
 
 # create a local API router for the endpoints created in this file:
 router = APIRouter()
@@ -140,12 +141,15 @@ async def read_users_me(request: Request,
             "roles": current_user.roles}
 
 # --------------------------------------------------------------------------------------------------------------
-# return list of current users:
+# return list of current users. Without 'limit' all users are returned, as the user selection lists expect;
+# with it one page of users following userid 'after' is returned, the next page follows the last userid:
 @router.get("/users", 
             status_code=status.HTTP_200_OK, 
             summary="Get list of current users, admin use only", 
             response_model=List[UserPublic])
 async def read_users(request: Request, 
+                    after: int = Query(0, ge=0),
+                    limit: Union[int, None] = Query(None, gt=0, le=1000),
                     current_user: UserInDB = Depends(users.get_current_active_user)) -> List[UserPublic]:
     
     log.info(f'read_users: got {current_user}')
@@ -158,12 +162,30 @@ async def read_users(request: Request,
                                        "Not Authorized" )
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized to access User list") """
     
-    userList = await crud.get_all_users()
+    userList = await crud.get_all_users(after, limit)
     
-    log.info(f'read_users: returning userList {userList}')
+    log.info(f'read_users: returning {len(userList)} users')
     
     return userList
 
+# --------------------------------------------------------------------------------------------------------------
+# stream all users following userid 'after' as newline delimited JSON, read from a server-side cursor.
+# Declared before "/users/{projectTag}" so "export" is not taken for a project tag:
+@router.get("/users/export", 
+            status_code=status.HTTP_200_OK, 
+            summary="Stream all users as newline delimited JSON, admin use only")
+async def export_users(after: int = Query(0, ge=0),
+                       current_user: UserInDB = Depends(users.get_current_active_user)):
+    
+    if not users.user_has_role( current_user, 'admin' ):
+        await crud.rememberUserAction( current_user.userid, 
+                                       UserActionLevel.index('WARNING'),
+                                       UserAction.index('NONADMIN_REQUESTED_USER_LIST'), 
+                                       "Not Authorized" )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized to access User list")
+    
+    return ndjsonResponse( crud.iterate_users(after), lambda u: u.json() )
+
 # --------------------------------------------------------------------------------------------------------------
 # return list of project users:
 @router.get("/users/{projectTag}", 
@@ -265,7 +287,7 @@ async def sign_up(payload: UserReg,
     
     log.info(f'sign_up: got {payload}')
     
-    if not user_has_role(current_user, " admin"):
+    if not user_has_role(current_user, "admin"):
         await crud.rememberUserAction( current_user.userid, 
                                        UserActionLevel.index('BANNED_ACTION'),
                                        UserAction.index('NONADMIN_REQUESTED_CREATE_NEW_USER'), 
@@ -462,7 +484,7 @@ async def set_user_roles(userid: int,
     log.info(f"set_user_roles: working with userid {userid} and payload >{payload.text}<")
     
     isAdmin = True
-    if not user_has_role(current_user, " admin"):
+    if not user_has_role(current_user, "admin"):
         # user is not an admin:
         if userid == current_user.userid:
             isAdmin = False
@@ -4,8 +4,9 @@ from fastapi import Request
 from fastapi.security.utils import get_authorization_scheme_param
 from fastapi import HTTPException
 from fastapi import status
+from fastapi.responses import StreamingResponse
 from typing import Optional
-from typing import Dict
+from typing import Dict, AsyncIterator, Callable
 
 from datetime import datetime
 from dateutil import tz
@@ -59,6 +60,28 @@ def convertDateToLocal( date: datetime ) -> datetime:
 
 
 
+# ---------------------------------------------------------------------------------------
+# streams items as newline delimited JSON, toJson() giving each item's line. Lines are
+# gathered into chunks of about chunkSize bytes so a large export is not one send per row:
+def ndjsonResponse( items: AsyncIterator, toJson: Callable, chunkSize: int = 65536 ) -> StreamingResponse:
+    
+    async def lines():
+        chunk = []
+        size = 0
+        async for item in items:
+            line = toJson(item) + "\n"
+            chunk.append(line)
+            size += len(line)
+            if size >= chunkSize:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
+    
+    return StreamingResponse( lines(), media_type="application/x-ndjson" )
+
+
 # ---------------------------------------------------------------------------------------
 def zipFileList( longPathFileList, destinationZipPath ):
     # writing files to a zipfile
@@ -0,0 +1,99 @@
+# ----------------------------------------------------------------------------------------------
+# The app's in-process caches, the user cache and the rendered page cache, are per worker
+# process. A change made through one worker is broadcast to all of them with Postgres
+# NOTIFY on the CACHE_EVENTS_CHANNEL, which each worker LISTENs to on a connection of its own:
+#
+#   "user:{userid}"   the user's row changed, drop them from the user cache
+#   "pages"           a memo or site_config changed, clear the rendered page cache
+#
+# broadcast() applies the event in the calling worker at once, the others get it within the
+# notification's delivery. While the listening connection is down the caches are cleared on
+# reconnecting, as events may have been missed; the caches' TTLs bound staleness meanwhile.
+#
+import asyncio
+from functools import lru_cache
+from typing import Optional
+
+import asyncpg
+
+from app.config import get_settings, log
+from app.db import get_database_mgr
+from app.page_cache import get_page_cache
+from app.user_cache import get_user_cache
+
+CACHE_EVENTS_CHANNEL = "cache_events"
+RECONNECT_SECONDS = 5.0
+
+
+# ----------------------------------------------------------------------------------------------
+def apply_cache_event(event: str):
+    kind, _, key = event.partition(":")
+    if kind == "user":
+        get_user_cache().invalidate(int(key))
+    elif kind == "pages":
+        get_page_cache().clear()
+    else:
+        log.info(f"apply_cache_event: unknown event '{event}'")
+
+def clear_caches():
+    get_user_cache().clear()
+    get_page_cache().clear()
+
+# ----------------------------------------------------------------------------------------------
+# applies event here and notifies the other workers. A failed notify is logged, not raised: the
+# change it reports is already made, and the other workers' caches expire within their TTLs:
+async def broadcast(event: str):
+    apply_cache_event(event)
+    try:
+        await get_database_mgr().get_db().execute( query="SELECT pg_notify(:channel, :event)",
+                                                   values={"channel": CACHE_EVENTS_CHANNEL, "event": event} )
+    except Exception as e:
+        log.error(f"broadcast: cache event '{event}' not sent, {e}")
+
+
+# ----------------------------------------------------------------------------------------------
+class CacheEventListener:
+    def __init__(self, databaseUrl: str):
+        self.databaseUrl = databaseUrl
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def notified(self, connection, pid, channel, payload):
+        apply_cache_event(payload)
+
+    async def run(self):
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.databaseUrl)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda c: lost.set())
+                await conn.add_listener(CACHE_EVENTS_CHANNEL, self.notified)
+                # events sent while not listening are lost:
+                clear_caches()
+                await lost.wait()
+                log.info("CacheEventListener: connection lost, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"CacheEventListener: {e}, retrying in {RECONNECT_SECONDS}s")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(RECONNECT_SECONDS)
+
+@lru_cache()
+def get_cache_event_listener() -> CacheEventListener:
+    return CacheEventListener(get_settings().DATABASE_URL)
@@ -2,6 +2,7 @@ import logging
 from pydantic import BaseSettings
 from pathlib import Path
 from functools import lru_cache
+from typing import Dict
 
 import os
 
@@ -73,6 +74,36 @@ class Settings(BaseSettings):
     MAIL_FROM_NAME: str
     
     OPENAI_API_KEY: str
+    
+    # AI chat completions run on an asyncio pool in the Celery worker, see app/aichat_pool.py:
+    OPENAI_API_BASE: str = "https://api.openai.com/v1"
+    AICHAT_MAX_CONCURRENCY_PER_MODEL: int = 8   # completions in flight per model, per worker process
+    AICHAT_MAX_RETRIES: int = 4                 # retries of 429, 5xx & connection errors
+    AICHAT_CACHE_TTL_SECONDS: int = 7 * 24 * 3600  # cached replies expire after this, see app/aichat_cache.py
+    AICHAT_CACHE_MAX_ENTRIES: int = 10000       # newest replies kept, 0 disables the cache
+    
+    # AI chat reply tokens are relayed from the Celery worker through Redis, see app/aichat_relay.py:
+    REDIS_URL: str = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379")
+    
+    # user action log batching, see app/action_log.py:
+    ACTION_LOG_BATCH_SIZE: int = 200            # flush once this many actions are queued
+    ACTION_LOG_FLUSH_SECONDS: float = 2.0       # flush at least this often
+    ACTION_LOG_MAX_QUEUED: int = 10000          # queue bound, beyond it NORMAL actions are dropped
+    ACTION_LOG_SAMPLE_RATES: Dict[str, int] = {} # keep 1-in-N per level, json like {"NORMAL": 10}
+    ACTION_LOG_RETENTION_MONTHS: int = 12       # months of partitions kept, 0 keeps all
+
+    # authorized file downloads handed to a front proxy to send, see app/api/fileserve.py:
+    FILE_OFFLOAD: str = ""                      # "", "x-accel-redirect" (nginx) or "x-sendfile" (Apache, lighttpd)
+    FILE_OFFLOAD_PREFIX: str = "/protected"     # the proxy's internal location, or directory for x-sendfile, of app/
+
+    # rendered public pages, see app/page_cache.py:
+    PAGE_CACHE_TTL_SECONDS: float = 60.0        # pages are re-rendered at least this often, 0 disables the cache
+    PAGE_CACHE_MAX_ENTRIES: int = 1000          # most recently used pages kept
+    PUBLIC_EXPORT_DIR: str = "public"           # static export of the public site under app/, "" disables, see app/export_public.py
+
+    # users of authenticated requests, see app/user_cache.py:
+    USER_CACHE_TTL_SECONDS: float = 30.0        # longest a missed invalidation leaves a user stale, 0 disables the cache
+    USER_CACHE_MAX_ENTRIES: int = 1000          # most recently used users kept
 
     # the presence of env_file within this child Config class 
     # tells Pydantic's BaseSettings to load our .env file
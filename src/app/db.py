@@ -1,15 +1,20 @@
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
+    Date,
     DateTime,
     Integer,
     ForeignKey,
+    Index,
     MetaData,
     String,
     Table,
-    create_engine
+    bindparam,
+    create_engine,
+    text
 )
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, select
 
 from sqlalchemy.orm import relationship 
 
@@ -18,6 +23,9 @@ from databases import Database
 from app.config import get_settings
 
 from functools import lru_cache
+from datetime import date
+from html import unescape
+import re
 
 import sqlalchemy # only for the __version__ expression below
 
@@ -67,6 +75,9 @@ class DatabaseMgr:
             Column("checked_date", DateTime, default=None, nullable=True),  # if checked out, when
             Column("version", Integer),                 # increments with each file revision
             Column("status", String, default="latest"), # latest, checkedout, archived
+            Column("size", BigInteger),                 # bytes, set at upload & checkin
+            Column("mimetype", String),                 # set at upload & checkin
+            Column("checksum", String),                 # sha256 hex digest, set at upload & checkin
             Column("created_date", DateTime, default=func.now(), nullable=False),
         )
         
@@ -82,6 +93,7 @@ class DatabaseMgr:
             Column("status", String, default="unpublished"),
             Column("access", String),
             Column("tags", String),
+            Column("excerpt", String),                  # plain text start of text, for listings
             Column("created_date", DateTime, default=func.now(), nullable=False),
             Column("updated_date", DateTime, default=func.now(), onupdate=func.now(), nullable=False),
             
@@ -123,6 +135,9 @@ class DatabaseMgr:
             Column("model", String),
             Column("status", String),
             Column("taskid", String),
+            Column("summary", String),                  # rolling summary of turns left out of the context
+            Column("summary_seq", Integer),             # the last aichat_message seq the summary covers
+            Column("input_tokens", Integer),            # context tokens sent for the latest reply
             Column("chatbotid", Integer, ForeignKey("chatbot.chatbotid")),
             Column("projectid", Integer, ForeignKey("project.projectid")),
             Column("userid", Integer, ForeignKey("users.userid")),
@@ -131,6 +146,18 @@ class DatabaseMgr:
             Column("updated_date", DateTime, default=func.now(), onupdate=func.now(), nullable=False),
         )
         
+        # the turns of an AI Chat conversation, in order. Appending a turn is one insert:
+        self.aichat_message_tb = Table(
+            "aichat_message",
+            self.metadata,
+            Column("aichatid", Integer, ForeignKey("aichat.aichatid"), primary_key=True),
+            Column("seq", Integer, primary_key=True),      # turn order within the conversation, from 1
+            Column("role", String, nullable=False),        # 'user' or 'assistant'
+            Column("content", String, nullable=False),     # plain text, as sent to the model
+            Column("tokens", Integer),                     # model tokens in content, when known
+            Column("created_date", DateTime, default=func.now(), nullable=False),
+        )
+        
         
         # tags are used for multiple things. They act as unique identifiers, access fences, and search terms. 
         # User roles are soon to become tags. 
@@ -144,6 +171,28 @@ class DatabaseMgr:
             Column("created_date", DateTime, default=func.now(), nullable=False),
         )
         
+        # user_role mirrors the users.roles string as one row per role held, for roles that are tags.
+        # crud.post_user() and crud.put_user() keep it in step with the string, and it is indexed 
+        # both ways so "which users hold this role" and "which roles does this user hold" are cheap: 
+        self.user_role_tb = Table(
+            "user_role",
+            self.metadata,
+            Column("userid", Integer, ForeignKey("users.userid"), primary_key=True),
+            Column("tagid", Integer, ForeignKey("tag.tagid"), primary_key=True),
+            Index("ix_user_role_tagid_userid", "tagid", "userid"),
+        )
+        
+        # memo_tag mirrors the memo.tags string the same way, one row per memo tag that is a tag. 
+        # crud.post_memo() and crud.put_memo() keep it in step with the string, and the tagid first 
+        # index answers "which memos have all of these tags" without reading the memos: 
+        self.memo_tag_tb = Table(
+            "memo_tag",
+            self.metadata,
+            Column("memoid", Integer, ForeignKey("memo.memoid"), primary_key=True),
+            Column("tagid", Integer, ForeignKey("tag.tagid"), primary_key=True),
+            Index("ix_memo_tag_tagid_memoid", "tagid", "memoid"),
+        )
+        
         self.project_tb = Table(
             "project",
             self.metadata,
@@ -156,6 +205,7 @@ class DatabaseMgr:
             Column("tagid", Integer, ForeignKey("tag.tagid")),              # tagid defining the access role for this project 
             Column("cbetagid", Integer, ForeignKey("tag.tagid")),           # tagid defining access for editing this project's chatbots
             Column("created_date", DateTime, default=func.now(), nullable=False),
+            Column("updated_date", DateTime, default=func.now(), onupdate=func.now(), nullable=False),
         )
 
         self.notes_tb = Table(
@@ -169,15 +219,30 @@ class DatabaseMgr:
             Column("created_date", DateTime, default=func.now(), nullable=False),
         )
 
+        # the action log is partitioned by month of created_date, see action_partition_ddl().
+        # Postgres requires the partition key be part of the primary key: 
         self.action_tb = Table(
             "action",
             self.metadata,
-            Column("actionid", Integer, primary_key=True),
-            Column("userid", Integer, ForeignKey("users.userid")),  # user who performed the action
+            Column("actionid", Integer, primary_key=True, autoincrement=True),
+            Column("userid", Integer, ForeignKey("users.userid"), index=True),  # user who performed the action
             Column("actionLevel", Integer, index=True),         # UserActionLevel values, nature of what they did
             Column("actionCode", Integer, index=True),          # UserAction values, what they did
             Column("description", String),                      # additional info here
-            Column("created_date", DateTime, default=func.now(), nullable=False),
+            Column("created_date", DateTime, default=func.now(), primary_key=True),
+            postgresql_partition_by="RANGE (created_date)",
+        )
+        
+        # daily counts of the action log per user, actionCode and actionLevel. Kept up to date 
+        # incrementally by the ActionLogWriter, and outlives the action log's retention window: 
+        self.action_daily_tb = Table(
+            "action_daily",
+            self.metadata,
+            Column("day", Date, primary_key=True),
+            Column("userid", Integer, primary_key=True, index=True),
+            Column("actionLevel", Integer, primary_key=True),
+            Column("actionCode", Integer, primary_key=True),
+            Column("count", Integer, nullable=False),
         )
         
         self.invite_tb = Table(
@@ -195,7 +260,100 @@ class DatabaseMgr:
         self.database = Database(get_settings().DATABASE_URL)
 
         # create db tables if they don't already exist:
+        self.unpartition_action_table()
         self.metadata.create_all(self.engine)
+        self.add_new_columns()
+        self.migrate_unpartitioned_actions()
+        self.migrate_aichat_messages()
+        self.backfill_memo_excerpts()
+        
+    # -----------------------------------------------------------------------------------------
+    # databases created before the action log was partitioned hold a plain "action" table. It is
+    # renamed out of the way, with its indexes dropped so their names are free, letting 
+    # create_all() make the partitioned table. migrate_unpartitioned_actions() moves the rows over.
+    def unpartition_action_table(self):
+        with self.engine.begin() as conn:
+            # several app workers start at once, only one at a time does this:
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {"key": ACTION_MIGRATION_LOCK})
+            relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE relname = 'action' "
+                                        "AND relnamespace = 'public'::regnamespace")).scalar()
+            if relkind == 'r':
+                print('DatabaseMgr: moving aside unpartitioned action table...')
+                conn.execute(text('ALTER TABLE action RENAME TO action_unpartitioned'))
+                conn.execute(text('ALTER TABLE action_unpartitioned RENAME CONSTRAINT action_pkey TO action_unpartitioned_pkey'))
+                conn.execute(text('DROP INDEX IF EXISTS "ix_action_actionLevel", "ix_action_actionCode"'))
+    
+    # -----------------------------------------------------------------------------------------
+    # create_all() only creates missing tables, columns added to existing tables are added here:
+    def add_new_columns(self):
+        with self.engine.begin() as conn:
+            for table, column, ddl in NEW_COLUMNS:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}'))
+            for index, table, ddl in NEW_INDEXES:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS {index} ON {table} {ddl}'))
+    
+    # -----------------------------------------------------------------------------------------
+    # ensures the action log has its current & next months' partitions, and when an older
+    # unpartitioned action table was moved aside, copies its rows into partitions covering them:
+    def migrate_unpartitioned_actions(self):
+        with self.engine.begin() as conn:
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {"key": ACTION_MIGRATION_LOCK})
+            first = date.today()
+            legacy = conn.execute(text("SELECT to_regclass('action_unpartitioned')")).scalar()
+            if legacy:
+                oldest = conn.execute(text('SELECT min(created_date) FROM action_unpartitioned')).scalar()
+                if oldest:
+                    first = min(first, oldest.date())
+            for month in action_partition_months(first, ACTION_PARTITIONS_AHEAD):
+                conn.execute(text(action_partition_ddl(month)))
+            if legacy:
+                print('DatabaseMgr: copying unpartitioned action rows...')
+                conn.execute(text('INSERT INTO action (actionid, userid, "actionLevel", "actionCode", description, created_date) '
+                                  'SELECT actionid, userid, "actionLevel", "actionCode", description, created_date '
+                                  'FROM action_unpartitioned'))
+                conn.execute(text("SELECT setval(pg_get_serial_sequence('action', 'actionid'), "
+                                  "(SELECT coalesce(max(actionid), 0) + 1 FROM action), false)"))
+                conn.execute(text('DROP TABLE action_unpartitioned'))
+            # the rollups start from whatever raw actions exist the first time they are created: 
+            rollups = conn.execute(text('SELECT 1 FROM action_daily LIMIT 1')).scalar()
+            if not rollups:
+                conn.execute(text('INSERT INTO action_daily (day, userid, "actionLevel", "actionCode", count) '
+                                  'SELECT created_date::date, userid, "actionLevel", "actionCode", count(*) '
+                                  'FROM action WHERE userid IS NOT NULL '
+                                  'GROUP BY 1, 2, 3, 4'))
+        
+    # -----------------------------------------------------------------------------------------
+    # AI Chat conversations used to be kept as one growing prompt, the turns joined by "<br><br>".
+    # The first time aichat_message exists, those prompts are split into their turns:
+    def migrate_aichat_messages(self):
+        with self.engine.begin() as conn:
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {"key": AICHAT_MESSAGE_MIGRATION_LOCK})
+            if conn.execute(text('SELECT 1 FROM aichat_message LIMIT 1')).scalar():
+                return
+            rows = conn.execute(self.aichat_tb.select().order_by(self.aichat_tb.c.aichatid)).fetchall()
+            if not rows:
+                return
+            print(f'DatabaseMgr: splitting {len(rows)} aichat prompts into messages...')
+            for r in rows:
+                turns = split_aichat_transcript(r.prompt or '', r.reply or '')
+                if turns:
+                    conn.execute(self.aichat_message_tb.insert(),
+                                 [ { "aichatid": r.aichatid, "seq": seq, "role": role, "content": content }
+                                   for seq, (role, content) in enumerate(turns, start=1) ])
+        
+    # -----------------------------------------------------------------------------------------
+    # memos written before the excerpt column existed get their excerpts once:
+    def backfill_memo_excerpts(self):
+        with self.engine.begin() as conn:
+            rows = conn.execute(select(self.memo_tb.c.memoid, self.memo_tb.c.text)
+                                .where(self.memo_tb.c.excerpt == None)).fetchall()
+            if not rows:
+                return
+            print(f'DatabaseMgr: writing excerpts of {len(rows)} memos...')
+            conn.execute(self.memo_tb.update()
+                                     .where(self.memo_tb.c.memoid == bindparam('excerptMemoid'))
+                                     .values(excerpt=bindparam('memoExcerpt')),
+                         [ { "excerptMemoid": r.memoid, "memoExcerpt": memo_excerpt(r.text) } for r in rows ])
         
     def get_db(self):
         return self.database
@@ -218,9 +376,18 @@ class DatabaseMgr:
     def get_aichat_table(self):
         return self.aichat_tb
         
+    def get_aichat_message_table(self):
+        return self.aichat_message_tb
+        
     def get_tag_table(self):
         return self.tag_tb
         
+    def get_user_role_table(self):
+        return self.user_role_tb
+        
+    def get_memo_tag_table(self):
+        return self.memo_tag_tb
+        
     def get_project_table(self):
         return self.project_tb
         
@@ -233,10 +400,134 @@ class DatabaseMgr:
     def get_action_table(self):
         return self.action_tb
         
+    def get_action_daily_table(self):
+        return self.action_daily_tb
+        
     def get_invite_table(self):
         return self.invite_tb
 
 
+# ----------------------------------------------------------------------------------------------
+# full text search: memo, comment & project rows keep a generated tsvector of their html stripped
+# text columns, weighted by column. The search_vector columns are left out of the Tables above so
+# row selects never read them, they are only used by the search queries of app.api.crud:
+SEARCH_CONFIG = 'english'
+
+def search_text_sql( column: str ) -> str:
+    return f"regexp_replace(coalesce({column}, ''), '<[^>]*>', ' ', 'g')"
+
+def tsvector_ddl( *weightedColumns ) -> str:
+    vectors = [ f"setweight(to_tsvector('{SEARCH_CONFIG}', {search_text_sql(c)}), '{w}')" for c, w in weightedColumns ]
+    return f"tsvector GENERATED ALWAYS AS ({' || '.join(vectors)}) STORED"
+
+# (table, column, type) of the columns added to tables after their creation, oldest first:
+NEW_COLUMNS = [
+    ("aichat", "summary", "VARCHAR"),
+    ("aichat", "summary_seq", "INTEGER"),
+    ("aichat", "input_tokens", "INTEGER"),
+    ("memo", "excerpt", "VARCHAR"),
+    ("projectfile", "size", "BIGINT"),
+    ("projectfile", "mimetype", "VARCHAR"),
+    ("projectfile", "checksum", "VARCHAR"),
+    ("project", "updated_date", "TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()"),
+    ("memo", "search_vector", tsvector_ddl( ("title", "A"), ("text", "B") )),
+    ("comment", "search_vector", tsvector_ddl( ("text", "B") )),
+    ("project", "search_vector", tsvector_ddl( ("name", "A"), ("text", "B") )),
+]
+
+# (index, table, definition) of the indexes over NEW_COLUMNS:
+NEW_INDEXES = [
+    ("ix_memo_search_vector", "memo", "USING GIN (search_vector)"),
+    ("ix_comment_search_vector", "comment", "USING GIN (search_vector)"),
+    ("ix_project_search_vector", "project", "USING GIN (search_vector)"),
+]
+
+MEMO_EXCERPT_LENGTH = 240
+
+# the plain text start of a memo's html, cut at a word boundary. Kept on the memo row so memo
+# listings never read the memo texts:
+def memo_excerpt( html: str ) -> str:
+    plain = re.sub(r'(?is)<(script|style)\b.*?</\1\s*>', ' ', html or '')
+    plain = unescape( re.sub(r'<[^>]*>', ' ', plain) )
+    plain = ' '.join( plain.split() )
+    if len(plain) <= MEMO_EXCERPT_LENGTH:
+        return plain
+    cut = plain[:MEMO_EXCERPT_LENGTH]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut + '...'
+
+AICHAT_MESSAGE_MIGRATION_LOCK = 7420612  # postgres advisory lock key of the aichat_message migration
+
+# an insert appending a turn to an aichat conversation, numbered after its last turn through
+# the (aichatid, seq) primary key index:
+def aichat_message_insert(aichat_message_tb, aichatid: int, role: str, content: str, tokens: int = None):
+    nextSeq = select( func.coalesce(func.max(aichat_message_tb.c.seq), 0) + 1 )\
+                .where(aichat_message_tb.c.aichatid == aichatid)\
+                .scalar_subquery()
+    return aichat_message_tb.insert().values( aichatid=aichatid, seq=nextSeq, role=role, 
+                                              content=content, tokens=tokens )
+
+# splits a legacy conversation prompt into (role, content) turns. The prompt joined question, 
+# "<br><br>", reply, "<br><br>", question and so on, where replies were stored as "<p>...</p>" 
+# with "<br>" for their newlines, so a reply can itself contain "<br><br>". A reply still on 
+# the aichat row, not yet joined into the prompt, is the last turn:
+def split_aichat_transcript(prompt: str, reply: str):
+    turns = []
+    inReply = False
+    for segment in prompt.split("<br><br>"):
+        if inReply:
+            turns[-1][1].append(segment)
+        elif segment.startswith("<p>"):
+            turns.append( ["assistant", [segment]] )
+        else:
+            turns.append( ["user", [segment]] )
+        inReply = turns[-1][0] == "assistant" and not segment.endswith("</p>")
+    if reply:
+        turns.append( ["assistant", [reply]] )
+    
+    result = []
+    for role, segments in turns:
+        content = "<br><br>".join(segments)
+        if role == "assistant":
+            if content.startswith("<p>"):
+                content = content[len("<p>"):]
+            if content.endswith("</p>"):
+                content = content[:-len("</p>")]
+            content = content.replace("<br>", "\n")
+        if content.strip():
+            result.append( (role, content) )
+    return result
+
+
+# ----------------------------------------------------------------------------------------------
+# action log partitions are named for their month, like action_y2024m03:
+ACTION_PARTITIONS_AHEAD = 2  # months of partitions created beyond the current month
+ACTION_MIGRATION_LOCK = 7420611  # postgres advisory lock key serializing action log maintenance
+
+def action_partition_name(month: date) -> str:
+    return f"action_y{month.year:04d}m{month.month:02d}"
+
+def next_month(month: date) -> date:
+    if month.month == 12:
+        return date(month.year + 1, 1, 1)
+    return date(month.year, month.month + 1, 1)
+
+# returns the first day of each month from the month holding first until 'ahead' months past today:
+def action_partition_months(first: date, ahead: int):
+    month = date(first.year, first.month, 1)
+    last = date.today().replace(day=1)
+    for i in range(ahead):
+        last = next_month(last)
+    while month <= last:
+        yield month
+        month = next_month(month)
+
+def action_partition_ddl(month: date) -> str:
+    return (f"CREATE TABLE IF NOT EXISTS {action_partition_name(month)} PARTITION OF action "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')")
+
+
 # ----------------------------------------------------------------------------------------------
 @lru_cache()
 def get_database_mgr() -> DatabaseMgr:
@@ -0,0 +1,151 @@
+# ----------------------------------------------------------------------------------------------
+# Static export of the public site: the home page and the page of each published, public access
+# memo, rendered to files under PUBLIC_EXPORT_DIR with gzip and, when brotli is installed, brotli
+# compressed copies beside them. The files are laid out as the site's urls,
+#
+#   index.html, index.html.gz, index.html.br                       for /
+#   publicmemo/{memoid}/index.html, index.html.gz, index.html.br   for /publicmemo/{memoid}
+#
+# so a front proxy serves the public site without the app, see nginx/offload.conf, as could
+# StaticFiles with html=True. crud schedules an export whenever a memo or site_config changes,
+# as every public page lists the public memos. Exports coalesce, only pages whose html changed
+# are rewritten and recompressed, and pages of memos no longer published & public are removed.
+#
+# Full rebuild, rewriting every page: python -m app.export_public
+#
+import asyncio
+import gzip
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.config import get_settings, get_base_path, log
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PAGE_FILE = "index.html"
+
+
+# ----------------------------------------------------------------------------------------------
+# the export directory, None when the export is disabled:
+def export_directory() -> Optional[Path]:
+    directory = get_settings().PUBLIC_EXPORT_DIR
+    if not directory:
+        return None
+    return get_base_path() / directory
+
+# ----------------------------------------------------------------------------------------------
+# each file is written aside then renamed into place, so the proxy never sends a partial page:
+def write_file_atomic(path: Path, content: bytes):
+    fd, temp = tempfile.mkstemp(dir=path.parent, prefix=".export-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+# ----------------------------------------------------------------------------------------------
+# writes a page's html and compressed copies into directory, returning False when the page was
+# already current:
+def write_page(directory: Path, html: bytes, force: bool = False) -> bool:
+    page = directory / PAGE_FILE
+    if not force and page.is_file() and page.read_bytes() == html:
+        return False
+    directory.mkdir(parents=True, exist_ok=True)
+    write_file_atomic( page.with_name(PAGE_FILE + ".gz"), gzip.compress(html, compresslevel=9, mtime=0) )
+    if brotli is not None:
+        write_file_atomic( page.with_name(PAGE_FILE + ".br"), brotli.compress(html, mode=brotli.MODE_TEXT) )
+    # the html last, so a page found current has its compressed copies:
+    write_file_atomic( page, html )
+    return True
+
+# ----------------------------------------------------------------------------------------------
+# exports the public site, returning the pages (written, removed):
+async def export_public_site(force: bool = False) -> Tuple[int, int]:
+    # imported here as htmlpages imports crud, which imports this module:
+    from app.api import crud
+    from app.api.htmlpages import render_home_page, render_public_memo_page
+
+    root = export_directory()
+    if root is None:
+        return 0, 0
+
+    written = 0
+    memoList = await crud.get_all_public_memos()
+    if await run_in_threadpool( write_page, root, await render_home_page(), force ):
+        written += 1
+    for m in memoList:
+        html = await render_public_memo_page( m.memoid, memoList )
+        if await run_in_threadpool( write_page, root / "publicmemo" / str(m.memoid), html, force ):
+            written += 1
+
+    # pages of memos since unpublished, made private or deleted:
+    removed = 0
+    exported = { str(m.memoid) for m in memoList }
+    memoPages = root / "publicmemo"
+    if memoPages.is_dir():
+        for page in memoPages.iterdir():
+            if page.name not in exported:
+                await run_in_threadpool( shutil.rmtree, page, True )
+                removed += 1
+    return written, removed
+
+
+# ----------------------------------------------------------------------------------------------
+# exports run one at a time in the background; changes arriving during an export are covered
+# by one more export after it:
+class PublicExporter:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.pending = False
+
+    def schedule(self):
+        if export_directory() is None:
+            return
+        self.pending = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            self.pending = False
+            try:
+                written, removed = await export_public_site()
+                log.info(f"export_public_site: {written} pages written, {removed} removed")
+            except Exception as e:
+                log.error(f"export_public_site: {e}")
+
+@lru_cache()
+def get_public_exporter() -> PublicExporter:
+    return PublicExporter()
+
+
+# ----------------------------------------------------------------------------------------------
+async def rebuild():
+    from app.db import get_database_mgr
+    db = get_database_mgr().get_db()
+    await db.connect()
+    try:
+        written, removed = await export_public_site(force=True)
+    finally:
+        await db.disconnect()
+    print(f"exported the public site to {export_directory()}: {written} pages written, {removed} removed"
+          + ("" if brotli is not None else ", brotli is not installed so no .br files"))
+
+
+if __name__ == "__main__":
+    if export_directory() is None:
+        print("PUBLIC_EXPORT_DIR is empty, the static export is disabled")
+    else:
+        asyncio.run(rebuild())
@@ -5,8 +5,11 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from app import config
 from app.db import DatabaseMgr, get_database_mgr
+from app.action_log import get_action_log_writer
+from app.aichat_relay import get_aichat_relay
+from app.cache_events import get_cache_event_listener
 from app.api import chatbot, project, memo, comment, tag, notes, ping, users_htmlpages, video
-from app.api import htmlpages, upload, backups, user_action, aichat, invite, tasks
+from app.api import htmlpages, upload, backups, user_action, aichat, invite, tasks, search
 from app.config import log
 
 # import sentry_sdk
@@ -42,11 +45,16 @@ def create_application() -> FastAPI:
     async def startup():
         db_mgr: DatabaseMgr = get_database_mgr()
         await db_mgr.get_db().connect()
+        get_action_log_writer().start()
+        get_cache_event_listener().start()
         await initialize_database_data(application)
     #     
-    # setup handler for application shutdown that disconnects the db: 
+    # setup handler for application shutdown that flushes the action log & disconnects the db: 
     @application.on_event("shutdown")
     async def shutdown():
+        await get_aichat_relay().stop()
+        await get_cache_event_listener().stop()
+        await get_action_log_writer().stop()
         db_mgr: DatabaseMgr = get_database_mgr()
         await db_mgr.get_db().disconnect()
 
@@ -84,6 +92,9 @@ def create_application() -> FastAPI:
     # install the video router into our app with a prefix & tag too:
     application.include_router(user_action.router, prefix="/user_action", tags=["user_action"])
 
+    # install the search router into our app with a prefix & tag too:
+    application.include_router(search.router, prefix="/search", tags=["search"])
+    
     # install the video router into our app with a prefix & tag too:
     application.include_router(video.router, prefix="/video", tags=["video"])
 
@@ -0,0 +1,64 @@
+# ----------------------------------------------------------------------------------------------
+# The public site, the home page and public memo pages, is the same for every anonymous visitor
+# and only changes when memos or the site_config note do. Those pages are rendered once and kept
+# PAGE_CACHE_TTL_SECONDS, bounded to the PAGE_CACHE_MAX_ENTRIES most recently used, and crud
+# clears the cache whenever a memo is posted, updated, archived or deleted, or site_config is
+# changed. Concurrent misses of one page wait on the single render in flight instead of each
+# querying the db and rendering (single-flight); a render in flight when the cache is cleared
+# still answers its waiters, but is not kept.
+#
+# The cache is per worker process: a change clears the cache of every worker through the "pages"
+# cache event, see app/cache_events.py. PAGE_CACHE_TTL_SECONDS 0 disables the cache.
+#
+import asyncio
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Awaitable, Callable, Dict, Tuple
+
+from app.config import get_settings
+
+
+# ----------------------------------------------------------------------------------------------
+class PageCache:
+    def __init__(self):
+        self.pages: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()  # key: (expires, page)
+        self.rendering: Dict[str, asyncio.Future] = {}
+        self.generation = 0     # bumped by clear(), renders begun before it are not kept
+
+    # the page at key, from the cache or else render(), shared with concurrent requests for it:
+    async def get(self, key: str, render: Callable[[], Awaitable[bytes]]) -> bytes:
+        ttl = get_settings().PAGE_CACHE_TTL_SECONDS
+        if ttl <= 0:
+            return await render()
+        entry = self.pages.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.pages.move_to_end(key)
+            return entry[1]
+        task = self.rendering.get(key)
+        if task is None:
+            task = asyncio.ensure_future(render())
+            self.rendering[key] = task
+            task.add_done_callback(partial(self.rendered, key, self.generation, ttl))
+        # shielded, so a request going away does not cancel the render others wait on:
+        return await asyncio.shield(task)
+
+    def rendered(self, key: str, generation: int, ttl: float, task: asyncio.Future):
+        if self.rendering.get(key) is task:
+            del self.rendering[key]
+        # failed renders, like a 404, are not kept:
+        if task.cancelled() or task.exception() is not None or generation != self.generation:
+            return
+        self.pages[key] = (time.monotonic() + ttl, task.result())
+        self.pages.move_to_end(key)
+        while len(self.pages) > get_settings().PAGE_CACHE_MAX_ENTRIES:
+            self.pages.popitem(last=False)
+
+    def clear(self):
+        self.generation += 1
+        self.pages.clear()
+        self.rendering.clear()
+
+@lru_cache()
+def get_page_cache() -> PageCache:
+    return PageCache()
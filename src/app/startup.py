@@ -250,6 +250,18 @@ async def initialize_database_data( app ) -> None:
     else:
         log.info(f"first AiChatRole name is '{aiChatRole.name}'")
     
+    # fill user_role from the users.roles strings if it has never been filled:
+    log.info("checking user_role is filled...")
+    count = await crud.backfill_user_roles()
+    if count > 0:
+        log.info(f"backfilled {count} user_role rows.")
+    
+    # fill memo_tag from the memo.tags strings if it has never been filled:
+    log.info("checking memo_tag is filled...")
+    count = await crud.backfill_memo_tags()
+    if count > 0:
+        log.info(f"backfilled {count} memo_tag rows.")
+    
     # look for orphaned files and directories in the project upload area:
     await check_project_uploads_for_orphans( adminUser )
         
@@ -0,0 +1,59 @@
+# ----------------------------------------------------------------------------------------------
+# Every authenticated request, each AI chat poll and video range request included, resolves its
+# JWT's username to a UserInDB. Those users are cached per worker process for
+# USER_CACHE_TTL_SECONDS, bounded to the USER_CACHE_MAX_ENTRIES most recently used, so most
+# requests skip the users query. USER_CACHE_TTL_SECONDS 0 disables the cache.
+#
+# A user's entry is dropped when crud changes their row, roles, password or email, in this
+# worker directly and in the other workers by the "user:{userid}" cache event, see
+# app/cache_events.py. The TTL bounds how long a revoked role can outlive its revocation were
+# an event lost. Callers get copies, as endpoints modify the current user before put_user().
+#
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from app.config import get_settings
+from app.api.models import UserInDB
+
+
+# ----------------------------------------------------------------------------------------------
+class UserCache:
+    def __init__(self):
+        self.users: "OrderedDict[str, Tuple[float, UserInDB]]" = OrderedDict()  # username: (expires, user)
+        self.generation = 0     # bumped by each invalidation, users read before it are not kept
+
+    def get(self, username: str) -> Optional[UserInDB]:
+        entry = self.users.get(username)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.users[username]
+            return None
+        self.users.move_to_end(username)
+        return entry[1].copy()
+
+    # keeps user, read from the db when the cache's generation was 'generation':
+    def put(self, user: UserInDB, generation: int):
+        settings = get_settings()
+        if settings.USER_CACHE_TTL_SECONDS <= 0 or generation != self.generation:
+            return
+        self.users[user.username] = (time.monotonic() + settings.USER_CACHE_TTL_SECONDS, user.copy())
+        self.users.move_to_end(user.username)
+        while len(self.users) > settings.USER_CACHE_MAX_ENTRIES:
+            self.users.popitem(last=False)
+
+    # by userid, as a renamed user is cached under their old username:
+    def invalidate(self, userid: int):
+        self.generation += 1
+        for username in [ u for u, (expires, user) in self.users.items() if user.userid == userid ]:
+            del self.users[username]
+
+    def clear(self):
+        self.generation += 1
+        self.users.clear()
+
+@lru_cache()
+def get_user_cache() -> UserCache:
+    return UserCache()
@@ -2,12 +2,19 @@ import os
 import time
 
 from celery import Celery
+from celery.signals import worker_shutdown
+from kombu.serialization import register
 
-from app.api.models import AiChatTask
+from app.api.models import AiChatTask, aichat_task_dumps, aichat_task_loads
 
-from app.config import get_settings
+from app.db import get_database_mgr, aichat_message_insert
+from app.aichat_relay import publish_aichat_message, publish_aichat_message_async
+from app.aichat_pool import get_completion_pool
+from app.aichat_cache import AICHAT_SAMPLING, aichat_cache_key, aichat_conversation, store_cached_reply
+from app.aichat_context import AiChatTurn, build_aichat_context, summary_request, count_tokens
+from app.aichat_context import CHAT_MODELS, AICHAT_MODELS
 
-import openai
+from sqlalchemy import select, and_, bindparam
 
 # ----------------------------------------------------------------------------------------------
 
@@ -17,13 +24,19 @@ logger = get_task_logger(__name__)
 
 # ----------------------------------------------------------------------------------------------
 
+# task messages are JSON, with AiChatTasks encoded by their own codec, see app/api/models.py:
+register( 'aichatjson', aichat_task_dumps, aichat_task_loads,
+          content_type='application/x-aichat-json', content_encoding='utf-8' )
+
 celery_app = Celery(__name__)
 celery_app.conf.update(
     broker_url = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379"),
     result_backend = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379"),
-    task_serializer='pickle',
-    result_serializer='pickle',
-    accept_content=['json','pickle']
+    task_serializer='aichatjson',
+    result_serializer='json',
+    accept_content=['json','aichatjson'],
+    result_accept_content=['json'],
+    result_expires=3600,                # replies are in the db, results are only kept an hour 
 )
 # ----------------------------------------------------------------------------------------------
 
@@ -33,13 +46,98 @@ def create_task(task_type):
     return True
 
 # ----------------------------------------------------------------------------------------------
+# AI chat completions share one asyncio pool per worker process, run the worker with 
+# "--pool threads" so many tasks can wait on their completions at once:
+@worker_shutdown.connect
+def stop_completion_pool(**kwargs):
+    get_completion_pool().stop()
+
+# ----------------------------------------------------------------------------------------------
+# replies are plain text from the model, shown as html on the aichat row:
+def aichat_reply_html( text: str ) -> str:
+    return "<p>" + text.replace("\n", "<br>") + "</p>"
+
+# ----------------------------------------------------------------------------------------------
+# an aichat's conversation turns in order, with its rolling summary and the last turn it covers:
+def load_aichat_conversation( aichatid: int ):
+    db_mgr = get_database_mgr()
+    aichat_tb = db_mgr.get_aichat_table()
+    msg_tb = db_mgr.get_aichat_message_table()
+    with db_mgr.engine.connect() as conn:
+        rows = conn.execute( select(msg_tb.c.seq, msg_tb.c.role, msg_tb.c.content, msg_tb.c.tokens)
+                             .where(msg_tb.c.aichatid == aichatid)
+                             .order_by(msg_tb.c.seq) ).fetchall()
+        summary = conn.execute( select(aichat_tb.c.summary, aichat_tb.c.summary_seq)
+                                .where(aichat_tb.c.aichatid == aichatid) ).first()
+    turns = [ AiChatTurn(r.seq, r.role, r.content, r.tokens) for r in rows ]
+    return turns, summary.summary, summary.summary_seq or 0
+
+# ----------------------------------------------------------------------------------------------
+# keeps the token counts of newly counted turns, so each turn is only counted once:
+def save_turn_tokens( aichatid: int, turns ):
+    if not turns:
+        return
+    db_mgr = get_database_mgr()
+    msg_tb = db_mgr.get_aichat_message_table()
+    query = msg_tb.update()\
+                  .where(and_(msg_tb.c.aichatid == aichatid, msg_tb.c.seq == bindparam('turnSeq')))\
+                  .values(tokens=bindparam('turnTokens'))
+    with db_mgr.engine.begin() as conn:
+        conn.execute( query, [ {"turnSeq": t.seq, "turnTokens": t.tokens} for t in turns ] )
+
+# ----------------------------------------------------------------------------------------------
+def save_aichat_summary( aichatid: int, summary: str, summarySeq: int ):
+    db_mgr = get_database_mgr()
+    aichat_tb = db_mgr.get_aichat_table()
+    with db_mgr.engine.begin() as conn:
+        conn.execute( aichat_tb.update()
+                               .where(aichat_tb.c.aichatid == aichatid)
+                               .values(summary=summary, summary_seq=summarySeq) )
+
+# ----------------------------------------------------------------------------------------------
+# the worker writes each finished exchange straight to its aichat row, through the sync engine,
+# so the web app's readers only ever read the db and never the Celery result backend. A reply
+# is also appended to the conversation as its assistant turn:
+def save_aichat_result( aichatid: int, reply: str, status: str, replyText: str = None, 
+                        inputTokens: int = None, replyTokens: int = None ):
+    db_mgr = get_database_mgr()
+    aichat_tb = db_mgr.get_aichat_table()
+    with db_mgr.engine.begin() as conn:
+        conn.execute( aichat_tb.update()
+                               .where(aichat_tb.c.aichatid == aichatid)
+                               .values(reply=reply, status=status, input_tokens=inputTokens) )
+        if replyText is not None:
+            conn.execute( aichat_message_insert(db_mgr.get_aichat_message_table(), aichatid, 
+                                                'assistant', replyText, replyTokens) )
 
-openai.api_key = get_settings().OPENAI_API_KEY
+# ----------------------------------------------------------------------------------------------
+# the context sent for the conversation's next reply: the most recent turns within the model's
+# token budget, with the turns before them folded into the aichat's rolling summary:
+def assemble_aichat_context( aichat_task: AiChatTask, turns, summary, summarySeq ):
+    uncounted = [ t for t in turns if t.tokens is None ]
+    context = build_aichat_context( aichat_task.model, aichat_task.prePrompt, turns, summary, summarySeq )
+    save_turn_tokens( aichat_task.aichatid, uncounted )
+    
+    if context.unsummarized:
+        pool = get_completion_pool()
+        try:
+            request = summary_request( aichat_task.model, summary, context.unsummarized )
+            summary = pool.run( pool.complete( aichat_task.model, request ) ).strip(" \n")
+        except Exception as e:
+            # without a new summary the dropped turns are simply left out of this reply's context:
+            logger.info(f"OpenAI_Comm: aichatid {aichat_task.aichatid} summary failed, {e}")
+            return context
+        summarySeq = context.unsummarized[-1].seq
+        save_aichat_summary( aichat_task.aichatid, summary, summarySeq )
+        logger.info(f"OpenAI_Comm: aichatid {aichat_task.aichatid} summarized through turn {summarySeq}")
+        context = build_aichat_context( aichat_task.model, aichat_task.prePrompt, turns, summary, summarySeq )
+    
+    return context
 
 # ----------------------------------------------------------------------------------------------
 
 @celery_app.task(name="OpenAI_Comm")
-def OpenAI_Comm( aichat_task: AiChatTask ) -> AiChatTask:
+def OpenAI_Comm( aichat_task: AiChatTask ) -> dict:
     
     logger.info("OpenAI_Comm: we are in!")
     logger.info(f"OpenAI_Comm: aichat_task.aichatid '{aichat_task.aichatid}'")
@@ -61,35 +159,53 @@ def OpenAI_Comm( aichat_task: AiChatTask ) -> AiChatTask:
     # '''
     prePrompt = aichat_task.prePrompt
     
-    aiResponse = None
-    if aichat_task.model=="text-davinci-003":        
-        aiResponse = openai.Completion.create(model=aichat_task.model, 
-                                              prompt= prePrompt + " \n" + aichat_task.prompt,
-                                              temperature=0,
-                                              max_tokens=900,
-                                              top_p=1,
-                                              frequency_penalty=0.0,
-                                              presence_penalty=0.0,
-                                        )["choices"][0]["text"].strip(" \n")
+    # the reply is requested as a stream, each token is relayed to the browser as it arrives:
+    async def relay_token( token: str ):
+        await publish_aichat_message_async( aichat_task.aichatid, {"token": token} )
     
-    elif aichat_task.model=="gpt-3.5-turbo" or aichat_task.model=="gpt-4":
-        aiResponse = openai.ChatCompletion.create( model=aichat_task.model,
-                                                   messages=[ {"role": "system", "content": prePrompt },
-                                                              {"role": "user", "content": aichat_task.prompt } ],
-                                                   temperature=0,
-                                                   max_tokens=900,
-                                                   top_p=1,
-                                                   frequency_penalty=0.0,
-                                                   presence_penalty=0.0,
-                                                )['choices'][0]['message']['content']
+    # the conversation so far, its last turn is the question to answer:
+    turns, summary, summarySeq = load_aichat_conversation( aichat_task.aichatid )
+    
+    started = time.monotonic()
+    try:
+        # launch_aichat_task() rejects other models, this task may have been queued before:
+        if aichat_task.model not in AICHAT_MODELS:
+            raise ValueError(f"unknown or unsupported model '{aichat_task.model}'")
+        
+        context = assemble_aichat_context( aichat_task, turns, summary, summarySeq )
+        if aichat_task.model in CHAT_MODELS:
+            body = { "messages": context.messages }
+        else:
+            body = { "prompt": context.prompt() }
+        
+        body.update( AICHAT_SAMPLING )
+        pool = get_completion_pool()
+        aiResponse = pool.run( pool.complete( aichat_task.model, body, relay_token ) ).strip(" \n")
+        # an empty assistant turn would be sent back in every later context:
+        if not aiResponse:
+            raise ValueError("empty reply")
+    except Exception as e:
+        logger.info(f"OpenAI_Comm: aichatid {aichat_task.aichatid} failed, {e}")
+        save_aichat_result( aichat_task.aichatid, aichat_task.reply, 'failed' )
+        publish_aichat_message( aichat_task.aichatid, {"status": 'failed'} )
+        raise
     
     # communication with OpenAI complete, save results:
-    aichat_task.reply = aiResponse 
+    aichat_task.reply = aichat_reply_html( aiResponse )
     aichat_task.status = 'ready'
+    inputTokens = context.inputTokens
+    replyTokens = count_tokens( aichat_task.model, aiResponse )
+    save_aichat_result( aichat_task.aichatid, aichat_task.reply, aichat_task.status, aiResponse, inputTokens, replyTokens )
+    publish_aichat_message( aichat_task.aichatid, {"status": aichat_task.status} )
+    conversation = aichat_conversation( (t.role, t.content) for t in turns )
+    store_cached_reply( aichat_cache_key(aichat_task.model, prePrompt, conversation), aiResponse )
+    
+    logger.info(f"OpenAI_Comm: aichatid {aichat_task.aichatid}, {inputTokens} input tokens, "
+                f"{len(turns)} turns, {time.monotonic() - started:.2f}s")
        
     logger.info(f"OpenAI_Comm: reply '{aichat_task.reply}'")
     
-    # task is done:
-    return aichat_task
+    # task is done, the reply is already in the db so the result is only what identifies it:
+    return { "aichatid": aichat_task.aichatid, "status": aichat_task.status, "reply": aichat_task.reply }
 
 # ----------------------------------------------------------------------------------------------
@@ -0,0 +1,41 @@
+# ----------------------------------------------------------------------------------------------
+# Benchmark of AI chats per second through one CompletionPool, against a local stub of OpenAI
+# answering each chat with 'tokens' tokens over 'latency' seconds.
+#
+# Run from src/: python -m tests.bench_aichat_pool
+#
+import asyncio
+import json
+import time
+
+import httpx
+
+from app.aichat_pool import CompletionPool
+
+
+# ----------------------------------------------------------------------------------------------
+# benchmark: chats per second through one pool, against a stub OpenAI answering each chat with
+# 'tokens' tokens over 'latency' seconds:
+def benchmark(chats: int = 200, concurrency: int = 32, tokens: int = 20, latency: float = 0.5):
+    async def stub(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        lines = [ "data: " + json.dumps({"choices": [{"delta": {"content": f"t{i} "}}]}) for i in range(tokens) ]
+        lines.append("data: [DONE]")
+        return httpx.Response(200, content="\n\n".join(lines).encode())
+
+    pool = CompletionPool( "http://stub", "key", concurrency, 0, transport=httpx.MockTransport(stub) )
+    body = { "messages": [ {"role": "user", "content": "hello"} ] }
+
+    async def all_chats():
+        await asyncio.gather( *[ pool.complete("gpt-4", body) for _ in range(chats) ] )
+
+    start = time.perf_counter()
+    pool.run( all_chats() )
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    print( f"{chats} chats, {concurrency} at once, {latency}s each: "
+           f"{elapsed:.2f}s, {chats / elapsed:.1f} chats per second per worker process" )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,68 @@
+# ----------------------------------------------------------------------------------------------
+# Benchmark of MB per second sending a 'megabytes' file, whole and as 4 MB ranges, through the
+# previous StreamingResponse of a 10,000 byte generator and through fileserve.file_response(),
+# to an ASGI send that discards the body.
+#
+# Run from src/: python -m tests.bench_fileserve
+#
+import asyncio
+import os
+import tempfile
+import time
+
+from fastapi import Request
+from starlette.responses import StreamingResponse
+
+from app.api.fileserve import file_response
+
+
+# ----------------------------------------------------------------------------------------------
+# benchmark: MB per second sending a 'megabytes' file, whole and as 4 MB ranges, through the
+# previous StreamingResponse of a 10,000 byte generator and through file_response(), to an
+# ASGI send that discards the body:
+def benchmark(megabytes: int = 256, rounds: int = 3):
+    def legacy_generator(path, start, end, chunk_size=10_000):
+        with open(path, "rb") as f:
+            f.seek(start)
+            while (pos := f.tell()) <= end:
+                yield f.read(min(chunk_size, end + 1 - pos))
+
+    async def drive(response) -> int:
+        sent = 0
+        async def receive():
+            # the client never disconnects:
+            await asyncio.Event().wait()
+        async def send(message):
+            nonlocal sent
+            sent += len(message.get("body", b""))
+        await response({"type": "http", "extensions": {}}, receive, send)
+        return sent
+
+    def request(rangeHeader=None):
+        headers = [(b"range", rangeHeader.encode())] if rangeHeader else []
+        return Request({"type": "http", "method": "GET", "headers": headers})
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(1024*1024) * megabytes)
+        f.flush()
+        size = megabytes * 1024*1024
+        ranges = [ (s, min(s + 4*1024*1024, size) - 1) for s in range(0, size, 4*1024*1024) ]
+
+        cases = {
+            "generator, whole": lambda: [ StreamingResponse(legacy_generator(f.name, 0, size - 1)) ],
+            "file_response, whole": lambda: [ file_response(request(), f.name) ],
+            "generator, 4MB ranges": lambda: [ StreamingResponse(legacy_generator(f.name, s, e)) for s, e in ranges ],
+            "file_response, 4MB ranges": lambda: [ file_response(request(f"bytes={s}-{e}"), f.name) for s, e in ranges ],
+        }
+        for name, responses in cases.items():
+            best = None
+            for r in range(rounds):
+                start = time.perf_counter()
+                sent = sum( asyncio.run(drive(response)) for response in responses() )
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{name:>28}: {sent / best / 1e6:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    benchmark()
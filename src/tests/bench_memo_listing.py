@@ -0,0 +1,98 @@
+# ----------------------------------------------------------------------------------------------
+# Benchmark of memo listings over 'memos' generated memos of public, staff and admin access, as
+# an admin, a project member and an unverified member, comparing the single access filtered
+# query, crud.memo_access_query(), against the former listing, which checked
+# user_has_memo_access() per memo with a project and a tag query for each memo that is not
+# public. Reports the statements each issues and their latency.
+#
+# Run from src/ against a db with at least one user: python -m tests.bench_memo_listing
+# The memos are written inside a transaction that is rolled back, leaving the db as it was.
+#
+import statistics
+import time
+
+from sqlalchemy import event, text
+
+from app.api import crud
+from app.api.models import UserInDB
+from app.api.users import get_principal
+from app.db import get_database_mgr
+
+
+# ----------------------------------------------------------------------------------------------
+def benchmark(memos: int = 10000, repeats: int = 5):
+    db_mgr = get_database_mgr()
+    memo_tb = db_mgr.get_memo_table()
+    proj_tb = db_mgr.get_project_table()
+    tag_tb = db_mgr.get_tag_table()
+
+    def per_row_access(conn, user, m) -> bool:
+        principal = get_principal(user)
+        if principal.is_admin or m.access == 'public':
+            return True
+        if principal.is_unverified:
+            return False
+        proj = conn.execute(proj_tb.select().where(proj_tb.c.projectid == m.projectid)).first()
+        tag = proj and conn.execute(tag_tb.select().where(tag_tb.c.tagid == proj.tagid)).first()
+        if not tag or not crud.user_has_project_access(user, proj, tag):
+            return False
+        if m.status == 'published':
+            return m.access == 'staff'
+        return m.userid == user.userid
+
+    def per_row_listing(conn, user):
+        memoList = conn.execute(memo_tb.select().order_by(memo_tb.c.memoid)).fetchall()
+        return [ crud.decorated_memo(m) for m in memoList if per_row_access(conn, user, m) ]
+
+    def single_query_listing(conn, user):
+        return [ crud.decorated_memo(m) for m in conn.execute(crud.memo_access_query(user)).fetchall() ]
+
+    with db_mgr.engine.connect() as conn:
+        statements = [0]
+        @event.listens_for(conn, "before_cursor_execute")
+        def count_statement(*args):
+            statements[0] += 1
+
+        trans = conn.begin()
+        try:
+            owner = conn.execute(text('SELECT userid, username FROM users ORDER BY userid LIMIT 1')).first()
+            tagid = conn.execute(text("INSERT INTO tag (text, created_date) VALUES ('memobench', now()) RETURNING tagid")).scalar()
+            projectid = conn.execute(text(
+                "INSERT INTO project (userid, username, name, text, status, tagid, created_date, updated_date) "
+                "VALUES (:userid, :username, 'memobench', 'memo benchmark', 'published', :tagid, now(), now()) "
+                "RETURNING projectid"), {"userid": owner.userid, "username": owner.username, "tagid": tagid}).scalar()
+            conn.execute(text(
+                "INSERT INTO memo (userid, username, projectid, title, text, status, access, tags, "
+                "                  excerpt, created_date, updated_date) "
+                "SELECT :userid, :username, :projectid, 'memo ' || i, '<p>memo ' || i || '</p>', "
+                "       CASE WHEN i % 5 = 0 THEN 'unpublished' ELSE 'published' END, "
+                "       (ARRAY['public', 'staff', 'admin'])[1 + i % 3], '', 'memo ' || i, now(), now() "
+                "FROM generate_series(1, :memos) AS i"),
+                {"userid": owner.userid, "username": owner.username, "projectid": projectid, "memos": memos})
+            conn.execute(text('ANALYZE memo'))
+            total = conn.execute(text('SELECT count(*) FROM memo')).scalar()
+            print(f"{memos} memos written, {total} in all")
+
+            admin = UserInDB.construct(userid=owner.userid, username=owner.username, roles='admin')
+            member = UserInDB.construct(userid=-1, username='memobench', roles='staff memobench')
+            unverified = UserInDB.construct(userid=-2, username='memobench2', roles='staff memobench unverified')
+            for who, user in (('admin', admin), ('member', member), ('unverified', unverified)):
+                for name, listing in (('single query', single_query_listing), ('per row', per_row_listing)):
+                    times = []
+                    for r in range(repeats):
+                        statements[0] = 0
+                        start = time.perf_counter()
+                        memoList = listing(conn, user)
+                        times.append((time.perf_counter() - start) * 1000.0)
+                    print(f"{who:>10} {name:>12}: {len(memoList):>6} memos, {statements[0]:>6} statements, "
+                          f"median {statistics.median(times):8.1f}ms, max {max(times):8.1f}ms")
+                if [ m.memoid for m in single_query_listing(conn, user) ] != [ m.memoid for m in per_row_listing(conn, user) ]:
+                    print(f"{who:>10}: the single query and per row listings differ")
+        finally:
+            trans.rollback()
+
+
+
+
+if __name__ == "__main__":
+    benchmark()
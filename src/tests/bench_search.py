@@ -0,0 +1,73 @@
+# ----------------------------------------------------------------------------------------------
+# Benchmark of the full text search queries, crud.search_query(), against 100k generated memos,
+# as an admin and as a project member whose results are access filtered.
+#
+# Run from src/ against a db with at least one user: python -m tests.bench_search
+# The memos are written inside a transaction that is rolled back, leaving the db as it was.
+#
+import statistics
+import time
+
+from sqlalchemy import text
+
+from app.api import crud
+from app.api.models import UserInDB
+from app.db import get_database_mgr
+
+
+# ----------------------------------------------------------------------------------------------
+# benchmark: search query times over 'memos' generated memos, as an admin and as a project member
+# whose results are access filtered:
+def benchmark(memos: int = 100000, repeats: int = 20):
+    words = [ 'lease', 'contract', 'tenant', 'landlord', 'deposit', 'court', 'hearing', 'motion',
+              'settlement', 'estate', 'trust', 'probate', 'custody', 'appeal', 'damages', 'witness',
+              'evidence', 'claim', 'insurance', 'liability', 'notice', 'eviction', 'payment', 'invoice',
+              'meeting', 'schedule', 'draft', 'review', 'client', 'filing', 'deadline', 'discovery' ]
+    searches = [ 'eviction notice', 'probate', '"tenant deposit"', 'custody -appeal', 'zzzunmatched' ]
+
+    db_mgr = get_database_mgr()
+    with db_mgr.engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            owner = conn.execute(text('SELECT userid, username FROM users ORDER BY userid LIMIT 1')).first()
+            tagid = conn.execute(text("INSERT INTO tag (text, created_date) VALUES ('searchbench', now()) RETURNING tagid")).scalar()
+            projectid = conn.execute(text(
+                "INSERT INTO project (userid, username, name, text, status, tagid, created_date, updated_date) "
+                "VALUES (:userid, :username, 'searchbench', 'search benchmark', 'published', :tagid, now(), now()) "
+                "RETURNING projectid"), {"userid": owner.userid, "username": owner.username, "tagid": tagid}).scalar()
+
+            start = time.perf_counter()
+            conn.execute(text(
+                "INSERT INTO memo (userid, username, projectid, title, text, status, access, tags, "
+                "                  excerpt, created_date, updated_date) "
+                "SELECT :userid, :username, :projectid, "
+                "       (SELECT string_agg(w[1 + (random() * 31)::int], ' ') FROM generate_series(1, 4 + i % 2)), "
+                "       '<p>' || (SELECT string_agg(w[1 + (random() * 31)::int], ' ') FROM generate_series(1, 150 + i % 2)) || '</p>', "
+                "       CASE WHEN i % 10 = 0 THEN 'unpublished' ELSE 'published' END, "
+                "       (ARRAY['staff', 'staff', 'public', 'admin'])[1 + i % 4], '', '', now(), now() "
+                "FROM generate_series(1, :memos) AS i, (SELECT CAST(:words AS varchar[]) AS w) AS vocabulary"),
+                {"userid": owner.userid, "username": owner.username, "projectid": projectid,
+                 "memos": memos, "words": words})
+            conn.execute(text("SELECT gin_clean_pending_list('ix_memo_search_vector')"))
+            conn.execute(text('ANALYZE memo'))
+            print(f"{memos} memos written and indexed in {time.perf_counter() - start:.1f}s")
+
+            admin = UserInDB.construct(userid=owner.userid, username=owner.username, roles='admin')
+            member = UserInDB.construct(userid=-1, username='searchbench', roles='user searchbench')
+            for who, user in (('admin', admin), ('member', member)):
+                for terms in searches:
+                    query = crud.search_query(user, terms)
+                    times = []
+                    for r in range(repeats):
+                        start = time.perf_counter()
+                        rows = conn.execute(query).fetchall()
+                        times.append((time.perf_counter() - start) * 1000.0)
+                    times.sort()
+                    print(f"{who:>6} {terms!r:>20}: {len(rows):>3} rows, median {statistics.median(times):6.1f}ms, "
+                          f"p95 {times[int(len(times) * 0.95) - 1]:6.1f}ms")
+        finally:
+            trans.rollback()
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,116 @@
+import asyncio
+
+from app import action_log
+from app.action_log import ActionLogWriter
+
+NORMAL = 1
+WARNING = 3
+
+# ----------------------------------------------------------------------------------------------
+# an ActionLogWriter whose database writes are captured in a list instead:
+def make_writer(monkeypatch, written, **kwargs) -> ActionLogWriter:
+    settings = { "batchSize": 10, "flushSeconds": 60.0, "maxQueued": 10,
+                 "sampleRates": {}, "droppableLevels": {NORMAL} }
+    settings.update(kwargs)
+    writer = ActionLogWriter(**settings)
+
+    async def mock_write_batch(batch):
+        written.append(batch)
+
+    async def mock_write_counts():
+        pass
+
+    monkeypatch.setattr(writer, "write_batch", mock_write_batch)
+    monkeypatch.setattr(writer, "write_counts", mock_write_counts)
+    return writer
+
+# ----------------------------------------------------------------------------------------------
+def test_actions_are_queued_and_flushed_as_one_batch(monkeypatch):
+    written = []
+
+    async def run():
+        writer = make_writer(monkeypatch, written)
+        writer.running = True
+        for i in range(5):
+            await writer.remember(1, NORMAL, i, "read")
+        assert written == []
+        await writer.flush()
+
+    asyncio.run(run())
+    assert len(written) == 1
+    assert [row["actionCode"] for row in written[0]] == [0, 1, 2, 3, 4]
+
+# ----------------------------------------------------------------------------------------------
+def test_sampling_keeps_one_in_n(monkeypatch):
+    written = []
+
+    async def run():
+        writer = make_writer(monkeypatch, written, sampleRates={NORMAL: 3}, maxQueued=100)
+        writer.running = True
+        for i in range(9):
+            await writer.remember(1, NORMAL, i, "read")
+        await writer.remember(1, WARNING, 99, "warned")
+        await writer.flush()
+        return writer
+
+    writer = asyncio.run(run())
+    codes = [row["actionCode"] for batch in written for row in batch]
+    assert codes == [0, 3, 6, 99]
+    assert writer.sampledOut == 6
+
+# ----------------------------------------------------------------------------------------------
+def test_full_queue_drops_normal_and_flushes_for_others(monkeypatch):
+    written = []
+
+    async def run():
+        writer = make_writer(monkeypatch, written, batchSize=2, maxQueued=2)
+        writer.running = True
+        await writer.remember(1, NORMAL, 0, "read")
+        await writer.remember(1, NORMAL, 1, "read")
+        await writer.remember(1, NORMAL, 2, "dropped")
+        await writer.remember(1, WARNING, 3, "kept")
+        await writer.flush()
+        return writer
+
+    writer = asyncio.run(run())
+    codes = [row["actionCode"] for batch in written for row in batch]
+    assert codes == [0, 1, 3]
+    assert writer.dropped == 1
+
+# ----------------------------------------------------------------------------------------------
+def test_dropped_and_sampled_actions_still_count_in_rollups(monkeypatch):
+    written = []
+
+    async def run():
+        writer = make_writer(monkeypatch, written, sampleRates={NORMAL: 2}, batchSize=1, maxQueued=1)
+        writer.running = True
+        for i in range(4):
+            await writer.remember(7, NORMAL, 5, "read")
+        return writer
+
+    writer = asyncio.run(run())
+    assert list(writer.counts.values()) == [4]
+    key = list(writer.counts.keys())[0]
+    assert key[1:] == (7, NORMAL, 5)
+
+# ----------------------------------------------------------------------------------------------
+# the writer is a process singleton, so it may be started again on another event loop, as each
+# TestClient's startup does:
+def test_writer_restarts_on_a_new_event_loop(monkeypatch):
+    written = []
+    writer = make_writer(monkeypatch, written, batchSize=1, flushSeconds=0.01)
+
+    async def mock_maintain_action_partitions(retentionMonths):
+        pass
+
+    monkeypatch.setattr(action_log, "maintain_action_partitions", mock_maintain_action_partitions)
+
+    async def run(code):
+        writer.start()
+        await writer.remember(1, NORMAL, code, "read")
+        await asyncio.sleep(0.05)
+        await writer.stop()
+
+    asyncio.run(run(0))
+    asyncio.run(run(1))
+    assert [row["actionCode"] for batch in written for row in batch] == [0, 1]
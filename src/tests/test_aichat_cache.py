@@ -0,0 +1,14 @@
+from app.aichat_cache import AICHAT_SAMPLING, aichat_cache_key
+
+# ----------------------------------------------------------------------------------------------
+def test_cache_key_depends_on_every_input():
+    key = aichat_cache_key("gpt-4", "You are helpful.", "hello")
+    assert key == aichat_cache_key("gpt-4", "You are helpful.", "hello")
+    assert key != aichat_cache_key("gpt-3.5-turbo", "You are helpful.", "hello")
+    assert key != aichat_cache_key("gpt-4", "You are terse.", "hello")
+    assert key != aichat_cache_key("gpt-4", "You are helpful.", "hello!")
+    assert key != aichat_cache_key("gpt-4", "You are helpful.", "hello", dict(AICHAT_SAMPLING, max_tokens=100))
+
+# ----------------------------------------------------------------------------------------------
+def test_sampled_requests_are_not_cached():
+    assert aichat_cache_key("gpt-4", "p", "q", dict(AICHAT_SAMPLING, temperature=0.7)) is None
@@ -0,0 +1,22 @@
+from app.aichat_context import AiChatTurn, build_aichat_context, context_budget
+
+# ----------------------------------------------------------------------------------------------
+def test_context_keeps_newest_turns_within_budget():
+    budget = context_budget("gpt-4")
+    turns = [ AiChatTurn(seq, "user" if seq % 2 else "assistant", "x", budget // 4) for seq in range(1, 11) ]
+    context = build_aichat_context("gpt-4", "You are helpful.", turns)
+
+    kept = context.messages[1:]
+    assert 0 < len(kept) < len(turns)
+    assert context.inputTokens <= budget
+    assert [ t.seq for t in context.unsummarized ] == list(range(1, len(turns) - len(kept) + 1))
+
+# ----------------------------------------------------------------------------------------------
+def test_summary_covers_dropped_turns():
+    budget = context_budget("gpt-4")
+    turns = [ AiChatTurn(seq, "user", "x", budget // 4) for seq in range(1, 11) ]
+    context = build_aichat_context("gpt-4", "You are helpful.", turns, "earlier talk", summarySeq=10)
+
+    assert context.unsummarized == []
+    assert "earlier talk" in context.messages[1]["content"]
+    assert context.messages[-1]["content"] == "x"
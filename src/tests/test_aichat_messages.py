@@ -0,0 +1,15 @@
+from app.db import split_aichat_transcript
+
+# ----------------------------------------------------------------------------------------------
+def test_legacy_prompt_splits_into_alternating_turns():
+    prompt = "What is x?<br><br><p>X is<br><br>a thing</p><br><br>And y?"
+    assert split_aichat_transcript(prompt, "<p>Y is<br>other</p>") == [
+        ("user", "What is x?"),
+        ("assistant", "X is\n\na thing"),
+        ("user", "And y?"),
+        ("assistant", "Y is\nother"),
+    ]
+
+# ----------------------------------------------------------------------------------------------
+def test_unanswered_question_is_one_turn():
+    assert split_aichat_transcript("hello", "") == [("user", "hello")]
@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import httpx
+
+from app.aichat_pool import CompletionPool, CompletionError
+
+# ----------------------------------------------------------------------------------------------
+# a stub of OpenAI's streamed chat completions, answering 'failures' with status first:
+def make_stub(reply, failures=(), latency=0.0, stats=None):
+    stats = stats if stats is not None else {}
+    stats.update(calls=0, inFlight=0, maxInFlight=0)
+    failures = list(failures)
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        stats["calls"] += 1
+        if failures:
+            return httpx.Response(failures.pop(0), content=b"busy")
+        stats["inFlight"] += 1
+        stats["maxInFlight"] = max(stats["maxInFlight"], stats["inFlight"])
+        await asyncio.sleep(latency)
+        stats["inFlight"] -= 1
+        assert json.loads(request.content)["stream"] is True
+        lines = [ "data: " + json.dumps({"choices": [{"delta": {"content": t}}]}) for t in reply ]
+        lines.append("data: [DONE]")
+        return httpx.Response(200, content="\n\n".join(lines).encode())
+
+    return httpx.MockTransport(handler)
+
+def make_pool(transport, **kwargs) -> CompletionPool:
+    settings = { "maxConcurrencyPerModel": 4, "maxRetries": 3, "backoffSeconds": 0.001 }
+    settings.update(kwargs)
+    return CompletionPool( "http://stub", "key", transport=transport, **settings )
+
+BODY = { "messages": [ {"role": "user", "content": "hello"} ] }
+
+# ----------------------------------------------------------------------------------------------
+def test_tokens_are_relayed_and_joined():
+    pool = make_pool( make_stub(["Hel", "lo", "!"]) )
+    relayed = []
+
+    async def on_token(token):
+        relayed.append(token)
+
+    try:
+        assert pool.run( pool.complete("gpt-4", BODY, on_token) ) == "Hello!"
+    finally:
+        pool.stop()
+    assert relayed == ["Hel", "lo", "!"]
+
+# ----------------------------------------------------------------------------------------------
+def test_429_and_5xx_are_retried():
+    stats = {}
+    pool = make_pool( make_stub(["ok"], failures=[429, 503], stats=stats) )
+    try:
+        assert pool.run( pool.complete("gpt-4", BODY) ) == "ok"
+    finally:
+        pool.stop()
+    assert stats["calls"] == 3
+    assert pool.retried == 2
+
+# ----------------------------------------------------------------------------------------------
+def test_client_errors_are_not_retried():
+    stats = {}
+    pool = make_pool( make_stub(["ok"], failures=[400], stats=stats) )
+    try:
+        pool.run( pool.complete("gpt-4", BODY) )
+        assert False, "expected a CompletionError"
+    except CompletionError as e:
+        assert e.status == 400
+    finally:
+        pool.stop()
+    assert stats["calls"] == 1
+
+# ----------------------------------------------------------------------------------------------
+def test_concurrency_is_limited_per_model():
+    stats = {}
+    pool = make_pool( make_stub(["ok"], latency=0.02, stats=stats), maxConcurrencyPerModel=2 )
+
+    async def many():
+        return await asyncio.gather( *[ pool.complete("gpt-4", BODY) for _ in range(6) ] )
+
+    try:
+        assert pool.run( many() ) == ["ok"] * 6
+    finally:
+        pool.stop()
+    assert stats["maxInFlight"] == 2
@@ -0,0 +1,30 @@
+import asyncio
+
+from app.aichat_relay import AiChatRelay
+
+# ----------------------------------------------------------------------------------------------
+# an AiChatRelay whose Redis subscription is replaced by one that goes live at once:
+def make_relay(monkeypatch) -> AiChatRelay:
+    relay = AiChatRelay("redis://unused")
+
+    async def mock_listen():
+        relay.subscribed.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(relay, "listen", mock_listen)
+    return relay
+
+# ----------------------------------------------------------------------------------------------
+# the relay is a process singleton, so it may serve streams on another event loop, as each
+# TestClient's startup makes:
+def test_relay_subscribes_again_on_a_new_event_loop(monkeypatch):
+    relay = make_relay(monkeypatch)
+
+    async def stream(aichatid):
+        queue = await asyncio.wait_for(relay.subscribe(aichatid), timeout=1.0)
+        relay.unsubscribe(aichatid, queue)
+        return relay.subscribers
+
+    assert asyncio.run(stream(7)) == {}
+    # the first loop closed without stop(), cancelling its listen task:
+    assert asyncio.run(stream(8)) == {}
@@ -0,0 +1,22 @@
+import pytest
+
+from app.api.models import AiChatTask, aichat_task_dumps, aichat_task_loads
+
+# ----------------------------------------------------------------------------------------------
+def test_aichat_task_round_trips_inside_celery_message():
+    task = AiChatTask( prePrompt="You are helpful.", prompt="hello<br><br>again", reply="",
+                       model="gpt-4", status="inuse", taskid="abc-123", aichatid=7 )
+    
+    message = aichat_task_loads( aichat_task_dumps( [[task], {}, {"callbacks": None}] ) )
+    
+    decoded = message[0][0]
+    assert isinstance(decoded, AiChatTask)
+    assert [getattr(decoded, name) for name in AiChatTask.__slots__] == \
+           [getattr(task, name) for name in AiChatTask.__slots__]
+    assert message[1:] == [{}, {"callbacks": None}]
+
+# ----------------------------------------------------------------------------------------------
+def test_aichat_task_has_no_instance_dict():
+    task = AiChatTask( "p", "q", "", "gpt-4", "inuse", "abc", 1 )
+    with pytest.raises(AttributeError):
+        task.extra = 1
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from app import worker
+from app.api.models import AiChatTask
+from app.aichat_context import AiChatTurn
+
+# ----------------------------------------------------------------------------------------------
+# OpenAI_Comm with the db, the relay and OpenAI replaced, its saved results kept in saved:
+def run_task(monkeypatch, model, reply, saved):
+    turns = [ AiChatTurn(seq=1, role='user', content='hello', tokens=None) ]
+
+    class Pool:
+        def run(self, coro):
+            return asyncio.run(coro)
+        async def complete(self, model, body, onToken=None):
+            return reply
+
+    monkeypatch.setattr(worker, "load_aichat_conversation", lambda aichatid: (turns, None, 0))
+    monkeypatch.setattr(worker, "save_turn_tokens", lambda aichatid, turns: None)
+    monkeypatch.setattr(worker, "save_aichat_result", lambda *args: saved.append(args))
+    monkeypatch.setattr(worker, "publish_aichat_message", lambda aichatid, message: None)
+    monkeypatch.setattr(worker, "store_cached_reply", lambda key, reply: None)
+    monkeypatch.setattr(worker, "get_completion_pool", lambda: Pool())
+
+    task = AiChatTask( "You are helpful.", "hello", "", model, "inuse", "abc", 7 )
+    return worker.OpenAI_Comm.run(task)
+
+# ----------------------------------------------------------------------------------------------
+def test_a_reply_is_saved_with_its_assistant_turn(monkeypatch):
+    saved = []
+    assert run_task(monkeypatch, "gpt-4", " hi there \n", saved)["status"] == 'ready'
+    assert [ s[2] for s in saved ] == ['ready']
+    assert saved[0][3] == "hi there"
+
+# ----------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("model, reply", [ ("gpt-2", "hi there"), ("gpt-4", " \n") ])
+def test_unknown_models_and_empty_replies_fail_without_an_assistant_turn(monkeypatch, model, reply):
+    saved = []
+    with pytest.raises(ValueError):
+        run_task(monkeypatch, model, reply, saved)
+    assert [ s[2] for s in saved ] == ['failed']
+    # no replyText, so no aichat_message row:
+    assert len(saved[0]) == 3
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from starlette.requests import Request
+
+from app.api.conditional import strong_etag, http_date, is_not_modified, if_range_matches
+
+def request(method='GET', **headers):
+    return Request({ "type": "http", "method": method,
+                     "headers": [ (k.replace('_', '-').encode(), v.encode()) for k, v in headers.items() ] })
+
+ETAG = strong_etag(7, 2, 'abc123')
+UPDATED = http_date(datetime(2023, 5, 1, 12, 30, 15, 500))
+
+# ----------------------------------------------------------------------------------------------
+def test_if_none_match():
+    assert is_not_modified(request(if_none_match=ETAG), ETAG, UPDATED)
+    assert is_not_modified(request(if_none_match=f'"other", W/{ETAG}'), ETAG, UPDATED)
+    assert is_not_modified(request(if_none_match='*'), ETAG, UPDATED)
+    assert not is_not_modified(request(if_none_match='"other"'), ETAG, UPDATED)
+    # If-None-Match wins over If-Modified-Since:
+    assert not is_not_modified(request(if_none_match='"other"', if_modified_since=UPDATED), ETAG, UPDATED)
+    assert not is_not_modified(request('PUT', if_none_match=ETAG), ETAG, UPDATED)
+    assert not is_not_modified(request(), ETAG, UPDATED)
+
+# ----------------------------------------------------------------------------------------------
+def test_if_modified_since():
+    assert is_not_modified(request(if_modified_since=UPDATED), ETAG, UPDATED)
+    assert is_not_modified(request(if_modified_since='Mon, 01 May 2023 13:00:00 GMT'), ETAG, UPDATED)
+    assert not is_not_modified(request(if_modified_since='Mon, 01 May 2023 12:00:00 GMT'), ETAG, UPDATED)
+    assert not is_not_modified(request(if_modified_since='not a date'), ETAG, UPDATED)
+
+# ----------------------------------------------------------------------------------------------
+def test_if_range():
+    assert if_range_matches(request(), ETAG, UPDATED)
+    assert if_range_matches(request(if_range=ETAG), ETAG, UPDATED)
+    assert if_range_matches(request(if_range=UPDATED), ETAG, UPDATED)
+    assert not if_range_matches(request(if_range=strong_etag(7, 3, 'def456')), ETAG, UPDATED)
+    assert not if_range_matches(request(if_range=f'W/{ETAG}'), ETAG, UPDATED)
+    assert not if_range_matches(request(if_range='Mon, 01 May 2023 13:00:00 GMT'), ETAG, UPDATED)
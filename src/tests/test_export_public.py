@@ -0,0 +1,61 @@
+import asyncio
+import gzip
+
+from app import export_public
+from app.export_public import PublicExporter, write_page, PAGE_FILE
+
+# ----------------------------------------------------------------------------------------------
+def test_pages_are_written_compressed_and_only_when_changed(tmp_path):
+    page = tmp_path / 'publicmemo' / '7'
+    assert write_page(page, b'<html>v1</html>')
+    assert (page / PAGE_FILE).read_bytes() == b'<html>v1</html>'
+    assert gzip.decompress((page / (PAGE_FILE + '.gz')).read_bytes()) == b'<html>v1</html>'
+    assert not write_page(page, b'<html>v1</html>')
+    assert write_page(page, b'<html>v1</html>', force=True)
+    assert write_page(page, b'<html>v2</html>')
+    assert gzip.decompress((page / (PAGE_FILE + '.gz')).read_bytes()) == b'<html>v2</html>'
+    assert not [ p for p in page.iterdir() if p.name.startswith('.') ]
+
+# ----------------------------------------------------------------------------------------------
+def test_bursts_of_changes_are_coalesced_into_one_export_each(monkeypatch, tmp_path):
+    exports = []
+    events = {}
+
+    async def mock_export_public_site(force=False):
+        exports.append(len(exports) + 1)
+        events['exporting'].set()
+        await events['finish'].wait()
+        return 0, 0
+
+    monkeypatch.setattr(export_public, "export_directory", lambda: tmp_path)
+    monkeypatch.setattr(export_public, "export_public_site", mock_export_public_site)
+
+    async def run():
+        # created in the running loop, as python 3.9 binds them at creation:
+        exporting = events['exporting'] = asyncio.Event()
+        finish = events['finish'] = asyncio.Event()
+        exporter = PublicExporter()
+        # a burst before the export starts is one export:
+        for i in range(50):
+            exporter.schedule()
+        await exporting.wait()
+        assert exports == [1]
+        # and a burst during it is one more after it:
+        for i in range(50):
+            exporter.schedule()
+        finish.set()
+        await exporter.task
+        assert exports == [1, 2]
+        # a change after exports are done starts another:
+        exporter.schedule()
+        await exporter.task
+        assert exports == [1, 2, 3]
+
+    asyncio.run(run())
+
+# ----------------------------------------------------------------------------------------------
+def test_nothing_is_scheduled_while_the_export_is_disabled(monkeypatch):
+    monkeypatch.setattr(export_public, "export_directory", lambda: None)
+    exporter = PublicExporter()
+    exporter.schedule()
+    assert exporter.task is None and not exporter.pending
@@ -0,0 +1,25 @@
+import pytest
+from fastapi import HTTPException
+
+from app.api.fileserve import parse_range_header
+
+# ----------------------------------------------------------------------------------------------
+def test_range_header_forms():
+    assert parse_range_header(None, 100) is None
+    assert parse_range_header('bytes=0-9', 100) == (0, 9)
+    assert parse_range_header('bytes=90-', 100) == (90, 99)
+    assert parse_range_header('bytes=-10', 100) == (90, 99)
+    assert parse_range_header('bytes=50-500', 100) == (50, 99)
+    # multiple ranges are answered with the whole file:
+    assert parse_range_header('bytes=0-9,20-29', 100) is None
+    # as are ranges that are not valid syntax:
+    for rangeHeader in ('bytes=x-y', 'bytes=-', 'bytes=9-0', 'bytes=5', 'bytes=+1-2', 'items=0-9'):
+        assert parse_range_header(rangeHeader, 100) is None
+
+# ----------------------------------------------------------------------------------------------
+def test_unsatisfiable_range():
+    for rangeHeader in ('bytes=100-', 'bytes=100-200', 'bytes=-0'):
+        with pytest.raises(HTTPException) as e:
+            parse_range_header(rangeHeader, 100)
+        assert e.value.status_code == 416
+        assert e.value.headers['content-range'] == 'bytes */100'
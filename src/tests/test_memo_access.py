@@ -0,0 +1,46 @@
+from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy.dialects import postgresql
+
+from app.api import crud
+from app.api.models import UserInDB
+
+metadata = MetaData()
+memo_tb = Table("memo", metadata, Column("memoid", Integer), Column("userid", Integer), Column("projectid", Integer),
+                Column("status", String), Column("access", String))
+proj_tb = Table("project", metadata, Column("projectid", Integer), Column("userid", Integer),
+                Column("status", String), Column("tagid", Integer))
+tag_tb = Table("tag", metadata, Column("tagid", Integer), Column("text", String))
+
+def user(roles='staff MiniCMS'):
+    return UserInDB(username='alice', userid=3, email='alice@example.com', roles=roles,
+                    verify_code='x', hashed_password='bogus')
+
+def sql(clause) -> str:
+    return " ".join(str(clause.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})).split())
+
+# ----------------------------------------------------------------------------------------------
+def test_memo_access_clause_for_a_project_member():
+    clause = sql(crud.memo_access_clause(user(), memo_tb, proj_tb, tag_tb))
+    # public memos are open to all:
+    assert clause.startswith("memo.access = 'public' OR ")
+    # otherwise project access, as its creator or a member of the published project:
+    assert "tag.tagid IS NOT NULL" in clause
+    assert "project.userid = 3" in clause
+    assert "tag.text IN ('MiniCMS')" in clause
+    assert "project.status = 'published'" in clause
+    # then a published staff memo, or the author's own unpublished memo:
+    assert "memo.status = 'published' AND memo.access = 'staff'" in clause
+    assert "memo.status != 'published' AND memo.userid = 3" in clause
+
+# ----------------------------------------------------------------------------------------------
+def test_memo_access_clause_for_admins_and_unverified_users():
+    assert crud.memo_access_clause(user('staff admin'), memo_tb, proj_tb, tag_tb) is None
+    # unverified users see public memos only:
+    clause = sql(crud.memo_access_clause(user('staff MiniCMS unverified'), memo_tb, proj_tb, tag_tb))
+    assert clause == "memo.access = 'public' OR false"
+
+# ----------------------------------------------------------------------------------------------
+def test_project_access_clause_skips_projects_without_their_tag():
+    # as the former per project loop did, for admins too:
+    assert sql(crud.project_access_clause(user('staff admin'), proj_tb, tag_tb)) == "tag.tagid IS NOT NULL"
+    assert sql(crud.project_access_clause(user(), proj_tb, tag_tb)).startswith("tag.tagid IS NOT NULL AND ")
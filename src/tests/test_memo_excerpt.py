@@ -0,0 +1,13 @@
+from app.db import memo_excerpt, MEMO_EXCERPT_LENGTH
+
+# ----------------------------------------------------------------------------------------------
+def test_excerpt_is_plain_text():
+    html = '<p>Hello&nbsp;<b>world</b> &amp; all</p><script>alert(1)</script><p>again</p>'
+    assert memo_excerpt(html) == 'Hello world & all again'
+    assert memo_excerpt(None) == ''
+
+# ----------------------------------------------------------------------------------------------
+def test_long_excerpt_is_cut_at_a_word():
+    excerpt = memo_excerpt('<p>' + 'word ' * 200 + '</p>')
+    assert len(excerpt) <= MEMO_EXCERPT_LENGTH + 3
+    assert excerpt.endswith('word...')
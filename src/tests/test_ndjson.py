@@ -0,0 +1,30 @@
+import asyncio
+import json
+
+from app.api.utils import ndjsonResponse
+
+async def numbered(count):
+    for i in range(count):
+        yield {"id": i, "title": f"note {i}"}
+
+async def body(response) -> str:
+    return "".join([ chunk async for chunk in response.body_iterator ])
+
+# ----------------------------------------------------------------------------------------------
+def test_ndjson_is_one_json_object_per_line():
+    response = ndjsonResponse( numbered(3), json.dumps )
+    assert response.media_type == "application/x-ndjson"
+    lines = asyncio.run(body(response)).split("\n")
+    assert lines[-1] == ""
+    assert [ json.loads(line) for line in lines[:-1] ] == [ {"id": i, "title": f"note {i}"} for i in range(3) ]
+
+# ----------------------------------------------------------------------------------------------
+def test_ndjson_lines_are_sent_in_chunks_of_whole_lines():
+    async def chunks():
+        return [ chunk async for chunk in ndjsonResponse( numbered(10), json.dumps, chunkSize=64 ).body_iterator ]
+    sent = asyncio.run(chunks())
+    assert len(sent) > 1
+    assert all( chunk.endswith("\n") for chunk in sent )
+    assert len("".join(sent).splitlines()) == 10
+    # nothing at all for no items:
+    assert asyncio.run(body(ndjsonResponse( numbered(0), json.dumps ))) == ""
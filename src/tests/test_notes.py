@@ -1,7 +1,10 @@
 import json
+from types import SimpleNamespace
 from typing import List
 
 import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy.dialects import postgresql
 
 from app.api import crud
 from app.api.models import NoteDB
@@ -99,7 +102,7 @@ def test_read_all_notes(test_app, monkeypatch):
                        "data": "{'datum':10}"
                     }]
 
-    async def mock_get_all() -> List[NoteDB]:
+    async def mock_get_all(after=0, limit=None) -> List[NoteDB]:
         return test_data
 
     monkeypatch.setattr(crud, "get_all_notes", mock_get_all)
@@ -108,6 +111,19 @@ def test_read_all_notes(test_app, monkeypatch):
     assert response.status_code == 200
     assert response.json() == test_response
 
+# ----------------------------------------------------------------------------------------------
+# pages are keyset ordered by id: each page follows the last id of the one before:
+def test_notes_query_pages_by_id(monkeypatch):
+    notes_tb = Table("notes", MetaData(), Column("id", Integer), Column("owner", Integer), Column("title", String))
+    monkeypatch.setattr(crud, "get_database_mgr", lambda: SimpleNamespace(get_notes_table=lambda: notes_tb))
+
+    def sql(query) -> str:
+        return " ".join(str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})).split())
+
+    assert sql(crud.notes_query(after=8, limit=2)).endswith("FROM notes WHERE notes.id > 8 ORDER BY notes.id ASC LIMIT 2")
+    # the export reads every note following after:
+    assert sql(crud.notes_query(after=0)).endswith("FROM notes WHERE notes.id > 0 ORDER BY notes.id ASC")
+
 # ----------------------------------------------------------------------------------------------
 def test_update_note(test_app, monkeypatch):
     test_update_data = { "title": "someone", 
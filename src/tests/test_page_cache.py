@@ -0,0 +1,45 @@
+import asyncio
+
+from app.page_cache import PageCache
+
+# ----------------------------------------------------------------------------------------------
+def test_concurrent_misses_render_once():
+    renders = []
+    async def render():
+        renders.append(1)
+        await asyncio.sleep(0.01)
+        return b'<html>home</html>'
+
+    async def main():
+        cache = PageCache()
+        pages = await asyncio.gather( *[ cache.get('/', render) for i in range(20) ] )
+        assert pages == [b'<html>home</html>'] * 20
+        assert await cache.get('/', render) == b'<html>home</html>'
+    asyncio.run(main())
+    assert len(renders) == 1
+
+# ----------------------------------------------------------------------------------------------
+def test_clear_drops_pages_and_renders_in_flight():
+    version = [1]
+    started = []
+    async def render():
+        page = f'v{version[0]}'.encode()
+        started.append(page)
+        await asyncio.sleep(0.01)
+        return page
+
+    async def main():
+        cache = PageCache()
+        assert await cache.get('/', render) == b'v1'
+        version[0] = 2
+        assert await cache.get('/', render) == b'v1'
+        cache.clear()
+        # a render begun before a clear answers its request but is not kept:
+        inFlight = asyncio.ensure_future(cache.get('/', render))
+        while started[-1] != b'v2':
+            await asyncio.sleep(0)
+        cache.clear()
+        version[0] = 3
+        assert await inFlight == b'v2'
+        assert await cache.get('/', render) == b'v3'
+    asyncio.run(main())
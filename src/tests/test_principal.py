@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.api import crud
+from app.api.models import UserInDB
+from app.api.users import AccessContext, get_principal, user_has_role
+
+def user(roles='staff'):
+    return UserInDB(username='alice', userid=3, email='alice@example.com', roles=roles,
+                    verify_code='x', hashed_password='bogus')
+
+# ----------------------------------------------------------------------------------------------
+def test_roles_match_exactly():
+    alice = user('staff MiniCMSCBEdit')
+    assert user_has_role(alice, 'MiniCMSCBEdit')
+    assert not user_has_role(alice, 'MiniCMS')
+    assert not user_has_role(alice, 'CMS')
+    assert not user_has_role(alice, 'staff MiniCMSCBEdit')
+    assert get_principal(alice).projects == frozenset({'MiniCMSCBEdit'})
+
+# ----------------------------------------------------------------------------------------------
+def test_site_role_flags():
+    principal = get_principal(user('staff admin unverified'))
+    assert principal.is_admin and principal.is_unverified and not principal.is_disabled
+    assert principal.projects == frozenset()
+    # the old substring test let a project tag containing "admin" pass as admin:
+    assert not get_principal(user('staff sysadmins')).is_admin
+
+# ----------------------------------------------------------------------------------------------
+def test_principal_is_kept_until_roles_change():
+    alice = user()
+    principal = get_principal(alice)
+    assert get_principal(alice) is principal
+    alice.roles += ' MiniCMS'
+    assert user_has_role(alice, 'MiniCMS')
+    assert get_principal(alice) is not principal
+    # copies, as the user cache hands out, follow their own roles:
+    bob = alice.copy()
+    bob.roles = 'staff disabled'
+    assert get_principal(bob).is_disabled and not get_principal(alice).is_disabled
+
+# ----------------------------------------------------------------------------------------------
+def test_access_helpers_use_the_request_principal():
+    admin = user('staff admin')
+    access = AccessContext(admin)
+    assert crud.access_principal(admin, access) is access.principal
+    # another user's checks do not take this request's principal:
+    assert not crud.access_principal(user(), access).is_admin
+    # an admin is granted without any project lookup, so without the db:
+    memo = SimpleNamespace(access='admin', projectid=7, status='published', userid=9)
+    assert asyncio.run(crud.user_has_memo_access(admin, memo, access))
+    assert asyncio.run(crud.user_has_project_access_by_id(admin, 7, access))
+    assert access.projectAccess == {7: True}
+
+# ----------------------------------------------------------------------------------------------
+def test_access_decisions_are_not_shared_with_other_users():
+    admin = user('staff admin')
+    access = AccessContext(admin)
+    assert asyncio.run(crud.user_has_project_access_by_id(admin, 7, access))
+    assert access.projectAccess == {7: True}
+    # an unverified user is denied without the db, and does not inherit the admin's decision:
+    unverified = user('staff unverified')
+    assert not asyncio.run(crud.user_has_project_access_by_id(unverified, 7, access))
+    assert access.projectAccess == {7: True}
@@ -0,0 +1,11 @@
+import re
+
+from app.api import crud
+
+# ----------------------------------------------------------------------------------------------
+# the pattern is run by Postgres' regexp_replace(); its lookahead reads the same in Python's re:
+def test_bare_ampersands_are_escaped_and_character_references_kept():
+    escape = lambda text: re.sub(crud.SEARCH_BARE_AMPERSAND, '&amp;', text)
+    assert escape("Smith & Jones") == "Smith &amp; Jones"
+    assert escape("R&D, trailing &") == "R&amp;D, trailing &amp;"
+    assert escape("&amp; &lt;b&gt; &#38; &#x26; &nbsp;") == "&amp; &lt;b&gt; &#38; &#x26; &nbsp;"
@@ -0,0 +1,30 @@
+from app.api.models import UserInDB
+from app.user_cache import UserCache
+
+def user(username='alice', userid=3, roles='staff'):
+    return UserInDB(username=username, userid=userid, email='alice@example.com', roles=roles,
+                    verify_code='x', hashed_password='bogus')
+
+# ----------------------------------------------------------------------------------------------
+def test_cached_users_are_copies():
+    cache = UserCache()
+    cache.put(user(), cache.generation)
+    cached = cache.get('alice')
+    cached.roles = 'staff admin'
+    assert cache.get('alice').roles == 'staff'
+    assert cache.get('bob') is None
+
+# ----------------------------------------------------------------------------------------------
+def test_invalidation_by_userid_and_reads_racing_it():
+    cache = UserCache()
+    cache.put(user(), cache.generation)
+    cache.put(user('bob', 4), cache.generation)
+    # a rename leaves the user cached under the old name, dropped by userid:
+    cache.invalidate(3)
+    assert cache.get('alice') is None
+    assert cache.get('bob') is not None
+    # a user read before an invalidation is not kept:
+    generation = cache.generation
+    cache.invalidate(3)
+    cache.put(user(), generation)
+    assert cache.get('alice') is None